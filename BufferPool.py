@@ -3,6 +3,10 @@ import time
 import logging
 db_logger = logging.getLogger('SimpleDB')
 
+# LSN is the byte address of a log record in the log file
+#   lsn = block_number * block_size + (block_size - record_offset)
+# Records are written from the end of a block towards its beginning, so the address grows with every append
+# Being an address, a lsn survives restart and can be turned back into (block, offset) to start reading from it
 class LogMgr:
     # Needs access to file manager because if no log file is present we make one with given block size
     def __init__(self, file_mgr, log_file):
@@ -13,12 +17,16 @@ class LogMgr:
 
         self.log_page = Page(self.file_mgr.block_size)
         log_block_count = self.file_mgr.length(self.log_file)
-        self._lock = threading.Lock()
+        self._lock = threading.RLock() # reentrant because appendLog flushes a full page while holding it
+        self._read_cache = (-1, None)
 
         if log_block_count:
             # read last block of log file and put it in a page
             self.log_block = Block(self.log_file, log_block_count - 1)
             self.file_mgr.readBlockToPage(self.log_block, self.log_page)
+            # continue numbering after the last record on disk; an empty last block continues from its start address
+            self.current_lsn = self.lsn(self.log_block.block_number, min(self.log_page.getInt(0), self.file_mgr.block_size))
+            self.last_saved_lsn = self.current_lsn
         else:
             # create new log, block and page
             self.log_block = self.file_mgr.appendEmptyBlock(self.log_file)
@@ -26,7 +34,10 @@ class LogMgr:
             self.file_mgr.writePageToBlock(self.log_block, self.log_page)
 
     # add b'log_record' to current log_page and return current_lsn
+    # A record must fit in a single log block(its length and the page boundary take 8 bytes); nothing is written otherwise
     def appendLog(self, log_record):
+        if len(log_record) > self.file_mgr.block_size - 8:
+            raise Exception('Log record of ' + str(len(log_record)) + ' bytes does not fit in a log block of ' + str(self.file_mgr.block_size) + ' bytes.')
         with self._lock:
             boundary = self.log_page.getInt(0)
             bytes_needed = len(log_record) + 4  # for writing length of binary blob
@@ -44,52 +55,122 @@ class LogMgr:
             offset = boundary - bytes_needed
             self.log_page.setData(offset, log_record)  # ACTUAL WRITE
             self.log_page.setData(0, offset)  # Update offset for the next write
-            self.current_lsn += 1
+            self.current_lsn = self.lsn(self.log_block.block_number, offset)
             return self.current_lsn
 
     # Log manager manually decides when to write the page to disk
+    # Commit durability depends on this write, so it runs under the same lock as appendLog
+    #   otherwise a concurrent append could swap log_block/log_page halfway through the flush
     def flushPage(self, lsn=None):
-        # without lsn; flush the log page
-        if not lsn:
-            self.file_mgr.writePageToBlock(self.log_block, self.log_page)
-            self.last_saved_lsn = self.current_lsn  # because we will be flushing all logs from the single log page
-            return
+        with self._lock:
+            # without lsn; flush the log page
+            if not lsn:
+                self.file_mgr.writePageToBlock(self.log_block, self.log_page)
+                self.last_saved_lsn = self.current_lsn  # because we will be flushing all logs from the single log page
+                return
+
+            # with lsn; dont flush the log page if those lsn were already flushed
+            if lsn > self.last_saved_lsn:  # TODO: do we need >= instead?
+                self.flushPage()
 
-        # with lsn; dont flush the log page if those lsn were already flushed
-        if lsn > self.last_saved_lsn:  # TODO: do we need >= instead?
-            self.flushPage()
+    # Random access to a single log record
+    # The tail block is read from memory(no flush needed); older blocks never change once written,
+    #   so the last block read from disk is kept around for the next call(rollback reads neighbouring records)
+    def readLog(self, lsn):
+        block_number, offset = self.position(lsn)
+        with self._lock:
+            if block_number == self.log_block.block_number:
+                return self.log_page.getByte(offset)
+        cached_block_number, cached_page = self._read_cache
+        if cached_block_number != block_number:
+            cached_page = Page(self.file_mgr.block_size)
+            self.file_mgr.readBlockToPage(Block(self.log_file, block_number), cached_page)
+            self._read_cache = (block_number, cached_page)
+        return cached_page.getByte(offset)
+
+    # (block number, record offset) -> lsn
+    def lsn(self, block_number, offset):
+        return block_number * self.file_mgr.block_size + (self.file_mgr.block_size - offset)
+
+    # lsn -> (block number, record offset)
+    def position(self, lsn):
+        block_number = (lsn - 1) // self.file_mgr.block_size
+        return block_number, self.file_mgr.block_size - (lsn - block_number * self.file_mgr.block_size)
 
     # this is a stateful function; depends on what block log manager is currently working on
-    def iterator(self):
+    # Without start_lsn, a backward iterator starts at the newest record and a forward iterator at the oldest one
+    # with_lsn makes the iterator yield (lsn, log_record) pairs instead of log_record
+    def iterator(self, start_lsn=None, forward=False, with_lsn=False):
         self.flushPage()  # we flush the log page to ensure iteration goes over all log records
-        return LogIter(self.file_mgr, self.log_block)  # Returning the current block
+        start = self.position(start_lsn) if start_lsn else None
+        return LogIter(self.file_mgr, self.log_block, start, forward, with_lsn)  # Returning the current block
 
 
+# Walks the log file backward(newest first) or forward(oldest first)
+# Blocks are read BATCH_BLOCKS at a time with FileMgr.readBlocks; records are sliced out lazily by a generator
+# Inside a block records are stacked from the end of the block, so the newest one sits at the lowest offset
 class LogIter:
-    def __init__(self, fm, block):
+    BATCH_BLOCKS = 64
+
+    # block is the last block of the log; start is an optional (block number, record offset) to begin at(inclusive)
+    def __init__(self, fm, block, start=None, forward=False, with_lsn=False):
         self.fm = fm
         self.block = block
+        self.start = start
+        self.forward = forward
+        self.with_lsn = with_lsn
 
     def __iter__(self):
-        self.temp_page = Page(self.fm.block_size)
-        self.fm.readBlockToPage(self.block, self.temp_page)
-        self.current_offset = self.temp_page.getInt(0)
-        return self  # returning self because in each loop self.__next__ will be called
-
-    def __next__(self):
-        if self.current_offset >= self.fm.block_size:  # reached at the end of the block
-            self.block = Block(self.block.file_name,
-                               self.block.block_number - 1)  # TODO: Why -1? Doesn't block number start
-            if self.block.block_number < 0:
-                raise StopIteration()
-            else:
-                self.fm.readBlockToPage(self.block, self.temp_page)
-                self.current_offset = self.temp_page.getInt(0)
-
-        log_record = self.temp_page.getByte(self.current_offset)
-        self.current_offset = self.current_offset + len(log_record) + 4  # 4 bytes tho skip the length of the Byte blob
+        return self._forward() if self.forward else self._backward()
+
+    # offsets of all records in a block, newest first
+    def _offsets(self, data, block_start):
+        block_size = self.fm.block_size
+        offsets = []
+        offset = int.from_bytes(data[block_start: block_start + 4], 'big')
+        if offset < 4:
+            return offsets  # zeroed block; appended but never written
+        while offset < block_size:
+            offsets.append(offset)
+            offset += int.from_bytes(data[block_start + offset: block_start + offset + 4], 'big') + 4
+        return offsets
+
+    def _record(self, data, block_start, block_number, offset):
+        record_len = int.from_bytes(data[block_start + offset: block_start + offset + 4], 'big')
+        log_record = data[block_start + offset + 4: block_start + offset + 4 + record_len]
+        if self.with_lsn:
+            return block_number * self.fm.block_size + (self.fm.block_size - offset), log_record
         return log_record
 
+    def _backward(self):
+        block_size = self.fm.block_size
+        block_number, start_offset = self.start if self.start else (self.block.block_number, 0)
+        while block_number >= 0:
+            first = max(0, block_number - LogIter.BATCH_BLOCKS + 1)
+            data = self.fm.readBlocks(self.block.file_name, first, block_number - first + 1)
+            for b in range(block_number, first - 1, -1):
+                block_start = (b - first) * block_size
+                for offset in self._offsets(data, block_start):
+                    if offset >= start_offset:
+                        yield self._record(data, block_start, b, offset)
+                start_offset = 0
+            block_number = first - 1
+
+    def _forward(self):
+        block_size = self.fm.block_size
+        block_number, start_offset = self.start if self.start else (0, block_size)
+        last_block = self.block.block_number
+        while block_number <= last_block:
+            count = min(LogIter.BATCH_BLOCKS, last_block - block_number + 1)
+            data = self.fm.readBlocks(self.block.file_name, block_number, count)
+            for b in range(block_number, block_number + count):
+                block_start = (b - block_number) * block_size
+                for offset in reversed(self._offsets(data, block_start)):
+                    if offset <= start_offset:
+                        yield self._record(data, block_start, b, offset)
+                start_offset = block_size
+            block_number += count
+
 
 # pins page to block and tracks pin count
 class Buffer:
@@ -100,14 +181,22 @@ class Buffer:
         self.block = None
         self.page = Page(fm.block_size)
         self.lsn = -1
+        self.rec_lsn = -1 # lower bound of the first lsn that dirtied this buffer since it was last flushed
         self.txnum = -1
         self.pin_count = 0
+        self.latch = threading.Lock() # short term; held while a transaction reads or writes the page
+
+    # Called before the update is logged with a lsn no larger than the update's lsn
+    # A checkpoint taken in between then either sees this buffer as dirty, or begins after its update was logged
+    def markDirty(self, lsn):
+        if self.rec_lsn < 0:
+            self.rec_lsn = lsn
 
     # TODO when we might call it as setMod(x, 0)
     def setModified(self, txnum,
                     lsn):  # once Transaction sets data, it updates the txnum that updated the buffer, and pos lsn if it was loggable activity
         self.txnum = txnum
-        if lsn >= 0:  # first lsn value is 1
+        if lsn > self.lsn:  # first lsn value is 1; with record locking several transactions update the same buffer
             self.lsn = lsn
 
     def assignToBlock(self, block):
@@ -127,6 +216,7 @@ class Buffer:
 
             self.fm.writePageToBlock(self.block, self.page)
             self.txnum = -1
+            self.rec_lsn = -1
         # else nothing has happened yet, therefore there is nothing to flush
 
     def pin(self):
@@ -136,6 +226,129 @@ class Buffer:
         self.pin_count -= 1
 
 
+# Page versions for snapshot(read-only) transactions
+# Every write to a page also records (txnum, offset, overwritten bytes) for its block
+# A snapshot sees the writes of a transaction only if that transaction completed before the snapshot began
+#   reading a block copies the page and puts back, newest first, the bytes it must not see
+# Rolled back transactions complete as well; their writes and compensations cancel out
+# Once a transaction's writes are visible to every open snapshot, its entries are dropped
+# Nothing is recorded while no snapshot(or optimistic transaction) is open, so plain 2PL writes skip the store
+#   the first snapshot switches recording on and brings in, from the log, the writes of transactions already running
+#   the last one to end switches it off and drops everything
+class VersionStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._switch_lock = threading.Lock() # held while recording is switched on or off
+        self.recording = False
+        self.seq = 0
+        self.completed = {} # txnum -> completion seq, for transactions whose entries are still kept
+        self.deltas = {} # block -> [(txnum, offset, overwritten bytes), ...] in write order; offset None holds an undo(page) instead
+        self.tx_blocks = {} # txnum -> blocks it wrote
+        self.snapshots = {} # seq -> number of open snapshots started at seq
+        self.block_versions = {} # block -> seq of the last transaction that completed after writing it
+        self.commit_lsn = 0 # newest <COMMIT> of a completed transaction that may not be flushed yet(early lock release)
+
+    # Called under the buffer latch, right before the write
+    def record(self, txnum, block, offset, old_bytes):
+        if not self.recording:
+            return
+        with self._lock:
+            self.deltas.setdefault(block, []).append((txnum, offset, old_bytes))
+            self.tx_blocks.setdefault(txnum, set()).add(block)
+
+    # A change that is not a byte range of its own; undo(page) reverts it on a snapshot copy
+    # Called under the buffer latch, right before the change
+    def recordUndo(self, txnum, block, undo):
+        self.record(txnum, block, None, undo)
+
+    # Transaction committed or rolled back
+    # commit_lsn; its <COMMIT> when that is not flushed yet, a snapshot that sees the writes must flush it(see Transaction.commit)
+    def complete(self, txnum, commit_lsn=0):
+        with self._lock:
+            self.commit_lsn = max(self.commit_lsn, commit_lsn)
+            if txnum in self.tx_blocks:
+                self.seq += 1
+                self.completed[txnum] = self.seq
+                for block in self.tx_blocks[txnum]:
+                    self.block_versions[block] = self.seq
+                self._collect()
+
+    # Used by optimistic validation; did a transaction that completed after seq write any of the blocks
+    def changedSince(self, blocks, seq):
+        with self._lock:
+            return any(self.block_versions.get(block, 0) > seq for block in blocks)
+
+    # backfill() is called when this snapshot switches recording on; it adds the writes made while it was off(see addEarlier)
+    def beginSnapshot(self, backfill):
+        with self._switch_lock:
+            if not self.recording:
+                self.recording = True
+                backfill()
+            with self._lock:
+                self.snapshots[self.seq] = self.snapshots.get(self.seq, 0) + 1
+                return self.seq
+
+    def endSnapshot(self, seq):
+        with self._switch_lock, self._lock:
+            self.snapshots[seq] -= 1
+            if not self.snapshots[seq]:
+                del self.snapshots[seq]
+            if self.snapshots:
+                self._collect()
+            else:
+                self.recording = False
+                self.completed.clear()
+                self.deltas.clear()
+                self.tx_blocks.clear()
+                self.block_versions.clear()
+
+    # Writes of a running transaction made before recording was switched on, oldest first; (block, offset, overwritten bytes)
+    # They go in front of the block's entries, which are all newer
+    def addEarlier(self, txnum, writes):
+        with self._lock:
+            earlier = {}
+            for block, offset, old_bytes in writes:
+                earlier.setdefault(block, []).append((txnum, offset, old_bytes))
+                self.tx_blocks.setdefault(txnum, set()).add(block)
+            for block, entries in earlier.items():
+                self.deltas[block] = entries + self.deltas.get(block, [])
+
+    # Copy of the buffer's page as a snapshot started at seq sees it; called under the buffer latch
+    def read(self, buffer, seq):
+        page = Page(bytearray(buffer.page.bb))
+        with self._lock:
+            for txnum, offset, old_bytes in reversed(self.deltas.get(buffer.block, ())):
+                completed = self.completed.get(txnum)
+                if completed is None or completed > seq:
+                    if offset is None:
+                        old_bytes(page)
+                    else:
+                        page.bb[offset:offset + len(old_bytes)] = old_bytes
+        return page
+
+    def _collect(self):
+        oldest = min(self.snapshots) if self.snapshots else self.seq
+        for txnum in [t for t, completed in self.completed.items() if completed <= oldest]:
+            for block in self.tx_blocks.pop(txnum):
+                remaining = [d for d in self.deltas[block] if d[0] != txnum]
+                if remaining:
+                    self.deltas[block] = remaining
+                else:
+                    del self.deltas[block]
+            del self.completed[txnum]
+
+
+# A transaction was aborted by the engine and may succeed if it runs again(see Transaction.run)
+# The caller still has to roll it back
+class AbortException(Exception):
+    pass
+
+
+# No buffer became available while pinning; the pool is full of pinned buffers
+class BufferAbortException(AbortException):
+    pass
+
+
 # BufferMgr pins Block(which returns a Buffer ref); The Buffer ref is used to unpin the buffer
 # BufferMgr does two things.
 #   track changes to page(new data) and
@@ -163,27 +376,49 @@ class BufferMgr:
         self.buffer_pool = [Buffer(self.fm, self.lm) for _ in range(self.num_buffers)]
         self.pool_availability = self.num_buffers
         self._condition = threading.Condition()  # Condition is event and lock combined
+        self.versions = VersionStore()
 
-    def flushAll(self, at_txnum):
+    # flush buffers modified by at_txnum; without at_txnum flush every modified buffer(checkpoint)
+    def flushAll(self, at_txnum=None):
         with self._condition:
             for b in self.buffer_pool:
-                if b.txnum == at_txnum:
+                if b.txnum == at_txnum or (at_txnum is None and b.txnum >= 0):
                     b.flushDirtyBufferWithLog()
 
+    # Used by checkpoints; flushing an unpinned buffer never races with a transaction writing to it
+    def flushUnpinned(self):
+        with self._condition:
+            for b in self.buffer_pool:
+                if b.txnum >= 0 and not b.pin_count > 0:
+                    b.flushDirtyBufferWithLog()
+
+    # dirty page table; {block: rec_lsn} of every modified buffer
+    def dirtyPages(self):
+        with self._condition:
+            return {b.block: b.rec_lsn for b in self.buffer_pool if b.txnum >= 0 and b.rec_lsn >= 0}
+
     # takes buffer; returns nothing
     def unpin(self, target_buffer):
-        db_logger.info('Unpinning ' + str(target_buffer.block))
         with self._condition:
             target_buffer.unpin()
             if not target_buffer.pin_count > 0:
                 self.pool_availability += 1  # No client is using it. New request to pin is now eligible to replace this buffer
                 self._condition.notify_all()  # wakes up thread waiting on the condition variable; but the lock is not yet released
         # Lock is released after we exit the context manager
-        db_logger.info('Unpinned ' + str(target_buffer.block))
+        if db_tracer.buffer:
+            db_tracer.emit('buffer', 'unpin', lambda: {'block': str(target_buffer.block), 'pin_count': target_buffer.pin_count})
+
+    # Drops many pins under a single lock acquisition(a transaction completing); pins are (buffer, count) pairs
+    def unpinAll(self, pins):
+        with self._condition:
+            for target_buffer, count in pins:
+                target_buffer.pin_count -= count
+                if not target_buffer.pin_count > 0:
+                    self.pool_availability += 1
+            self._condition.notify_all()
 
     # takes block; returns buffer
     def pin(self, target_block):
-        db_logger.info('Pinning ' + str(target_block))
         with self._condition:
             b = self.tryToPin(target_block)
             start = time.time()
@@ -193,14 +428,16 @@ class BufferMgr:
                 b = self.tryToPin(target_block)
             # we tried to pin a few times, and it has been over 10 seconds
             if not b:
-                raise Exception("Buffer Pool is full.")
-        db_logger.info('Pinned ' + str(target_block))
+                raise BufferAbortException("Buffer Pool is full.")
+        if db_tracer.buffer:
+            db_tracer.emit('buffer', 'pin', lambda: {'block': str(target_block), 'pin_count': b.pin_count})
         return b
 
     def tryToPin(self, target_block):
         b = self.findExistingBuffer(target_block)  # check if the requested block is already present in the buffer pool
         if not b:
-            db_logger.info('Not in buffer pool ' + str(target_block))
+            if db_tracer.buffer:
+                db_tracer.emit('buffer', 'miss', lambda: {'block': str(target_block)})
             b = self.chooseUnpinnedBuffer()  # requested block is not already in the buffer pool; so find an unpinned buffer
             if not b:
                 return None  # requested block is neither in buffer pool nor we have any unpinned buffer
@@ -1,6 +1,7 @@
 import os
 import threading
 import logging
+from Tracer import *
 db_logger = logging.getLogger('SimpleDB')
 
 # file system allows accessing raw disk in blocks.
@@ -122,10 +123,23 @@ class FileMgr:
                 page.bb = bytearray(self.block_size)
             f.close()
 
+    # Read `count` consecutive blocks starting at `first_block` with a single read call
+    # Returned bytearray is shorter than count * block_size if the file ends early
+    # Used by sequential readers(i.e. LogIter) so scanning n blocks does not cost n open/seek/read
+    def readBlocks(self, file_name, first_block, count):
+        with self._lock:
+            self.length(file_name)  # same hack as readBlockToPage to create missing file
+            f = open(file_name, 'rb', buffering=0)
+            f.seek(self.block_size * first_block)
+            content = bytearray(f.read(self.block_size * count))
+            f.close()
+            return content
+
     # if file does not exist we create a new one
     def writePageToBlock(self, block, page):
         with self._lock:
-            db_logger.info('Disk write of ' + str(block))
+            if db_tracer.file:
+                db_tracer.emit('file', 'write', lambda: {'block': str(block)})
             f = open(block.file_name, 'r+b', buffering=0)  # r is used because a prevents seek and w truncates the file
             f.seek(self.block_size * block.block_number)
             f.write(page.bb)
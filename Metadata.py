@@ -17,9 +17,11 @@ class TableMgr:
     def __init__(self, tx, init_table_catalog):
         self.tx = tx
 
+        # fill_factor; 0 for fixed-length slots(Layout), otherwise a slotted table(SlottedLayout) and its fill factor in percent
         self.table_catalog_schema = Schema(
             ['table_name', 'str', 20],
-            ['slot_size', 'int', 4]
+            ['slot_size', 'int', 4],
+            ['fill_factor', 'int', 4]
         )
         self.table_catalog_layout = Layout(self.table_catalog_schema) # Used in getLayoutMetadata
 
@@ -41,7 +43,8 @@ class TableMgr:
     # Create a new table in the database
     #   This does not imply creating a new tbl file
     #   but this implies creating appropriate entries to the table_catalog and field_catalog
-    def createTable(self, tx, new_table_name, new_sch):
+    # slotted=True stores the table's records in slotted pages(see SlottedLayout), fill_factor is kept for its inserts
+    def createTable(self, tx, new_table_name, new_sch, slotted=False, fill_factor=0.9):
         temp_layout = Layout(new_sch)
 
         # Add new table name and its slot size to the table_catalog table
@@ -49,6 +52,7 @@ class TableMgr:
         table_ts.nextEmptyRecord()
         table_ts.setString('table_name', new_table_name)
         table_ts.setInt('slot_size', temp_layout.slot_size)
+        table_ts.setInt('fill_factor', round(fill_factor * 100) if slotted else 0)
         table_ts.closeRecordPage()
 
         # Add fields info of the new tables to field_catalog table
@@ -76,11 +80,19 @@ class TableMgr:
         # Although Layout constructor auto initialize slot_size
         #   we are still getting the value from table_catalog to ensure all data in layout is coming from table
         temp_slot_size = None
+        fill_factor = 0
         slot_ts = TableScan(tx, 'table_catalog', self.table_catalog_layout)
         while slot_ts.nextRecord():
             if slot_ts.getString('table_name') == table_name:
                 temp_slot_size = slot_ts.getInt('slot_size')
+                fill_factor = slot_ts.getInt('fill_factor')
         slot_ts.closeRecordPage()
+        if fill_factor:
+            # a slotted record holds its fields in schema order; the field offsets keep that order
+            slotted_sch = Schema()
+            for f in sorted(temp_offset, key=temp_offset.get):
+                slotted_sch.addField(f, temp_sch.field_info[f]['field_type'], temp_sch.field_info[f]['field_byte_length'])
+            return SlottedLayout(slotted_sch, fill_factor / 100)
         return Layout(temp_sch, temp_offset, temp_slot_size)
 
 class ViewMgr:
@@ -121,8 +133,7 @@ class StatMgr:
         self._refreshAll = threading.Lock()
         self._refreshOne = threading.Lock()
         self._numcalls = 0
-        self.table_stats = {}
-        self.refreshStatistics(self.tx)
+        self.table_stats = {} # filled lazily by getStatInfo; startup does not scan any table
 
     # This method needs layout parameter
     #   because it might need to open and parse the table to calculate the table statistics
@@ -171,9 +182,9 @@ class IndexMgr:
         self.tm: TableMgr = tm
         self.sm: StatMgr = sm
 
+        index_sch = Schema(['index_name', 'str', 20], ['table_name', 'str', 20],['field_name', 'str', 20])
+        self.index_layout = Layout(index_sch)
         if init_index_catalog:
-            index_sch = Schema(['index_name', 'str', 20], ['table_name', 'str', 20],['field_name', 'str', 20])
-            self.index_layout = Layout(index_sch)
             tm.createTable(tx, 'index_catalog', index_sch)
 
     # Create an index over a particular column on a table
@@ -231,8 +242,8 @@ class MetadataMgr:
         self.stat_mgr = StatMgr(self.tx, self.table_mgr)
         self.index_mgr = IndexMgr(self.tx, self.table_mgr, self.stat_mgr, init_db)
 
-    def createTable(self, tx, table_name, schema):
-        self.table_mgr.createTable(tx, table_name, schema)
+    def createTable(self, tx, table_name, schema, slotted=False, fill_factor=0.9):
+        self.table_mgr.createTable(tx, table_name, schema, slotted, fill_factor)
     def getLayout(self, tx, table_name):
         return self.table_mgr.getLayout(tx, table_name)
 
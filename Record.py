@@ -1,4 +1,5 @@
 from Transaction import *
+import struct
 import logging
 db_logger = logging.getLogger('SimpleDB')
 
@@ -30,11 +31,15 @@ class Schema:
 
 
 # Layout hold record's field and slot side; field offset within a slot
+# A 'text' field holds a string of any length; field_byte_length is how much of it is kept in the row
+#   the row has a 4 byte reference to its overflow chain(0 if the value is in the row, see Overflow) followed by the string
 class Layout:
     """Calculates field offset from schema info"""
 
     def __init__(self, schema, offset = None, slot_size = None):
         self.schema = schema
+        self.text_fields = {field_name for field_name, info in schema.field_info.items() if info['field_type'] == 'text'}
+        self._codec = None
 
         if not offset and not slot_size:
             self.offset = {} # Holds byte offset for all fields inside a record
@@ -42,6 +47,8 @@ class Layout:
             for sk, sv in self.schema.field_info.items():
                 self.offset[sk] = field_pos
                 field_pos += (sv['field_byte_length'] if sv['field_type'] == 'int' else (sv['field_byte_length'] + 4))
+                if sk in self.text_fields:
+                    field_pos += 4
             self.slot_size = field_pos
         else:
             # we are reading everything from table_catalog and field_catalog table
@@ -49,13 +56,241 @@ class Layout:
             self.offset = offset
             self.slot_size = slot_size
 
+    # Slots that fit in a block after the record page header(see SlotHeader)
+    def slotsPerBlock(self, block_size):
+        return SlotHeader.geometry(block_size, self.slot_size)[0]
+
+    # Record page that interprets the blocks of a table with this layout
+    def recordPage(self, tx, blk):
+        return RecordPage(tx, blk, self)
+
+    # RowCodec of a slot, compiled the first time a whole row is read or written
+    def codec(self):
+        if self._codec is None:
+            self._codec = RowCodec(self)
+        return self._codec
+
+    # values with every text value too long for its field moved to the overflow file of file_name
+    # Done once before a row is written, a row that has to try several blocks does not store its values again
+    def toast(self, tx, file_name, values):
+        if not self.text_fields or not values:
+            return values
+        values = dict(values)
+        for field_name in self.text_fields & values.keys():
+            value = values[field_name]
+            if isinstance(value, str) and len(value.encode()) > self.schema.field_info[field_name]['field_byte_length']:
+                values[field_name] = Overflow.store(tx, file_name, value)
+        return values
+
     def __str__(self):
         return 'Layout :: \n' + str(self.schema) + 'Slot size: ' + str(self.slot_size)
 
+
+# Layout of variable-length records(see SlottedPage)
+# A record is its fields in schema order; an int takes 4 bytes, a string 4 bytes of length and only the bytes it uses
+#   a text field has 4 more bytes in front, the reference to its overflow chain(0 if the value is in the record)
+# field_byte_length is the most a string may take, slot_size the largest record
+# fill_factor; share of a block inserts may fill, the rest is kept for updates that make records longer
+class SlottedLayout(Layout):
+    """Encodes whole records for slotted pages"""
+
+    def __init__(self, schema, fill_factor=0.9):
+        super().__init__(schema)
+        self.fill_factor = fill_factor
+        self.fields = [(field_name, info['field_type'] == 'int', field_name in self.text_fields) for field_name, info in schema.field_info.items()]
+        self.min_size = 4 * len(self.fields) + 4 * len(self.text_fields) # every string empty
+
+    # values; {field_name: value}, missing fields are 0 or empty
+    # A text value is either a string that fits its field or an Overflow(see Layout.toast)
+    def encode(self, values):
+        record = bytearray()
+        for field_name, is_int, is_text in self.fields:
+            if is_int:
+                record += values.get(field_name, 0).to_bytes(4, 'big')
+                continue
+            value = values.get(field_name, '')
+            if is_text:
+                record += (value.block_number + 1 if isinstance(value, Overflow) else 0).to_bytes(4, 'big')
+            data = b'' if isinstance(value, Overflow) else value.encode()
+            if len(data) > self.schema.field_info[field_name]['field_byte_length']:
+                raise Exception('Value of ' + field_name + ' is longer than ' + str(self.schema.field_info[field_name]['field_byte_length']) + ' bytes.')
+            record += len(data).to_bytes(4, 'big') + data
+        return bytes(record)
+
+    # A text value stored out of the record is decoded to its Overflow; the chain is only read when the field is(see SlottedPage.getString)
+    def decode(self, record):
+        values, pos = {}, 0
+        for field_name, is_int, is_text in self.fields:
+            if is_int:
+                values[field_name] = int.from_bytes(record[pos:pos + 4], 'big')
+                pos += 4
+                continue
+            reference = 0
+            if is_text:
+                reference = int.from_bytes(record[pos:pos + 4], 'big')
+                pos += 4
+            length = int.from_bytes(record[pos:pos + 4], 'big')
+            values[field_name] = Overflow(reference - 1) if reference else record[pos + 4:pos + 4 + length].decode()
+            pos += 4 + length
+        return values
+
+    def recordPage(self, tx, blk):
+        return SlottedPage(tx, blk, self)
+
+# Whole slot(flag and every field) of a fixed-length layout as one struct.Struct, compiled from the field offsets
+#   an int is 'I', a string its length and its bytes('I' + '<n>s'), a text field its overflow reference in front('II<n>s')
+#   ints are unsigned big endian, like Page writes them; bytes between fields are skipped('x')
+# unpack(slot bytes) returns {field_name: value}, a text value stored out of the row as its Overflow
+# pack(values) returns the slot bytes of a used slot; missing fields are 0 or empty
+class RowCodec:
+    """Decodes and encodes the slot of a record in one struct call"""
+    INT, STR, TEXT = 0, 1, 2
+
+    def __init__(self, layout):
+        self.fields = [] # (field_name, kind, max string length), in slot order
+        fmt, pos = '>I', 4
+        for field_name in sorted(layout.offset, key=layout.offset.get):
+            info = layout.schema.field_info[field_name]
+            if layout.offset[field_name] > pos:
+                fmt += '%dx' % (layout.offset[field_name] - pos)
+            if info['field_type'] == 'int':
+                kind, fmt, pos = RowCodec.INT, fmt + 'I', layout.offset[field_name] + 4
+            else:
+                kind = RowCodec.TEXT if field_name in layout.text_fields else RowCodec.STR
+                fmt += ('II%ds' if kind == RowCodec.TEXT else 'I%ds') % info['field_byte_length']
+                pos = layout.offset[field_name] + info['field_byte_length'] + (8 if kind == RowCodec.TEXT else 4)
+            self.fields.append((field_name, kind, info['field_byte_length']))
+        if layout.slot_size > pos:
+            fmt += '%dx' % (layout.slot_size - pos)
+        self.struct = struct.Struct(fmt)
+
+    def unpack(self, data):
+        values, row, i = self.struct.unpack(data), {}, 1
+        for field_name, kind, _ in self.fields:
+            if kind == RowCodec.INT:
+                row[field_name] = values[i]
+                i += 1
+            elif kind == RowCodec.STR:
+                row[field_name] = values[i + 1][:values[i]].decode()
+                i += 2
+            else:
+                row[field_name] = Overflow(values[i] - 1) if values[i] else values[i + 2][:values[i + 1]].decode()
+                i += 3
+        return row
+
+    # Strings must fit their field; text values that do not were moved to overflow blocks before(see Layout.toast)
+    def pack(self, values):
+        args = [1]
+        for field_name, kind, max_length in self.fields:
+            value = values.get(field_name, 0 if kind == RowCodec.INT else '')
+            if kind == RowCodec.INT:
+                args.append(value)
+                continue
+            if kind == RowCodec.TEXT:
+                args.append(value.block_number + 1 if isinstance(value, Overflow) else 0)
+                value = '' if isinstance(value, Overflow) else value
+            data = value.encode()
+            if len(data) > max_length:
+                raise Exception('Value of ' + field_name + ' is longer than ' + str(max_length) + ' bytes.')
+            args += [len(data), data]
+        return self.struct.pack(*args)
+
+
+# Out-of-line storage of text values too long for their field(TOAST), in a side file of the table(<table>.ovf)
+# A value is cut into a chain of blocks; a block starts with the number of the next one plus 1(0 ends the chain)
+#   and the length of its piece, the piece follows
+# The row keeps the first block's number(plus 1, so 0 can mean "in the row"); the chain is read only when the field is
+# Chains are written by the transaction like any other block(locked and logged) and never changed afterwards
+#   an update stores a new chain and frees the old one, so does a delete
+# A block with a piece length of 0 is empty; freeing a chain empties its blocks with delete row records
+#   which puts them on the free space map of the overflow file(see FreeSpaceMap), new chains take blocks from there before appending
+#   the map is a hint like a table's; a block is only taken once it is locked and still empty
+class Overflow:
+    """Reference to a text value stored in overflow blocks"""
+    HEADER_SIZE = 8
+
+    def __init__(self, block_number):
+        self.block_number = block_number
+
+    @staticmethod
+    def fileName(data_file):
+        return os.path.splitext(data_file)[0] + '.ovf'
+
+    @staticmethod
+    def store(tx, data_file, value):
+        file_name = Overflow.fileName(data_file)
+        data = value.encode()
+        piece_size = tx.blockSize() - Overflow.HEADER_SIZE
+        pieces = [data[start:start + piece_size] for start in range(0, len(data), piece_size)]
+        blocks = Overflow._allocate(tx, file_name, len(pieces))
+        for i, piece in enumerate(pieces):
+            next_block = blocks[i + 1].block_number + 1 if i + 1 < len(blocks) else 0
+            tx.setRaw(blocks[i], [(0, next_block.to_bytes(4, 'big') + len(piece).to_bytes(4, 'big') + piece)], LogRecord.UPDATEROW)
+            tx.markFull(blocks[i], lambda page: not Overflow._isEmpty(page.bb))
+            tx.unpin(blocks[i])
+        return Overflow(blocks[0].block_number)
+
+    # count pinned and X locked empty blocks; free ones first, then appended ones
+    @staticmethod
+    def _allocate(tx, file_name, count):
+        blocks, block_number = [], -1
+        while len(blocks) < count:
+            block_number = tx.nextFreeBlock(file_name, block_number)
+            if block_number < 0:
+                break
+            blk = Block(file_name, block_number)
+            tx.pin(blk)
+            if tx.peekPage(blk, Overflow._isEmpty):
+                tx.xLockBlock(blk)
+                if Overflow._isEmpty(tx.getBytes(blk, 0, Overflow.HEADER_SIZE)): # still empty now that we hold the lock
+                    blocks.append(blk)
+                    continue
+            tx.markFull(blk, lambda page: not Overflow._isEmpty(page.bb))
+            tx.unpin(blk)
+        while len(blocks) < count:
+            blk = tx.append(file_name)
+            tx.pin(blk)
+            tx.xLockBlock(blk)
+            blocks.append(blk)
+        return blocks
+
+    @staticmethod
+    def _isEmpty(page):
+        return not int.from_bytes(page[4:8], 'big')
+
+    # Reads the value back, one block read per block of the chain
+    def load(self, tx, data_file):
+        file_name, data, block_number = Overflow.fileName(data_file), bytearray(), self.block_number
+        while True:
+            blk = Block(file_name, block_number)
+            tx.pin(blk)
+            page = tx.getBytes(blk, 0, tx.blockSize())
+            tx.unpin(blk)
+            next_block, length = int.from_bytes(page[0:4], 'big'), int.from_bytes(page[4:8], 'big')
+            data += page[Overflow.HEADER_SIZE:Overflow.HEADER_SIZE + length]
+            if not next_block:
+                return data.decode()
+            block_number = next_block - 1
+
+    # Empties the blocks of the chain; the value must no longer be referenced by its row
+    def free(self, tx, data_file):
+        file_name, block_number = Overflow.fileName(data_file), self.block_number
+        while True:
+            blk = Block(file_name, block_number)
+            tx.pin(blk)
+            tx.xLockBlock(blk)
+            next_block = int.from_bytes(tx.getBytes(blk, 0, 4), 'big')
+            tx.setRaw(blk, [(0, bytes(Overflow.HEADER_SIZE))], LogRecord.DELETEROW)
+            tx.unpin(blk)
+            if not next_block:
+                return
+            block_number = next_block - 1
+
 # file is a sequence of blocks
 # record files are a sequence of record pages/blocks
 # record page contains sequence of slots
 # slot are one byte + record
+# record page starts with a header(used slot count and a bitmap of used slots), the slots follow it
 
 # RM is responsible for interpreting the values in a record blocks/page.
 # RM uses Layout(slot size) and Schema(record info) class to update record page
@@ -73,67 +308,356 @@ class RecordPage: # Also being called Record Manager
         self.tx: Transaction = tx
         self.blk: Block = blk
         self.layout: Layout = layout
+        self.slot_count, self.header_size = SlotHeader.geometry(tx.blockSize(), layout.slot_size)
         self.tx.pin(blk) # TODO: Are we pinning here to ensure tx.get/set does not fail?
 
+    # slot_index is passed along so a transaction with record locking only locks this row
+    # Every change to a row is a single physiological log record(insert, update or delete row) with the bytes it covers
     def setInt(self, slot_index, field_name, field_value):
-        blk_offset = (self.layout.slot_size * slot_index) + self.layout.offset[field_name]
-        self.tx.setInt(self.blk, blk_offset, field_value, True)
+        self.updateRow(slot_index, {field_name: field_value})
 
     def setString(self, slot_index, field_name, field_value):
-        blk_offset = slot_index * self.layout.slot_size + self.layout.offset[field_name]
-        self.tx.setString(self.blk, blk_offset, field_value, True)
+        self.updateRow(slot_index, {field_name: field_value})
+
+    # values; {field_name: value} of the fields to change, the update record covers only them
+    # The overflow chains of the text values it replaces are freed
+    def updateRow(self, slot_index, values):
+        replaced = self._overflows(slot_index, values.keys())
+        values = self.layout.toast(self.tx, self.blk.file_name, values)
+        self.tx.setRow(self.blk, self._fieldWrites(slot_index, values), LogRecord.UPDATEROW, slot_index)
+        for overflow in replaced:
+            overflow.free(self.tx, self.blk.file_name)
+
+    # Overflow of every text field in field_names stored out of the row
+    def _overflows(self, slot_index, field_names):
+        overflows = []
+        for field_name in self.layout.text_fields & set(field_names):
+            reference = self.tx.getInt(self.blk, self._slotOffset(slot_index) + self.layout.offset[field_name], slot_index)
+            if reference:
+                overflows.append(Overflow(reference - 1))
+        return overflows
+
+    # A text field is written as its overflow reference and the string in the row
+    # Strings must fit their field(see RowCodec.pack), a longer one would overwrite the next field
+    def _fieldWrites(self, slot_index, values):
+        slot_offset = self._slotOffset(slot_index)
+        writes = []
+        for field_name, field_value in values.items():
+            field_offset = slot_offset + self.layout.offset[field_name]
+            max_length = self.layout.schema.field_info[field_name]['field_byte_length']
+            if isinstance(field_value, str) and len(field_value.encode()) > max_length:
+                raise Exception('Value of ' + field_name + ' is longer than ' + str(max_length) + ' bytes.')
+            if field_name in self.layout.text_fields:
+                overflow = isinstance(field_value, Overflow)
+                writes.append((field_offset, field_value.block_number + 1 if overflow else 0))
+                writes.append((field_offset + 4, '' if overflow else field_value))
+            else:
+                writes.append((field_offset, field_value))
+        return writes
+
+    # Slots start right after the page header
+    def _slotOffset(self, slot_index):
+        return self.header_size + slot_index * self.layout.slot_size
 
     def getInt(self, slot_index, field_name):
-        blk_offset = (self.layout.slot_size * slot_index) + self.layout.offset[field_name]
-        return self.tx.getInt(self.blk, blk_offset)
+        blk_offset = self._slotOffset(slot_index) + self.layout.offset[field_name]
+        return self.tx.getInt(self.blk, blk_offset, slot_index)
 
     def getString(self, slot_index, field_name):
-        blk_offset = (slot_index * self.layout.slot_size) + self.layout.offset[field_name]
-        return self.tx.getString(self.blk, blk_offset)
+        blk_offset = self._slotOffset(slot_index) + self.layout.offset[field_name]
+        if field_name in self.layout.text_fields:
+            reference = self.tx.getInt(self.blk, blk_offset, slot_index)
+            if reference:
+                return Overflow(reference - 1).load(self.tx, self.blk.file_name)
+            blk_offset += 4
+        return self.tx.getString(self.blk, blk_offset, slot_index)
+
+    # The whole record in one read; text values are loaded from their overflow blocks
+    def getRow(self, slot_index):
+        row = self.layout.codec().unpack(self.tx.getBytes(self.blk, self._slotOffset(slot_index), self.layout.slot_size, slot_index))
+        for field_name in self.layout.text_fields:
+            if isinstance(row[field_name], Overflow):
+                row[field_name] = row[field_name].load(self.tx, self.blk.file_name)
+        return row
+
+    # Replaces the whole record with values({field_name: value}, missing fields are 0 or empty), encoded in one call
+    def setRow(self, slot_index, values):
+        replaced = self._overflows(slot_index, self.layout.text_fields)
+        values = self.layout.toast(self.tx, self.blk.file_name, values)
+        self.tx.setRow(self.blk, [(self._slotOffset(slot_index), self.layout.codec().pack(values))], LogRecord.UPDATEROW, slot_index)
+        for overflow in replaced:
+            overflow.free(self.tx, self.blk.file_name)
 
     # Mark the slot empty; we are not operating per field, so field parameter is not needed
+    # The delete row record clears the slot's bit in the header as well; the row's overflow chains are freed
     def delete(self, slot_index):
-        self.tx.setInt(self.blk, slot_index * self.layout.slot_size, 0, True)
+        replaced = self._overflows(slot_index, self.layout.text_fields)
+        self.tx.setRow(self.blk, [(self._slotOffset(slot_index), 0)], LogRecord.DELETEROW, slot_index)
+        for overflow in replaced:
+            overflow.free(self.tx, self.blk.file_name)
 
     # Zero our all records in the record page
+    # An empty slot is all zeros(flag 0, ints 0, strings of length 0), so the whole block is zeroed in one page operation
+    #   an empty header is all zeros too(no used slots)
     def format(self):
-        db_logger.info('Format')
-        slot_index = 0
-        while ((slot_index * self.layout.slot_size) + self.layout.slot_size) < self.tx.fm.block_size:
-            self.tx.setInt(self.blk, slot_index * self.layout.slot_size, 0, False)
-            for field_name in self.layout.schema.getFields():
-                if self.layout.schema.field_info[field_name]['field_type'] == 'int':
-                    self.tx.setInt(self.blk, slot_index * self.layout.slot_size + self.layout.offset[field_name], 0, False)
-                else:
-                    self.tx.setString(self.blk, slot_index * self.layout.slot_size + self.layout.offset[field_name], '', False) # TODO: If we are not putting anything then recovery doesn't know what to do
-            slot_index += 1
-        db_logger.info('Formatted')
+        self.tx.formatPage(self.blk)
+        if db_tracer.record:
+            db_tracer.emit('record', 'format', lambda: {'block': str(self.blk), 'slots': self.slot_count})
 
     def nextEmpty(self, current_slot_index):
         return self.insertAfter(current_slot_index)
 
+    # Take the block off the table's free space map if every slot is used
+    def markFull(self):
+        self.tx.markFull(self.blk, lambda page: SlotHeader.read(page, self.slot_count)[1] >= self.slot_count)
+
     # next empty slot index with empty flag set to 0
-    def insertAfter(self, slot_index):
-        slot_index += 1
-        while ((slot_index * self.layout.slot_size) + self.layout.slot_size) <= self.tx.fm.block_size:
-            if not self.tx.getInt(self.blk, slot_index * self.layout.slot_size):
-                self.tx.setInt(self.blk, slot_index * self.layout.slot_size, 1, True) # Mark slot filled before returning it
-                return slot_index
-            slot_index += 1
+    # Empty slots are the clear bits of the header bitmap; a full block is recognized by its used count alone
+    # A slot that looks empty is claimed with a row lock that does not wait; slots other transactions hold are skipped
+    #   without record locking this locks the whole block, like before
+    # The flag and values({field_name: value}) are written together as one insert row record
+    #   values are encoded as a whole slot(see RowCodec), the fields not in values are 0 or empty
+    def insertAfter(self, slot_index, values=None):
+        bits, used = self.tx.peekSlots(self.blk, self.slot_count)
+        if used >= self.slot_count:
+            return -1
+        values = self.layout.toast(self.tx, self.blk.file_name, values)
+        empty = ~bits & ((1 << self.slot_count) - 1)
+        slot_index = SlotHeader.nextSet(empty, slot_index)
+        while slot_index >= 0:
+            if self.tx.tryXLockRecord(self.blk, slot_index):
+                if not self.tx.getInt(self.blk, self._slotOffset(slot_index), slot_index): # still empty now that we hold the lock
+                    row = self.layout.codec().pack(values) if values else 1 # Mark slot filled before returning it
+                    self.tx.setRow(self.blk, [(self._slotOffset(slot_index), row)], LogRecord.INSERTROW, slot_index)
+                    return slot_index
+            slot_index = SlotHeader.nextSet(empty, slot_index)
         return -1
 
     def nextUsed(self, current_slot_index):
         return self.nextAfter(current_slot_index)
 
     # next used slot index with empty flag set to 1
+    # Only the slots the header bitmap points at are read(see Transaction.scanSlots)
     def nextAfter(self, slot_index):
-        slot_index += 1
-        while ((slot_index * self.layout.slot_size) + self.layout.slot_size) <= self.tx.fm.block_size:
-            if self.tx.getInt(self.blk, slot_index * self.layout.slot_size):
+        bits = self.tx.scanSlots(self.blk, self.slot_count)
+        slot_index = SlotHeader.nextSet(bits, slot_index)
+        while slot_index >= 0:
+            if self.tx.getInt(self.blk, self._slotOffset(slot_index), slot_index):
                 return slot_index
-            slot_index += 1
+            slot_index = SlotHeader.nextSet(bits, slot_index)
+        return -1
+
+# Slotted page; variable-length records(see SlottedLayout) with a slot directory, implementing 6.2.2
+#   header; directory entries(4 bytes) and where the record data begins(4 bytes, 0 on a fresh page meaning the block end)
+#   slot directory right after the header, one (offset, length) entry per slot; offset 0 marks an empty slot
+#   records are packed at the end of the block and grow towards the directory
+# A record keeps its slot when it moves, so its RecordID never changes
+# Delete compacts the page; the records in front of the deleted one move up, free space is always a single gap
+# An update that changes the record's size moves it to the front of the data; it must still fit in its block
+#   one that shrinks the record puts the block back on the free space map
+#   inserts leave part of every block(see SlottedLayout.fill_factor) to updates
+# Every change is computed on a copy of the page and written as the pieces that differ(Transaction.setRaw)
+#   records move, so the block is always locked as a whole, also by transactions with record locking
+class SlottedPage:
+    """Writes variable-length records to a table block through a slot directory"""
+    HEADER_SIZE = 8
+    ENTRY_SIZE = 8
+
+    def __init__(self, tx, blk, layout):
+        self.tx: Transaction = tx
+        self.blk: Block = blk
+        self.layout: SlottedLayout = layout
+        self._directory = None # [(offset, length)] as last read; the block lock keeps it valid, our own writes reset it
+        self._record = (None, None) # (slot, values) of the last record read, kept like the directory
+        self.tx.pin(blk)
+
+    def _entries(self):
+        if self._directory is None:
+            header = self.tx.getBytes(self.blk, 0, SlottedPage.HEADER_SIZE)
+            count = int.from_bytes(header[0:4], 'big')
+            data = self.tx.getBytes(self.blk, SlottedPage.HEADER_SIZE, count * SlottedPage.ENTRY_SIZE)
+            self._directory = [(int.from_bytes(data[pos:pos + 4], 'big'), int.from_bytes(data[pos + 4:pos + 8], 'big'))
+                               for pos in range(0, len(data), SlottedPage.ENTRY_SIZE)]
+        return self._directory
+
+    def getRecord(self, slot_index):
+        if self._record[0] != slot_index:
+            offset, length = self._entries()[slot_index]
+            self._record = (slot_index, self.layout.decode(self.tx.getBytes(self.blk, offset, length)))
+        return self._record[1]
+
+    def getInt(self, slot_index, field_name):
+        return self.getRecord(slot_index)[field_name]
+
+    def getString(self, slot_index, field_name):
+        value = self.getRecord(slot_index)[field_name]
+        return value.load(self.tx, self.blk.file_name) if isinstance(value, Overflow) else value
+
+    def setInt(self, slot_index, field_name, field_value):
+        self.updateRow(slot_index, {field_name: field_value})
+
+    def setString(self, slot_index, field_name, field_value):
+        self.updateRow(slot_index, {field_name: field_value})
+
+    def getRow(self, slot_index):
+        row = dict(self.getRecord(slot_index))
+        for field_name, value in row.items():
+            if isinstance(value, Overflow):
+                row[field_name] = value.load(self.tx, self.blk.file_name)
+        return row
+
+    def setRow(self, slot_index, values):
+        self.updateRow(slot_index, {field_name: values.get(field_name, 0 if is_int else '') for field_name, is_int, _ in self.layout.fields})
+
+    # Text values of the fields that are not changed keep their overflow chains, the chains of the replaced ones are freed
+    def updateRow(self, slot_index, values):
+        values = self.layout.toast(self.tx, self.blk.file_name, values)
+        page = self._lockedPage()
+        offset, length = SlottedPage._entry(page, slot_index)
+        record = self.layout.decode(page[offset:offset + length])
+        replaced = [record[field_name] for field_name in values if isinstance(record.get(field_name), Overflow)]
+        record.update(values)
+        new_record = self.layout.encode(record)
+        if len(new_record) == length:
+            page[offset:offset + length] = new_record
+        else:
+            SlottedPage._remove(page, slot_index)
+            if not SlottedPage._place(page, slot_index, new_record):
+                raise Exception('Record ' + str(RecordID(self.blk.block_number, slot_index)) + ' no longer fits in its block.')
+        self._write(page, LogRecord.UPDATEROW)
+        if len(new_record) < length:
+            self.tx.markFree(self.blk)
+        for overflow in replaced:
+            overflow.free(self.tx, self.blk.file_name)
+
+    def delete(self, slot_index):
+        page = self._lockedPage()
+        offset, length = SlottedPage._entry(page, slot_index)
+        replaced = [value for value in self.layout.decode(page[offset:offset + length]).values() if isinstance(value, Overflow)]
+        SlottedPage._remove(page, slot_index)
+        count = SlottedPage._count(page)
+        while count and not SlottedPage._entry(page, count - 1)[0]: # trailing empty entries are dropped
+            count -= 1
+        page[0:4] = count.to_bytes(4, 'big')
+        self._write(page, LogRecord.DELETEROW)
+        for overflow in replaced:
+            overflow.free(self.tx, self.blk.file_name)
+
+    # A formatted page is all zeros; no entries, data begins at the block end
+    def format(self):
+        self.tx.formatPage(self.blk)
+        self._directory = None
+        self._record = (None, None)
+        if db_tracer.record:
+            db_tracer.emit('record', 'format', lambda: {'block': str(self.blk), 'slots': 0})
+
+    # Reuses the first empty entry after slot_index or adds one; -1 if the record does not fit
+    # The free space is looked at without locking first(like RecordPage's look at the slot bitmap), a full block is never locked
+    # A record that would not fit even in an empty block is refused; no block would ever take it
+    def insertAfter(self, slot_index, values=None):
+        record = self.layout.encode(self.layout.toast(self.tx, self.blk.file_name, values) or {})
+        reserve = int(self.tx.blockSize() * (1 - self.layout.fill_factor))
+        if len(record) + reserve > self.tx.blockSize() - SlottedPage.HEADER_SIZE - SlottedPage.ENTRY_SIZE:
+            raise Exception('Record of ' + str(len(record)) + ' bytes does not fit in a block.')
+        if self.tx.peekPage(self.blk, SlottedPage._freeSpace) < len(record) + reserve:
+            return -1
+        page = self._lockedPage()
+        count = SlottedPage._count(page)
+        slot_index = next((i for i in range(slot_index + 1, count) if not SlottedPage._entry(page, i)[0]), max(count, slot_index + 1))
+        if slot_index > count or SlottedPage._freeSpace(page) < len(record) + reserve or not SlottedPage._place(page, slot_index, record):
+            return -1
+        self._write(page, LogRecord.INSERTROW)
+        return slot_index
+
+    def nextAfter(self, slot_index):
+        entries = self._entries()
+        for i in range(slot_index + 1, len(entries)):
+            if entries[i][0]:
+                return i
         return -1
 
+    def markFull(self):
+        reserve = int(self.tx.blockSize() * (1 - self.layout.fill_factor))
+        self.tx.markFull(self.blk, lambda page: SlottedPage._freeSpace(page.bb) < self.layout.min_size + SlottedPage.ENTRY_SIZE + reserve)
+
+    # Copy of the page to change; the block is X locked before it is read
+    def _lockedPage(self):
+        self.tx.xLockBlock(self.blk)
+        self._before = self.tx.getBytes(self.blk, 0, self.tx.blockSize())
+        return bytearray(self._before)
+
+    # Writes the parts of page that changed since _lockedPage
+    # Changed chunks next to each other make one piece, trimmed to the bytes that differ
+    def _write(self, page, op, chunk=32):
+        old, runs = self._before, []
+        for start in range(0, len(page), chunk):
+            if page[start:start + chunk] != old[start:start + chunk]:
+                if runs and runs[-1][1] == start:
+                    runs[-1][1] = start + chunk
+                else:
+                    runs.append([start, start + chunk])
+        pieces = []
+        for start, end in runs:
+            end = min(end, len(page))
+            while page[start] == old[start]:
+                start += 1
+            while page[end - 1] == old[end - 1]:
+                end -= 1
+            pieces.append((start, bytes(page[start:end])))
+        self.tx.setRaw(self.blk, pieces, op)
+        self._directory = None
+        self._record = (None, None)
+
+    # Page(bytearray) helpers
+    @staticmethod
+    def _count(page):
+        return int.from_bytes(page[0:4], 'big')
+
+    @staticmethod
+    def _dataStart(page):
+        return int.from_bytes(page[4:8], 'big') or len(page)
+
+    @staticmethod
+    def _entry(page, slot_index):
+        pos = SlottedPage.HEADER_SIZE + slot_index * SlottedPage.ENTRY_SIZE
+        return int.from_bytes(page[pos:pos + 4], 'big'), int.from_bytes(page[pos + 4:pos + 8], 'big')
+
+    @staticmethod
+    def _setEntry(page, slot_index, offset, length):
+        pos = SlottedPage.HEADER_SIZE + slot_index * SlottedPage.ENTRY_SIZE
+        page[pos:pos + 8] = offset.to_bytes(4, 'big') + length.to_bytes(4, 'big')
+
+    # Bytes between the directory and the data
+    @staticmethod
+    def _freeSpace(page):
+        return SlottedPage._dataStart(page) - SlottedPage.HEADER_SIZE - SlottedPage._count(page) * SlottedPage.ENTRY_SIZE
+
+    # Puts record in front of the data under slot_index(an empty entry, or the one after the last); False if it does not fit
+    @staticmethod
+    def _place(page, slot_index, record):
+        count = max(SlottedPage._count(page), slot_index + 1)
+        offset = SlottedPage._dataStart(page) - len(record)
+        if offset < SlottedPage.HEADER_SIZE + count * SlottedPage.ENTRY_SIZE:
+            return False
+        page[offset:offset + len(record)] = record
+        page[0:8] = count.to_bytes(4, 'big') + offset.to_bytes(4, 'big')
+        SlottedPage._setEntry(page, slot_index, offset, len(record))
+        return True
+
+    # Empties the entry of slot_index and closes the gap its record leaves
+    @staticmethod
+    def _remove(page, slot_index):
+        offset, length = SlottedPage._entry(page, slot_index)
+        data_start = SlottedPage._dataStart(page)
+        page[data_start + length:offset + length] = page[data_start:offset]
+        for i in range(SlottedPage._count(page)):
+            entry_offset, entry_length = SlottedPage._entry(page, i)
+            if entry_offset and entry_offset < offset:
+                SlottedPage._setEntry(page, i, entry_offset + length, entry_length)
+        SlottedPage._setEntry(page, slot_index, 0, 0)
+        page[4:8] = (data_start + length).to_bytes(4, 'big')
+
+
 # Each record in file can be identified by block number and slot number
 # These two values put together is called Record Identifier
 class RecordID:
@@ -170,7 +694,7 @@ class TableScan:
         self.layout = layout
 
         self.current_slot_index = -1 # TODO: Book is initializing this value to zero.
-        self.rp: RecordPage = None
+        self.rp: RecordPage = None # or a SlottedPage, as the layout says
         if self.tx.size(self.file_name):
             self.moveToBlock(0)
         else:
@@ -181,7 +705,7 @@ class TableScan:
         if self.rp:
             self.tx.unpin(self.rp.blk)
         new_blk = self.tx.append(self.file_name)
-        self.rp = RecordPage(self.tx, new_blk, self.layout) # tx.pin(rp.blk) happening in RecordPage constructor
+        self.rp = self.layout.recordPage(self.tx, new_blk) # tx.pin(rp.blk) happening in RecordPage constructor
         self.rp.format()
         self.current_slot_index = -1
 
@@ -189,7 +713,7 @@ class TableScan:
         if self.rp:
             self.tx.unpin(self.rp.blk)
         new_blk = Block(self.file_name, block_num)
-        self.rp = RecordPage(self.tx, new_blk, self.layout)
+        self.rp = self.layout.recordPage(self.tx, new_blk)
         self.current_slot_index = -1
 
     # current_slot movement
@@ -206,17 +730,22 @@ class TableScan:
         self.insert()
 
     # have current_slot_index point to next available empty slot
-    def insert(self):
-        self.current_slot_index = self.rp.insertAfter(self.current_slot_index)
+    # values({field_name: value}) are written along with the slot flag, a single log record for the whole row
+    # Blocks without room are skipped; the free space map of the table points to the next block that may have some
+    # Text values too long for their field are moved to overflow blocks once, before any block is tried
+    def insert(self, values=None):
+        values = self.layout.toast(self.tx, self.file_name, values)
+        self.current_slot_index = self.rp.insertAfter(self.current_slot_index, values)
         while self.current_slot_index < 0:
             # we reached at the end of current block
-            if self.rp.blk.block_number == self.tx.size(self.file_name) - 1:
-                # this was the final block in the file, therefore append a new block to our table file
+            self.rp.markFull()
+            block_number = self.tx.nextFreeBlock(self.file_name, self.rp.blk.block_number)
+            if block_number < 0:
+                # no block after this one has room, therefore append a new block to our table file
                 self.moveToNewBlock()
             else:
-                # there are more blocks to this file, therefore move to the next block
-                self.moveToBlock(self.rp.blk.block_number + 1)
-            self.current_slot_index = self.rp.insertAfter(self.current_slot_index)
+                self.moveToBlock(block_number)
+            self.current_slot_index = self.rp.insertAfter(self.current_slot_index, values)
 
     def deleteRecord(self):
         self.rp.delete(self.current_slot_index)
@@ -251,6 +780,18 @@ class TableScan:
     def setString(self, field_name, field_value):
         self.rp.setString(self.current_slot_index, field_name, field_value)
 
+    # Several fields of the current record in one update record
+    def updateRow(self, values):
+        self.rp.updateRow(self.current_slot_index, values)
+
+    # The current record as {field_name: value}, decoded in one call
+    def getRow(self):
+        return self.rp.getRow(self.current_slot_index)
+
+    # Replaces the current record; fields not in values become 0 or empty
+    def setRow(self, values):
+        self.rp.setRow(self.current_slot_index, values)
+
     def currentRecordID(self):
         return RecordID(self.rp.blk.block_number, self.current_slot_index)
 
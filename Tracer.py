@@ -0,0 +1,62 @@
+import collections
+import random
+import threading
+import time
+
+# Structured tracing for hot paths (pinning, logging, record writes...)
+# Unlike db_logger.info('...' + str(x)), nothing is formatted unless the subsystem is traced
+# Call sites check the subsystem flag first, so a disabled subsystem costs a single attribute lookup
+#   if db_tracer.buffer:
+#       db_tracer.emit('buffer', 'pin', lambda: {'block': str(target_block)})
+# The payload is a callable; it is only evaluated for events that survive sampling
+# Events land in a fixed size ring buffer(oldest events are dropped), read it with dump()
+#
+# Tracing a running db for a short window
+#   db_tracer.enable('buffer', 'tx', sample_rate=0.1, duration=5)
+#   ...
+#   for e in db_tracer.dump(): print(e)
+class Tracer:
+    SUBSYSTEMS = ('file', 'log', 'buffer', 'tx', 'lock', 'record')
+
+    def __init__(self, capacity=10000):
+        for subsystem in Tracer.SUBSYSTEMS:
+            setattr(self, subsystem, False)
+        self.sample_rate = dict.fromkeys(Tracer.SUBSYSTEMS, 1.0)
+        self.events = collections.deque(maxlen=capacity)  # deque.append is thread safe
+        self._timer = None
+
+    # Turn tracing on for the given subsystems(all of them when none is given)
+    # sample_rate keeps roughly that fraction of events; duration(seconds) turns tracing back off automatically
+    def enable(self, *subsystems, sample_rate=1.0, duration=None):
+        for subsystem in (subsystems or Tracer.SUBSYSTEMS):
+            self.sample_rate[subsystem] = sample_rate
+            setattr(self, subsystem, True)
+        if duration:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(duration, self.disable, subsystems)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def disable(self, *subsystems):
+        for subsystem in (subsystems or Tracer.SUBSYSTEMS):
+            setattr(self, subsystem, False)
+
+    def emit(self, subsystem, event, payload=None):
+        if self.sample_rate[subsystem] < 1.0 and random.random() >= self.sample_rate[subsystem]:
+            return
+        self.events.append((time.time(), threading.current_thread().name, subsystem, event, payload() if payload else None))
+
+    # Returns captured events as a list of (timestamp, thread name, subsystem, event, payload)
+    def dump(self, clear=False):
+        captured = list(self.events)
+        if clear:
+            self.events.clear()
+        return captured
+
+    # Change ring buffer size; keeps the newest events
+    def resize(self, capacity):
+        self.events = collections.deque(self.events, maxlen=capacity)
+
+
+db_tracer = Tracer()
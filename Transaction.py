@@ -1,5 +1,10 @@
 from BufferPool import *
 import time
+import heapq
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import random
+import os
 import logging
 db_logger = logging.getLogger('SimpleDB')
 
@@ -19,66 +24,168 @@ class LogRecord:
     ROLLBACK = 3
     SETINT = 4
     SETSTRING = 5
+    NQCHECKPOINT = 6
+    SHUTDOWN = 7
+    INSERTROW = 8
+    UPDATEROW = 9
+    DELETEROW = 10
+    FORMATPAGE = 11
+    NQCHECKPOINTPART = 12
+    ROW_OPS = (INSERTROW, UPDATEROW, DELETEROW)
+    INVERSE = {INSERTROW: DELETEROW, UPDATEROW: UPDATEROW, DELETEROW: INSERTROW} # row op that undoes a row op
+    NO_SLOT = 0xFFFFFFFF # slot of a row record that changes no slot header(slotted pages)
+    UPDATES = (SETINT, SETSTRING, FORMATPAGE) + ROW_OPS # records that change a block and can be undone/redone
 
     # write log(byte array) from log parameters; return lsn
-    #   writeToLog(lm=lm, op=LogRecord.SETINT, txnum=10, blk_file='log.file', blk_num=10, blk_offset=80, value=100)
+    #   writeToLog(lm=lm, op=LogRecord.SETINT, txnum=10, prev_lsn=120, blk_file='log.file', blk_num=10, blk_offset=80, old_val=100, new_val=200)
     #   will generate appropriate log byte array and call lm.appendLog
+    # Update records carry both the old value(undo) and the new value(redo)
+    # Every transaction record carries prev_lsn, the lsn of the previous record of the same transaction(0 for <START>)
+    #   so a transaction's records form a backward chain through the shared log
+    # Row records(physiological) are written by RecordPage, one per inserted, updated or deleted row
+    #   they address a block and carry the before and after image of the bytes the row change covers
+    #   and the slot of the row; an insert sets its bit in the page header(see SlotHeader), a delete clears it
+    # <FORMATPAGE> zeroes a whole block that was just appended; its images are implicit(empty before, zeros after)
     # Equivalent to static method writeToLog of SetStringRecord class
     @staticmethod
     def writeToLog(**log_param):
-        if log_param['op'] == LogRecord.CHECKPOINT:
+        if log_param['op'] == LogRecord.CHECKPOINT or log_param['op'] == LogRecord.SHUTDOWN:
             op_offset = 0
 
             temp_page = Page(op_offset + 4)
             temp_page.setData(op_offset, log_param['op'])
-            db_logger.info('Logging ' + LogRecord.toString(temp_page.bb))
-            return log_param['lm'].appendLog(temp_page.bb)
+            return LogRecord._append(log_param['lm'], temp_page.bb)
+        elif log_param['op'] == LogRecord.NQCHECKPOINT:
+            # <NQCHECKPOINT, begin_lsn, part_lsn, {txnum: last_lsn}, {block: rec_lsn}>
+            # Both tables grow with the load, a record must fit in one log block
+            #   entries that do not fit go first into <NQCHECKPOINTPART> records, each pointing to the previous part(part_lsn)
+            #   the <NQCHECKPOINT> is written last and points to the last part; a checkpoint cut short by a crash has none
+            lm = log_param['lm']
+            limit = lm.file_mgr.block_size - 8 - 20 # op, begin_lsn, part_lsn and the two counts
+            txs, pages = list(log_param['active_txs'].items()), list(log_param['dirty_pages'].items())
+            part_lsn = 0
+            while True:
+                size, tx_count, page_count = 0, 0, 0
+                while tx_count < len(txs) and size + 8 <= limit:
+                    size, tx_count = size + 8, tx_count + 1
+                while tx_count == len(txs) and page_count < len(pages) and size + 12 + len(pages[page_count][0].file_name.encode()) <= limit:
+                    size, page_count = size + 12 + len(pages[page_count][0].file_name.encode()), page_count + 1
+                last = tx_count == len(txs) and page_count == len(pages)
+                temp_page = Page(20 + size)
+                pos = temp_page.setData(0, LogRecord.NQCHECKPOINT if last else LogRecord.NQCHECKPOINTPART)
+                pos += temp_page.setData(pos, log_param['begin_lsn'] if last else 0)
+                pos += temp_page.setData(pos, part_lsn)
+                pos += temp_page.setData(pos, tx_count)
+                for txnum, last_lsn in txs[:tx_count]:
+                    pos += temp_page.setData(pos, txnum)
+                    pos += temp_page.setData(pos, last_lsn)
+                pos += temp_page.setData(pos, page_count)
+                for blk, rec_lsn in pages[:page_count]:
+                    pos += temp_page.setData(pos, blk.file_name)
+                    pos += temp_page.setData(pos, blk.block_number)
+                    pos += temp_page.setData(pos, rec_lsn)
+                part_lsn = LogRecord._append(lm, temp_page.bb)
+                if last:
+                    return part_lsn
+                txs, pages = txs[tx_count:], pages[page_count:]
         elif log_param['op'] == LogRecord.START or log_param['op'] == LogRecord.COMMIT or log_param['op'] == LogRecord.ROLLBACK:
             op_offset = 0
             txnum_offset = op_offset + 4
+            prev_lsn_offset = txnum_offset + 4
 
-            temp_page = Page(txnum_offset + 4)
+            temp_page = Page(prev_lsn_offset + 4)
             temp_page.setData(op_offset, log_param['op'])
             temp_page.setData(txnum_offset, log_param['txnum'])
-            db_logger.info('Logging ' + LogRecord.toString(temp_page.bb))
-            return log_param['lm'].appendLog(temp_page.bb)
+            temp_page.setData(prev_lsn_offset, log_param.get('prev_lsn', 0))
+            return LogRecord._append(log_param['lm'], temp_page.bb)
         elif log_param['op'] == LogRecord.SETSTRING:
             op_offset = 0
             txnum_offset = op_offset + 4
-            blk_file_offset = txnum_offset + 4
+            prev_lsn_offset = txnum_offset + 4
+            blk_file_offset = prev_lsn_offset + 4
             blk_num_offset = blk_file_offset + len(log_param['blk_file']) + 4
             blk_offset_offset = blk_num_offset + 4
             old_value_offset = blk_offset_offset + 4
+            new_value_offset = old_value_offset + len(log_param['old_val'].encode()) + 4
 
-            temp_page = Page(old_value_offset + len(log_param['old_val']) + 4)
+            temp_page = Page(new_value_offset + len(log_param['new_val'].encode()) + 4)
             temp_page.setData(op_offset, log_param['op'])
             temp_page.setData(txnum_offset, log_param['txnum'])
+            temp_page.setData(prev_lsn_offset, log_param.get('prev_lsn', 0))
             temp_page.setData(blk_file_offset, log_param['blk_file'])
             temp_page.setData(blk_num_offset, log_param['blk_num'])
             temp_page.setData(blk_offset_offset, log_param['blk_offset'])
             temp_page.setData(old_value_offset, log_param['old_val'])
-            db_logger.info('Logging ' + LogRecord.toString(temp_page.bb))
-            return log_param['lm'].appendLog(temp_page.bb)
+            temp_page.setData(new_value_offset, log_param['new_val'])
+            return LogRecord._append(log_param['lm'], temp_page.bb)
+        elif log_param['op'] == LogRecord.FORMATPAGE:
+            op_offset = 0
+            txnum_offset = op_offset + 4
+            prev_lsn_offset = txnum_offset + 4
+            blk_file_offset = prev_lsn_offset + 4
+            blk_num_offset = blk_file_offset + len(log_param['blk_file']) + 4
+
+            temp_page = Page(blk_num_offset + 4)
+            temp_page.setData(op_offset, log_param['op'])
+            temp_page.setData(txnum_offset, log_param['txnum'])
+            temp_page.setData(prev_lsn_offset, log_param.get('prev_lsn', 0))
+            temp_page.setData(blk_file_offset, log_param['blk_file'])
+            temp_page.setData(blk_num_offset, log_param['blk_num'])
+            return LogRecord._append(log_param['lm'], temp_page.bb)
+        elif log_param['op'] in LogRecord.ROW_OPS:
+            op_offset = 0
+            txnum_offset = op_offset + 4
+            prev_lsn_offset = txnum_offset + 4
+            blk_file_offset = prev_lsn_offset + 4
+            blk_num_offset = blk_file_offset + len(log_param['blk_file']) + 4
+            blk_offset_offset = blk_num_offset + 4
+            slot_offset = blk_offset_offset + 4
+            old_value_offset = slot_offset + 4
+            new_value_offset = old_value_offset + len(log_param['old_val']) + 4
+
+            temp_page = Page(new_value_offset + len(log_param['new_val']) + 4)
+            temp_page.setData(op_offset, log_param['op'])
+            temp_page.setData(txnum_offset, log_param['txnum'])
+            temp_page.setData(prev_lsn_offset, log_param.get('prev_lsn', 0))
+            temp_page.setData(blk_file_offset, log_param['blk_file'])
+            temp_page.setData(blk_num_offset, log_param['blk_num'])
+            temp_page.setData(blk_offset_offset, log_param['blk_offset'])
+            temp_page.setData(slot_offset, LogRecord.NO_SLOT if log_param['slot'] is None else log_param['slot'])
+            temp_page.setData(old_value_offset, log_param['old_val'])
+            temp_page.setData(new_value_offset, log_param['new_val'])
+            return LogRecord._append(log_param['lm'], temp_page.bb)
         elif log_param['op'] == LogRecord.SETINT:
             op_offset = 0
             txnum_offset = op_offset + 4
-            blk_file_offset = txnum_offset + 4
+            prev_lsn_offset = txnum_offset + 4
+            blk_file_offset = prev_lsn_offset + 4
             blk_num_offset = blk_file_offset + len(log_param['blk_file']) + 4
             blk_offset_offset = blk_num_offset + 4
             old_value_offset = blk_offset_offset + 4
+            new_value_offset = old_value_offset + 4
 
-            temp_page = Page(old_value_offset + 4)
+            temp_page = Page(new_value_offset + 4)
             temp_page.setData(op_offset, log_param['op'])
             temp_page.setData(txnum_offset, log_param['txnum'])
+            temp_page.setData(prev_lsn_offset, log_param.get('prev_lsn', 0))
             temp_page.setData(blk_file_offset, log_param['blk_file'])
             temp_page.setData(blk_num_offset, log_param['blk_num'])
             temp_page.setData(blk_offset_offset, log_param['blk_offset'])
             temp_page.setData(old_value_offset, log_param['old_val'])
-            db_logger.info('Logging ' + LogRecord.toString(temp_page.bb))
-            return log_param['lm'].appendLog(temp_page.bb)
+            temp_page.setData(new_value_offset, log_param['new_val'])
+            return LogRecord._append(log_param['lm'], temp_page.bb)
+
+    # The log record is only decoded back to text when log tracing is on
+    @staticmethod
+    def _append(lm, log_bytearray):
+        lsn = lm.appendLog(log_bytearray)
+        if db_tracer.log:
+            db_tracer.emit('log', 'append', lambda: {'lsn': lsn, 'record': LogRecord.toString(log_bytearray)})
+        return lsn
 
     # extract log parameters from log byte array
     # Used when iterating over binary log file, such as rollback and recovery
+    # prev_lsn is the last element of every transaction record; row records carry the slot right before it
     # Equivalent: static method of LogRecord interface that returns instances such as SetStringRecord
     @staticmethod
     def createLogRecord(log_bytearray):
@@ -86,69 +193,253 @@ class LogRecord:
         op = temp_page.getInt(0)
         if op == LogRecord.START or op == LogRecord.COMMIT or op == LogRecord.ROLLBACK:
             txnum = temp_page.getInt(4)
-            return op, txnum
-        elif op == LogRecord.CHECKPOINT:
+            return op, txnum, temp_page.getInt(8)
+        elif op == LogRecord.CHECKPOINT or op == LogRecord.SHUTDOWN:
             return op, -1 # checkpoint returns a dummy txnum, which is -1
-        elif op == LogRecord.SETINT or op == LogRecord.SETSTRING:
+        elif op == LogRecord.NQCHECKPOINT or op == LogRecord.NQCHECKPOINTPART:
+            begin_lsn = temp_page.getInt(4)
+            part_lsn = temp_page.getInt(8)
+            pos = 12
+            active_txs = {}
+            for _ in range(temp_page.getInt(pos)):
+                active_txs[temp_page.getInt(pos + 4)] = temp_page.getInt(pos + 8)
+                pos += 8
+            pos += 4
+            dirty_pages = {}
+            for _ in range(temp_page.getInt(pos)):
+                blk_file = temp_page.getStr(pos + 4)
+                pos += 4 + len(blk_file)
+                dirty_pages[Block(blk_file, temp_page.getInt(pos + 4))] = temp_page.getInt(pos + 8)
+                pos += 8
+            return op, -1, begin_lsn, active_txs, dirty_pages, part_lsn
+        elif op == LogRecord.FORMATPAGE:
+            blk_file = temp_page.getStr(12)
+            return op, temp_page.getInt(4), blk_file, temp_page.getInt(12 + len(blk_file) + 4), 0, b'', b'', temp_page.getInt(8)
+        elif op in LogRecord.UPDATES:
             txnum = temp_page.getInt(4)
-            blk_file = temp_page.getStr(8)
-            blk_num = temp_page.getInt(8 + (len(blk_file) + 4))
-            blk_offset = temp_page.getInt(8 + (len(blk_file) + 4) + 4)
-            if op == LogRecord.SETINT:
-                old_val = temp_page.getInt(8 + (len(blk_file) + 4) + 4 + 4)
+            prev_lsn = temp_page.getInt(8)
+            blk_file = temp_page.getStr(12)
+            blk_num = temp_page.getInt(12 + (len(blk_file) + 4))
+            blk_offset = temp_page.getInt(12 + (len(blk_file) + 4) + 4)
+            old_value_offset = 12 + (len(blk_file) + 4) + 4 + 4
+            if op in LogRecord.ROW_OPS:
+                slot = temp_page.getInt(old_value_offset)
+                slot = None if slot == LogRecord.NO_SLOT else slot
+                old_val = bytes(temp_page.getByte(old_value_offset + 4))
+                new_val = bytes(temp_page.getByte(old_value_offset + 4 + 4 + len(old_val)))
+                return op, txnum, blk_file, blk_num, blk_offset, old_val, new_val, slot, prev_lsn
+            elif op == LogRecord.SETINT:
+                old_val = temp_page.getInt(old_value_offset)
+                new_val = temp_page.getInt(old_value_offset + 4)
             else:
-                old_val = temp_page.getStr(8 + (len(blk_file) + 4) + 4 + 4)
-            return op, txnum, blk_file, blk_num, blk_offset, old_val
+                old_val = temp_page.getStr(old_value_offset)
+                new_val = temp_page.getStr(old_value_offset + 4 + len(old_val.encode()))
+            return op, txnum, blk_file, blk_num, blk_offset, old_val, new_val, prev_lsn
         else:
             pass # TODO: Read log byte array to append block
 
+    # Write the old value back
+    # The write is logged like any other update(a compensation record), so redo repeats the undo as well
+    #   otherwise redo would bring back the changes of a rolled back transaction after a crash
+    # A row record is compensated by its inverse(insert by delete and vice versa), which puts the slot's bit back as well
     @staticmethod
     def undo(tx, *log_data):
-        # TODO: We do not need to call LogRecord.createLogRecord; instead we can pass the log parameters using splat operator
-        op, txnum, blk_file, blk_num, blk_offset, old_val = log_data
+        op, txnum, blk_file, blk_num, blk_offset, old_val, new_val = log_data[:7]
 
         # setInt will look for buffer in the pinned buffer list; this is in turns using BM to pin buffer
         temp_blk = Block(blk_file, blk_num)
         tx.pin(temp_blk)
         if op == LogRecord.SETINT:
-            tx.setInt(temp_blk, blk_offset, old_val, False)
+            tx.setInt(temp_blk, blk_offset, old_val, True)
         elif op == LogRecord.SETSTRING:
-            tx.setString(temp_blk, blk_offset, old_val, False)
+            tx.setString(temp_blk, blk_offset, old_val, True)
+        elif op in LogRecord.ROW_OPS:
+            tx.setBytes(temp_blk, blk_offset, old_val, True, log_data[7], LogRecord.INVERSE[op])
+        elif op == LogRecord.FORMATPAGE:
+            pass # the block was appended empty; the rows inserted into it are undone by their own records
         else:
             pass # TODO: byte type and block append?
         tx.unpin(temp_blk)
 
+    # Page header change a row op makes to the slot of a row record; (slot, used) or None
+    @staticmethod
+    def slotMark(op, log_data):
+        if op in (LogRecord.INSERTROW, LogRecord.DELETEROW) and log_data[7] is not None:
+            return log_data[7], op == LogRecord.INSERTROW
+        return None
+
+    # Does applying op leave room in the block; a formatted page is empty, a delete(slotted pages log theirs without a slot) frees a row
+    @staticmethod
+    def freesSpace(op):
+        return op in (LogRecord.FORMATPAGE, LogRecord.DELETEROW)
+
     # from log byte array get log parameters
     # then return human form
     @staticmethod
     def toString(log_bytearray):
-        temp_page = Page(log_bytearray)
-        op = temp_page.getInt(0)
+        log_data = LogRecord.createLogRecord(log_bytearray)
+        op = log_data[0]
         if op == LogRecord.CHECKPOINT:
             return '<CHECKPOINT>'
+        elif op == LogRecord.SHUTDOWN:
+            return '<SHUTDOWN>'
+        elif op == LogRecord.NQCHECKPOINT:
+            return '<NQCHECKPOINT, ' + str(log_data[2]) + ', ' + str(log_data[3]) + ', ' + str(log_data[4]) + '>'
+        elif op == LogRecord.NQCHECKPOINTPART:
+            return '<NQCHECKPOINTPART, ' + str(log_data[3]) + ', ' + str(log_data[4]) + '>'
         elif op == LogRecord.START:
-            txnum = temp_page.getInt(4)
-            return '<START, ' + str(txnum) + '>'
+            return '<START, ' + str(log_data[1]) + '>'
         elif op == LogRecord.COMMIT:
-            txnum = temp_page.getInt(4)
-            return '<COMMIT, ' + str(txnum) + '>'
+            return '<COMMIT, ' + str(log_data[1]) + '>'
         elif op == LogRecord.ROLLBACK:
-            txnum = temp_page.getInt(4)
-            return '<ROLLBACK, ' + str(txnum) + '>'
-        elif op == LogRecord.SETINT:
-            txnum = temp_page.getInt(4)
-            blk_file = temp_page.getStr(4 + 4)
-            blk_num = temp_page.getInt(4 + 4 + (4 + len(blk_file)))
-            blk_offset = temp_page.getInt(4 + 4 + (4 + len(blk_file)) + 4)
-            old_val = temp_page.getInt(4 + 4 + (4 + len(blk_file)) + 4 + 4)
-            return '<SETINT, ' + str(txnum) + ', ' + blk_file + ', ' + str(blk_num) + ', ' + str(blk_offset) + ', ' + str(old_val) + '>'
-        elif op == LogRecord.SETSTRING:
-            txnum = temp_page.getInt(4)
-            blk_file = temp_page.getStr(4 + 4)
-            blk_num = temp_page.getInt(4 + 4 + (4 + len(blk_file)))
-            blk_offset = temp_page.getInt(4 + 4 + (4 + len(blk_file)) + 4)
-            old_val = temp_page.getStr(4 + 4 + (4 + len(blk_file)) + 4 + 4)
-            return '<SETSTRING, ' + str(txnum) + ', ' + blk_file + ', ' + str(blk_num) + ', ' + str(blk_offset) + ', ' + str(old_val) + '>'
+            return '<ROLLBACK, ' + str(log_data[1]) + '>'
+        elif op == LogRecord.SETINT or op == LogRecord.SETSTRING:
+            op, txnum, blk_file, blk_num, blk_offset, old_val, new_val, prev_lsn = log_data
+            return '<' + ('SETINT, ' if op == LogRecord.SETINT else 'SETSTRING, ') + str(txnum) + ', ' + blk_file + ', ' + str(blk_num) + ', ' + str(blk_offset) + ', ' + str(old_val) + ', ' + str(new_val) + '>'
+        elif op == LogRecord.FORMATPAGE:
+            return '<FORMATPAGE, ' + str(log_data[1]) + ', ' + log_data[2] + ', ' + str(log_data[3]) + '>'
+        elif op in LogRecord.ROW_OPS:
+            op, txnum, blk_file, blk_num, blk_offset, old_val, new_val, slot, prev_lsn = log_data
+            name = {LogRecord.INSERTROW: 'INSERTROW, ', LogRecord.UPDATEROW: 'UPDATEROW, ', LogRecord.DELETEROW: 'DELETEROW, '}[op]
+            return '<' + name + str(txnum) + ', ' + blk_file + ', ' + str(blk_num) + ', ' + str(blk_offset) + ', ' + str(slot) + ', ' + old_val.hex() + ', ' + new_val.hex() + '>'
+
+
+# Header at the start of every record page; the number of used slots(4 bytes) followed by a bitmap, bit i is set when slot i is used
+# RecordPage finds the next used or empty slot with bit operations on the bitmap instead of reading every slot's flag
+# The slot flags stay the source of truth(they are read under a lock), the header is kept in step by the row records
+#   an insert row record sets the slot's bit and a delete row record clears it, in rollback, redo and undo alike
+class SlotHeader:
+    _geometry = {} # (block_size, slot_size) -> (slot_count, header_size)
+
+    # Slots per block and the header size in front of them
+    @staticmethod
+    def geometry(block_size, slot_size):
+        key = (block_size, slot_size)
+        if key not in SlotHeader._geometry:
+            slot_count = (block_size - 4) * 8 // (8 * slot_size + 1)
+            while 4 + (slot_count + 7) // 8 + slot_count * slot_size > block_size:
+                slot_count -= 1
+            SlotHeader._geometry[key] = (slot_count, 4 + (slot_count + 7) // 8)
+        return SlotHeader._geometry[key]
+
+    # (bitmap as an int, used slot count)
+    @staticmethod
+    def read(page, slot_count):
+        return int.from_bytes(page.bb[4:4 + (slot_count + 7) // 8], 'little'), page.getInt(0)
+
+    # Byte of the bitmap that holds the bit of slot
+    @staticmethod
+    def bytePos(slot):
+        return 4 + slot // 8
+
+    @staticmethod
+    def isUsed(page, slot):
+        return bool(page.bb[SlotHeader.bytePos(slot)] >> slot % 8 & 1)
+
+    # Sets(used=True) or clears the bit of slot and adjusts the count
+    # Nothing changes if the bit is already that way, so redo can repeat it on a page that is already up to date
+    @staticmethod
+    def mark(page, slot, used):
+        pos = SlotHeader.bytePos(slot)
+        bit = 1 << (slot % 8)
+        if bool(page.bb[pos] & bit) != used:
+            page.bb[pos] ^= bit
+            page.setData(0, page.getInt(0) + (1 if used else -1))
+
+    # Lowest set bit above after, -1 if there is none
+    @staticmethod
+    def nextSet(bits, after):
+        bits >>= after + 1
+        return after + (bits & -bits).bit_length() if bits else -1
+
+
+# Free space map of a table; a side file(<table>.fsm) with one bit per table block, set when the block may have an empty slot
+# TableScan.insert jumps to the next block whose bit is set instead of reading every block on its way
+# The map is a hint and is not logged, an insert still checks the block it lands on
+#   writes that free a slot(delete row records, formatting a new block) set the bit after the fact
+#   an insert clears it only when it finds the block full under the block's latch, so it never hides a delete that just happened
+#   a bit lost in a crash leaves a block with room unvisited until the next delete in it
+# A table from before the map existed gets a map with every bit set the first time an insert looks at it
+# The overflow file of a table(see Overflow) has a map of its own(<table>.ovf.fsm), its bits are the empty overflow blocks
+class FreeSpaceMap:
+    _lock = threading.Lock() # creates and extends map files
+
+    @staticmethod
+    def fileName(data_file):
+        root, ext = os.path.splitext(data_file)
+        return (root if ext == '.tbl' else data_file) + '.fsm'
+
+    # Block of the map holding the bit of a table block, and the bit's position in it
+    @staticmethod
+    def _position(bm, target_block):
+        bits_per_block = bm.fm.block_size * 8
+        fsm_block = Block(FreeSpaceMap.fileName(target_block.file_name), target_block.block_number // bits_per_block)
+        with FreeSpaceMap._lock:
+            while bm.fm.length(fsm_block.file_name) <= fsm_block.block_number:
+                bm.fm.appendEmptyBlock(fsm_block.file_name)
+        return fsm_block, target_block.block_number % bits_per_block
+
+    @staticmethod
+    def markFree(bm, target_block, txnum):
+        fsm_block, bit = FreeSpaceMap._position(bm, target_block)
+        buf = bm.pin(fsm_block)
+        with buf.latch:
+            FreeSpaceMap._set(buf, bit, True, txnum)
+        bm.unpin(buf)
+
+    # Called with the table block's latch held; pin the map block first
+    @staticmethod
+    def markFull(fsm_buf, target_block, txnum):
+        with fsm_buf.latch:
+            FreeSpaceMap._set(fsm_buf, target_block.block_number % (len(fsm_buf.page.bb) * 8), False, txnum)
+
+    # None if the map does not reach the block yet; there is no bit to clear(a missing map is created with every bit set)
+    @staticmethod
+    def pinFor(bm, target_block):
+        fsm_block = Block(FreeSpaceMap.fileName(target_block.file_name), target_block.block_number // (bm.fm.block_size * 8))
+        if bm.fm.length(fsm_block.file_name) <= fsm_block.block_number:
+            return None
+        return bm.pin(fsm_block)
+
+    @staticmethod
+    def _set(buf, bit, free, txnum):
+        pos, mask = bit // 8, 1 << (bit % 8)
+        if bool(buf.page.bb[pos] & mask) != free:
+            buf.page.bb[pos] ^= mask
+            buf.setModified(txnum, -1)
+
+    # First block after block_number(below block_count) whose bit is set; -1 if there is none
+    @staticmethod
+    def nextFree(bm, data_file, block_number, block_count, txnum):
+        fsm_file = FreeSpaceMap.fileName(data_file)
+        bits_per_block = bm.fm.block_size * 8
+        if block_count and not bm.fm.length(fsm_file):
+            FreeSpaceMap._initialize(bm, data_file, block_count, txnum)
+        fsm_block_number = (block_number + 1) // bits_per_block
+        while fsm_block_number * bits_per_block < block_count and fsm_block_number < bm.fm.length(fsm_file):
+            buf = bm.pin(Block(fsm_file, fsm_block_number))
+            with buf.latch:
+                bits = int.from_bytes(buf.page.bb, 'little')
+            bm.unpin(buf)
+            base = fsm_block_number * bits_per_block
+            found = SlotHeader.nextSet(bits, max(block_number - base, -1))
+            if found >= 0:
+                return base + found if base + found < block_count else -1
+            fsm_block_number += 1
+        return -1
+
+    @staticmethod
+    def _initialize(bm, data_file, block_count, txnum):
+        with FreeSpaceMap._lock:
+            if bm.fm.length(FreeSpaceMap.fileName(data_file)):
+                return
+        bits_per_block = bm.fm.block_size * 8
+        for first in range(0, block_count, bits_per_block):
+            buf = bm.pin(FreeSpaceMap._position(bm, Block(data_file, first))[0])
+            with buf.latch:
+                buf.page.bb[:] = ((1 << min(block_count - first, bits_per_block)) - 1).to_bytes(len(buf.page.bb), 'little')
+                buf.setModified(txnum, -1)
+            bm.unpin(buf)
 
 
 # RM treats db log as the source of truth; Therefore to maintain durability RM must flush logs to disk before completing a transaction
@@ -160,180 +451,594 @@ class LogRecord:
 # Proper shutdown:
 #   All incomplete transaction should be rolled back
 #   All completed transaction should be commited
+#   Every buffer is flushed, then <CHECKPOINT> <SHUTDOWN> are the last records of the log
+#   Next startup sees <SHUTDOWN> as the last record and skips recovery
 
-# Transaction completion:
-#   For undo only algorithm, we are forced to flush the buffers to disk before writing commit
-#       one problem is if commit log fails, recovery will undo the transaction without commit log
+# Transaction completion(no-force):
+#   Update records carry old and new value, so a committed change can be redone from the log
+#   Commit only needs to write <COMMIT, txnum> and flush the log; dirty buffers reach disk whenever the buffer manager evicts them
 # Transaction Update:
-#   If buffer updates are on disk, but not on log, those updates will get reverted by recovery
-#       To prevent that from happening, we flush logs before we flush a buffer, for whatever reason i.e. buffer swap
+#   If buffer updates are on disk, but not on log, recovery can neither undo nor redo them
+#       To prevent that from happening, we flush logs before we flush a buffer, for whatever reason i.e. buffer swap(write ahead log)
 
 # There are three types of loggable activity
 # Start record when a transaction were created
 class RecoveryMgr:
+    # Transactions that have not completed yet, per log; {lm: {txnum: lsn of its last log record}}
+    # recorded by non-quiescent checkpoints
+    _lock = threading.Lock()
+    _active_txs = {}
+    RECOVERY_WORKERS = 4
+
     def __init__(self, tx, txnum, lm, bm):
         self.tx = tx
         self.txnum = txnum
         self.lm = lm
         self.bm = bm
-
-        LogRecord.writeToLog(lm=self.lm, op=LogRecord.START, txnum=self.txnum)
-
-    # Undo only recovery explained in Fig 5.7
-    # Undo only recovery algorithm forces all buffer to disk before writing(and flushing) the commit log
-    # So, when recovering we can go backward and only undo changes if the transaction was not complete(commit/rollback)
-    def commit(self):
-        # during commit, we flush all buffers modified by a transaction
-        # Although this line might call lm.flushPage multiple times, due to lsn logic, not all will get called
-        self.bm.flushAll(self.txnum)
-
-        lsn = LogRecord.writeToLog(lm=self.lm, op=LogRecord.COMMIT, txnum=self.txnum)
-        self.lm.flushPage(lsn)
-
-    # Performs a single backward pass.
-    # Since each Transaction has its own recovery manager, it should know what transaction we are in
-    # Go backward in the log and undo all updates() that belongs to the transaction
+        self.last_lsn = 0 # head of this transaction's backward chain
+        self.log_count = 0
+
+        with RecoveryMgr._lock:
+            RecoveryMgr._active_txs.setdefault(self.lm, {})
+        self.start_lsn = None # <START> is deferred until the first update; read-only transactions never log
+
+    # Writes <START> unless it is already written
+    def begin(self):
+        with self.lm._lock:
+            if self.start_lsn is None:
+                self.start_lsn = self._log(op=LogRecord.START)
+        return self.start_lsn
+
+    # Every record of this transaction goes through here to keep the prev_lsn chain
+    # Appending and publishing last_lsn happen under the log lock, so a checkpoint never sees a stale chain head
+    #   the transaction stops being active with its <COMMIT> or <ROLLBACK>; a checkpoint taken after it is appended
+    #   begins past it, so it must not list the transaction(analysis would never see it completed)
+    def _log(self, **log_param):
+        with self.lm._lock:
+            if self.start_lsn is None and log_param['op'] != LogRecord.START:
+                self.begin()
+            self.last_lsn = LogRecord.writeToLog(lm=self.lm, txnum=self.txnum, prev_lsn=self.last_lsn, **log_param)
+            self.log_count += 1
+            with RecoveryMgr._lock:
+                if log_param['op'] in (LogRecord.COMMIT, LogRecord.ROLLBACK):
+                    RecoveryMgr._active_txs[self.lm].pop(self.txnum, None)
+                else:
+                    RecoveryMgr._active_txs[self.lm][self.txnum] = self.last_lsn
+        return self.last_lsn
+
+    # No-force commit; a single sequential log write
+    # The buffers modified by this transaction stay in the buffer pool, redo recovers them after a crash
+    # A transaction that never logged an update has nothing to make durable; it writes and flushes nothing
+    # flush=False leaves <COMMIT> in the log buffer and the caller flushes it(or not) later; returns its lsn
+    def commit(self, flush=True):
+        if self.start_lsn is None:
+            return 0
+        lsn = self._log(op=LogRecord.COMMIT)
+        if flush:
+            self.lm.flushPage(lsn)
+        return lsn
+
+    # Follows this transaction's prev_lsn chain from its last record back to its <START>
+    # Records of other transactions are never read, so the cost only depends on this transaction's own updates
     # Finally add a rollback log for that transaction
     def rollback(self):
-        # Make a single backward pass through the log
-        # Each time we see a update log for self.txnum, we call the undo method of transaction
-        # Continue until the start record of self.txnum was reached
-        for l in self.lm.iterator():
-            log_data = LogRecord.createLogRecord(l) # from byte array extract log record information
-            op, txnum = log_data[0], log_data[1]
-            if txnum == self.txnum:
-                if op == LogRecord.START:
-                    break
+        if self.start_lsn is None:
+            return
+        # Compensation records written by undo extend the chain at its head; we are already past them
+        lsn = self.last_lsn
+        while lsn:
+            log_data = LogRecord.createLogRecord(self.lm.readLog(lsn)) # from byte array extract log record information
+            op = log_data[0]
+            if op == LogRecord.START:
+                break
+            if op in LogRecord.UPDATES:
                 LogRecord.undo(self.tx, *log_data)
+            lsn = log_data[-1]
 
-        self.bm.flushAll(self.txnum) # TODO: Flushing buffers should not be mandatory here.
-        lsn = LogRecord.writeToLog(lm=self.lm, op=LogRecord.ROLLBACK, txnum=self.txnum)
+        lsn = self._log(op=LogRecord.ROLLBACK)
         self.lm.flushPage(lsn)
 
-    # Undo, followed by Redo
-    # Step 1: Go log backwards and undo the updates() that belongs to transaction that were not committed/rolled back.
-    # Step 2: Go log forward and redo the updates() that belongs only commited transactions
-
-    # During Transaction updating
-    #   If each buffer update flush log page that will result in poor performance as explained in 4.2
-    #       Therefore buffer update logs are only flushed when buffer manager is swapping them out or log page is full
-    # During Transaction completion
-    #   we flush all buffers associated with the transaction
-    #   then we write commit log entry <COMMIT, txnum>
-    #   then we flush the log page
-    # Undo only (Make sure buffers is flushed to disk before updating log so redo step is not necessary)
-    #   We know all commited transactions are
-
-    # Performs a single backward pass.
+    @staticmethod
+    def activeTransactions(lm):
+        with RecoveryMgr._lock:
+            return dict(RecoveryMgr._active_txs.get(lm, {}))
+
+    # Orderly shutdown; called once every transaction has completed
+    @staticmethod
+    def shutdown(lm, bm):
+        if RecoveryMgr.activeTransactions(lm):
+            raise Exception('Cannot shutdown while transactions are still active.')
+        bm.flushAll()
+        LogRecord.writeToLog(lm=lm, op=LogRecord.CHECKPOINT)
+        lsn = LogRecord.writeToLog(lm=lm, op=LogRecord.SHUTDOWN)
+        lm.flushPage(lsn)
+
+    # Only looks at the last log record; must be called before any transaction starts
+    @staticmethod
+    def isCleanShutdown(lm):
+        for l in lm.iterator():
+            return LogRecord.createLogRecord(l)[0] == LogRecord.SHUTDOWN
+        return False
+
+    # ARIES style recovery in three passes, starting from the last checkpoint
+    #   Analysis (forward)  find transactions that never completed(losers) with their last lsn, and the first update of each block
+    #   Redo     (forward)  repeat history; write the new value of every update, losers included
+    #   Undo     (backward) roll back losers by following their prev_lsn chains, always taking the newest pending record first
+    # Redo and undo first group their writes per block, then apply them block by block(see _applyByBlock)
+    # A quiescent <CHECKPOINT> means nothing before it matters
+    # A <NQCHECKPOINT> carries the active transactions(with their last lsn) and the dirty page table at the time it began
+    #   analysis starts at its begin_lsn, redo at the oldest rec_lsn, undo follows the chains as far back as they go
     # Recovery manger is oblivious current state of the database;
-    # it writes old values without looking the current value
+    # it writes old and new values without looking the current value
     # Recovery requirs a dummy tx, meaning a redundent <start x> will be created before <checkpoint>
     #   but it is not a problem since we never look at logs before <Checkpoint> anyway
+    # txnums restart from 1 on every startup, so the passes stop at the dummy tx's own <START> instead of matching its txnum
+    #   it is written up front here, since <START> is otherwise deferred until the first update
     def recover(self):
-        # go backward and only undo changes if the transaction was not complete(commit/rollback)
-        # transaction without commit/rollback are treated as incomplete and their changes should be reversed
-        completed_tx = set()
-        for l in self.lm.iterator():
+        self.begin()
+        analysis_lsn = None
+        losers = {} # txnum -> lsn of its last record
+        dirty_blocks = {} # block -> lsn of the first update that may not be on disk
+        for lsn, l in self.lm.iterator(start_lsn=self.start_lsn, with_lsn=True):
             log_data = LogRecord.createLogRecord(l)
-            op, txnum = log_data[0], log_data[1]
-            if op == LogRecord.CHECKPOINT:
+            if log_data[0] == LogRecord.CHECKPOINT:
+                analysis_lsn = lsn
+                break
+            elif log_data[0] == LogRecord.NQCHECKPOINT:
+                analysis_lsn, losers, dirty_blocks = log_data[2], log_data[3], log_data[4]
+                part_lsn = log_data[5]
+                while part_lsn: # the tables that did not fit in the checkpoint record
+                    part = LogRecord.createLogRecord(self.lm.readLog(part_lsn))
+                    losers.update(part[3])
+                    dirty_blocks.update(part[4])
+                    part_lsn = part[5]
                 break
 
+        # Analysis
+        for lsn, l in self.lm.iterator(start_lsn=analysis_lsn, forward=True, with_lsn=True):
+            if lsn >= self.start_lsn:
+                break
+            log_data = LogRecord.createLogRecord(l)
+            op, txnum = log_data[0], log_data[1]
             if op == LogRecord.COMMIT or op == LogRecord.ROLLBACK:
-                completed_tx.add(txnum)
+                losers.pop(txnum, None)
+            elif op == LogRecord.START or op in LogRecord.UPDATES:
+                losers[txnum] = lsn
+                if op != LogRecord.START:
+                    dirty_blocks.setdefault(Block(log_data[2], log_data[3]), lsn)
+        # A transaction listed by a checkpoint whose chain already ends in its <COMMIT> or <ROLLBACK> is finished, not a loser
+        for txnum, lsn in list(losers.items()):
+            if lsn and LogRecord.createLogRecord(self.lm.readLog(lsn))[0] in (LogRecord.COMMIT, LogRecord.ROLLBACK):
+                del losers[txnum]
+
+        # Redo; collect the new values per block in log order
+        redo_writes = {}
+        if dirty_blocks:
+            for lsn, l in self.lm.iterator(start_lsn=min(dirty_blocks.values()), forward=True, with_lsn=True):
+                if lsn >= self.start_lsn:
+                    break
+                log_data = LogRecord.createLogRecord(l)
+                op = log_data[0]
+                if op in LogRecord.UPDATES:
+                    block = Block(log_data[2], log_data[3])
+                    if lsn >= dirty_blocks.get(block, self.start_lsn):
+                        if op == LogRecord.FORMATPAGE: # everything before it is wiped out anyway
+                            redo_writes[block] = [(0, bytes(self.lm.file_mgr.block_size), None, True)]
+                        else:
+                            redo_writes.setdefault(block, []).append((log_data[4], log_data[6], LogRecord.slotMark(op, log_data), LogRecord.freesSpace(op)))
+        self._applyByBlock(redo_writes)
+
+        # Undo; collect the old values per block, the heap hands out records in reverse lsn order
+        undo_writes = {}
+        to_undo = [-lsn for lsn in losers.values() if lsn]
+        heapq.heapify(to_undo)
+        while to_undo:
+            log_data = LogRecord.createLogRecord(self.lm.readLog(-heapq.heappop(to_undo)))
+            op = log_data[0]
+            if op == LogRecord.START:
                 continue
-            elif txnum not in completed_tx and (op == LogRecord.SETINT or op == LogRecord.SETSTRING):
-                LogRecord.undo(self.tx, *log_data)
-            else:
-                pass # such as <START, txnum> log record
+            if op in LogRecord.UPDATES:
+                inverse = LogRecord.INVERSE.get(op)
+                undo_writes.setdefault(Block(log_data[2], log_data[3]), []).append((log_data[4], log_data[5], LogRecord.slotMark(inverse, log_data), LogRecord.freesSpace(inverse)))
+            if log_data[-1]:
+                heapq.heappush(to_undo, -log_data[-1])
+        self._applyByBlock(undo_writes)
 
         # Upon recovery completion; add checkpoint log
-        self.bm.flushAll(self.txnum) # TODO: Flushing buffers should not be mandatory here.
+        # Flushing every buffer makes the checkpoint quiescent, the next recovery never looks before it
+        # Recovery writes are not logged; if we crash before the checkpoint reaches the disk the losers are still losers
+        #   and the next recovery simply redoes and undoes them again
+        self.bm.flushAll()
+        for txnum in losers:
+            LogRecord.writeToLog(lm=self.lm, op=LogRecord.ROLLBACK, txnum=txnum, prev_lsn=losers[txnum])
         lsn = LogRecord.writeToLog(lm = self.lm, op = LogRecord.CHECKPOINT)
         self.lm.flushPage(lsn)
 
+    # Writes {block: [(offset, value, mark, frees), ...]} to the blocks, each list in order; row images(bytes) are copied as they are
+    # mark; (slot, used) to set in the page header after the write(see SlotHeader), None for no header change
+    # frees; the write leaves room in the block(see LogRecord.freesSpace), the block is put on the free space map
+    # Blocks are independent of each other, so they are spread over worker threads and every block is pinned only once
+    # The dummy tx is bypassed; there is no other transaction to lock against during recovery
+    def _applyByBlock(self, block_writes):
+        def applyBlock(block):
+            buf = self.bm.pin(block)
+            freed = False
+            for block_offset, val, mark, frees in block_writes[block]:
+                if isinstance(val, bytes):
+                    buf.page.bb[block_offset:block_offset + len(val)] = val
+                else:
+                    buf.page.setData(block_offset, val)
+                if mark:
+                    SlotHeader.mark(buf.page, *mark)
+                freed = freed or frees
+            buf.setModified(self.txnum, -1)
+            self.bm.unpin(buf)
+            if freed: # the free space map is not logged; put back the bit a lost map page may have missed
+                FreeSpaceMap.markFree(self.bm, block, self.txnum)
+
+        # each worker holds one buffer, leave room in the pool
+        workers = min(RecoveryMgr.RECOVERY_WORKERS, max(1, self.bm.num_buffers // 2), len(block_writes))
+        if workers:
+            with ThreadPoolExecutor(workers) as pool:
+                list(pool.map(applyBlock, block_writes)) # list() surfaces exceptions raised by workers
+
     # Transaction calls these set methods to write to log
-    # we want to save the old value in the log; so undo recovery can replace current value with this old value
+    # we save the old value(undo) and the new value(redo) in the log
     # Choosing to use static method instead of SetIntRecord.writeToLog
-    def setInt(self, target_buffer, block_offset):
+    def setInt(self, target_buffer, block_offset, new_val):
         old_val = target_buffer.page.getInt(block_offset)
-        return LogRecord.writeToLog(
-            lm=self.lm,
+        return self._log(
             op=LogRecord.SETINT,
-            txnum=self.txnum,
             blk_file=target_buffer.block.file_name,
             blk_num=target_buffer.block.block_number,
             blk_offset=block_offset,
-            old_val=old_val
+            old_val=old_val,
+            new_val=new_val
         )
 
-    def setString(self, target_buffer, block_offset):
+    def setString(self, target_buffer, block_offset, new_val):
         old_val = target_buffer.page.getStr(block_offset)
-        return LogRecord.writeToLog(
-            lm=self.lm,
+        return self._log(
             op=LogRecord.SETSTRING,
-            txnum=self.txnum,
             blk_file=target_buffer.block.file_name,
             blk_num=target_buffer.block.block_number,
             blk_offset=block_offset,
-            old_val=old_val
+            old_val=old_val,
+            new_val=new_val
         )
 
-# LockTable grants locks to a transaction
-class LockTable:
-    import collections
-    _all_locks = collections.defaultdict(int) # TODO: check if using defaultdict is introducing any bug
+    def formatPage(self, target_buffer):
+        return self._log(
+            op=LogRecord.FORMATPAGE,
+            blk_file=target_buffer.block.file_name,
+            blk_num=target_buffer.block.block_number
+        )
+
+    # Row records; the caller passes the old image since it already read it
+    def setBytes(self, target_buffer, block_offset, old_val, new_val, op, slot):
+        return self._log(
+            op=op,
+            blk_file=target_buffer.block.file_name,
+            blk_num=target_buffer.block.block_number,
+            blk_offset=block_offset,
+            slot=slot,
+            old_val=old_val,
+            new_val=new_val
+        )
 
+# Periodic non-quiescent checkpoints
+# Transactions keep running while a checkpoint is taken; nothing waits for them to finish
+#   1. remember the current end of the log(begin_lsn)
+#   2. flush dirty buffers nobody has pinned, so the next checkpoint's redo window stays short
+#   3. log <NQCHECKPOINT, begin_lsn, active transactions, dirty page table>(parts of the tables may go before it) and flush the log
+# Recovery after a crash then only reads forward from the oldest dirty page of the last checkpoint,
+#   and backward along the chains of the transactions that were active
+# A checkpoint is triggered once log_bytes of log were written or interval seconds passed since the last one
+class Checkpointer:
+    def __init__(self, lm, bm, log_bytes=1024 * 1024, interval=60, poll_interval=1.0):
+        self.lm = lm
+        self.bm = bm
+        self.log_bytes = log_bytes
+        self.interval = interval
+        self.poll_interval = poll_interval
+
+        self.last_checkpoint_lsn = self.lm.current_lsn
+        self.last_checkpoint_time = time.time()
+        self.checkpoint_count = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def checkpoint(self):
+        with self._lock:
+            with self.lm._lock: # no transaction can log while we read the chain heads
+                begin_lsn = self.lm.current_lsn
+                active_txs = RecoveryMgr.activeTransactions(self.lm)
+            self.bm.flushUnpinned()
+            lsn = LogRecord.writeToLog(
+                lm=self.lm,
+                op=LogRecord.NQCHECKPOINT,
+                begin_lsn=begin_lsn,
+                active_txs=active_txs,
+                dirty_pages=self.bm.dirtyPages()
+            )
+            self.lm.flushPage(lsn)
+            self.last_checkpoint_lsn = lsn
+            self.last_checkpoint_time = time.time()
+            self.checkpoint_count += 1
+            return lsn
+
+    def checkpointIfDue(self):
+        if self.lm.current_lsn - self.last_checkpoint_lsn >= self.log_bytes or time.time() - self.last_checkpoint_time >= self.interval:
+            if self.lm.current_lsn != self.last_checkpoint_lsn: # nothing was logged since the last checkpoint
+                return self.checkpoint()
+
+    # background thread that checks the triggers every poll_interval seconds
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='Checkpointer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    # A failed checkpoint is reported and the next one is tried as usual; the log is still valid up to the last one that completed
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.checkpointIfDue()
+            except Exception:
+                db_logger.exception('Checkpoint failed')
+
+
+# A transaction lost a conflict with another one; it was picked as a deadlock victim or failed optimistic validation
+class LockAbortException(AbortException):
+    pass
+
+
+# A transaction waiting for a lock; it sleeps on its own condition so only granted waiters are woken up
+# cost is called when the request ends up in a deadlock; the cheapest transaction in the cycle is aborted
+class LockRequest:
+    def __init__(self, txnum, mode, mutex, cost=None):
+        self.txnum = txnum
+        self.mode = mode
+        self.cost = cost
+        self.granted = False
+        self.aborted = False
+        self.condition = threading.Condition(mutex)
+
+
+# Every locked block has a queue
+#   granted; {txnum: mode} of the transactions holding the lock(the grant group)
+#   waiting; LockRequests in FIFO order, upgrades are placed ahead of new requests
+class LockQueue:
     def __init__(self):
-        self._condition = threading.Condition()
+        self.granted = {}
+        self.waiting = collections.deque()
 
-    # def getLockVal(self, target_block):
-    #     if target_block in LockTable._all_locks:
-    #         return LockTable._all_locks[target_block]
-    #     else:
-    #         return 0
 
-    # similar to BufferMgr.pin
-    def sLock(self, target_block):
-        with self._condition:
-            start = time.time()
-            # we will wait if there is a xlock and we have not waited for at least 10 sec to release that xlock
-            while LockTable._all_locks[target_block] < 0 and (time.time() - start) < 10:
-                self._condition.wait(2.0) # within this 10 seconds, every 2 sec check if xlock was released
-
-            # Since multiple threads are woken up; another thread might race first to xlock before current thread
-            # That's is when this check will fail; and prompt the client to try again
-            if LockTable._all_locks[target_block] < 0:
-                raise Exception('Tx aborted because it waited to long to acquire slock or another Tx raced first to acquire the slock. Try again.')
-            LockTable._all_locks[target_block] += 1
-
-    # We use Approximate Deadlock Detection to prevent Tx from waiting to obtain for a lock for too long
-    # Here, we prevent deadlock by aborting Tx that is waiting too long(10 sec) for a lock.
-    # Long wait time doesn't mean deadlock, it could also mean a lot of data is being written
-    # Meaning, our approach react to situation that could potentially lead to deadlock, which may or may not be an actual deadlock
-    # similar to BufferMgr.pin
-    def xLock(self, target_block):
-        with self._condition:
-            start = time.time()
-            # > 1 is because slock is obtained before attempting to xlock
-            # meaning, if a transaction has xlock on a block, it is implies that it also have slock on it
-            while LockTable._all_locks[target_block] > 1 and (time.time() - start) < 10:
-                self._condition.wait(2.0)
-
-            # see sLock function doc
-            if LockTable._all_locks[target_block] > 1:
-                raise Exception('Tx aborted because it waited to long to acquire xlock or another Tx raced first to acquire the xlock. Try again.')
-            LockTable._all_locks[target_block] = -1
+# LockTable grants locks to a transaction
+# One mutex protects the table, but waiters are queued per block
+#   a request is granted right away if it is compatible with the grant group and nobody is waiting before it(no barging)
+#   on unlock we grant the longest compatible prefix of the queue and wake up exactly those waiters
+# S -> X upgrade is explicit; the upgrader only waits for the other S holders to leave, and goes ahead of the new requests
+#   in general an upgrade asks for the supremum of the held and the requested mode(i.e. IX + S = SIX)
+# Lock keys are opaque; ConcurrencyMgr locks the database, files(by name), blocks and records((block, slot))
+#
+# Deadlock detection
+# A waiting transaction waits for the holders and the earlier waiters of its block that it conflicts with(wait-for graph)
+# A deadlock can only appear when a new wait starts, so the graph is checked right then, starting from the new waiter
+# The transaction with the fewest log records in the cycle is the victim(cheapest to roll back), ties go to the youngest
+# Victim's lock request fails immediately; no more waiting for a timeout that may or may not be a deadlock
+class LockTable:
+    # Lock modes; intention modes(IS, IX) are taken on a parent(database, file) before locking inside it
+    #   SIX = S on the whole parent + intention to X some of its children
+    COMPATIBLE = {
+        ('IS', 'IS'), ('IS', 'IX'), ('IS', 'S'), ('IS', 'SIX'),
+        ('IX', 'IS'), ('IX', 'IX'),
+        ('S', 'IS'), ('S', 'S'),
+        ('SIX', 'IS'),
+    } # (held, requested) pairs that can be granted together
+    COVERS = {
+        'IS': {'IS'},
+        'IX': {'IS', 'IX'},
+        'S': {'IS', 'S'},
+        'SIX': {'IS', 'IX', 'S', 'SIX'},
+        'X': {'IS', 'IX', 'S', 'SIX', 'X'},
+    } # held mode -> requested modes that need no new lock
+    # held mode -> requested mode -> weakest mode covering both; what an upgrade ends up holding
+    SUPREMUM = {
+        'IS': {'IS': 'IS', 'IX': 'IX', 'S': 'S', 'SIX': 'SIX', 'X': 'X'},
+        'IX': {'IS': 'IX', 'IX': 'IX', 'S': 'SIX', 'SIX': 'SIX', 'X': 'X'},
+        'S': {'IS': 'S', 'IX': 'SIX', 'S': 'S', 'SIX': 'SIX', 'X': 'X'},
+        'SIX': {'IS': 'SIX', 'IX': 'SIX', 'S': 'SIX', 'SIX': 'SIX', 'X': 'X'},
+        'X': {'IS': 'X', 'IX': 'X', 'S': 'X', 'SIX': 'X', 'X': 'X'},
+    }
 
-    # release lock on a block
-    def unlock(self, target_block):
-        with self._condition:
-            if LockTable._all_locks[target_block] > 0:
-                LockTable._all_locks[target_block] -= 1
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._queues = {}
+        self._row_slots = {} # block -> slots that have a record lock queue(granted or waiting)
+        self._waits_for = {} # txnum -> (block, LockRequest) of every waiting transaction
+        self._release_lsns = {} # key -> commit lsn of the last transaction that released X/SIX on it before its commit was durable
+        self._intent_release_lsns = {} # key -> the same for IX; rows(or blocks) below the key were written under it
+        self._dependencies = {} # txnum -> highest of those lsns among the keys it was granted
+        self.deadlocks = 0
+        self.detection_time = 0.0 # total and worst time between a wait that closed a cycle and aborting the victim
+        self.max_detection_time = 0.0
+
+    def sLock(self, target_block, txnum, cost=None):
+        self.lock(target_block, txnum, 'S', cost)
+
+    def xLock(self, target_block, txnum, cost=None):
+        self.lock(target_block, txnum, 'X', cost)
+
+    # Returns True once the lock is granted; with wait=False returns False instead of waiting
+    def lock(self, target_block, txnum, mode, cost=None, wait=True):
+        with self._mutex:
+            queue = self._queues.get(target_block)
+            if queue is None:
+                queue = self._queues[target_block] = LockQueue()
+                if isinstance(target_block, tuple):
+                    self._row_slots.setdefault(target_block[0], set()).add(target_block[1])
+            held = queue.granted.get(txnum)
+            if held:
+                if mode in LockTable.COVERS[held]:
+                    return True
+                mode = LockTable.SUPREMUM[held][mode]
+
+            if (held or not queue.waiting) and self._grantable(queue, txnum, mode):
+                queue.granted[txnum] = mode
+                self._inherit(target_block, txnum)
+                return True
+            if not wait:
+                return False
+
+            request = LockRequest(txnum, mode, self._mutex, cost)
+            if held:
+                # behind the upgrades that are already waiting, ahead of everything else
+                position = 0
+                while position < len(queue.waiting) and queue.waiting[position].txnum in queue.granted:
+                    position += 1
+                queue.waiting.insert(position, request)
             else:
-                # TODO: Maybe another alternative is set this entry to zero
-                del LockTable._all_locks[target_block]
-                self._condition.notify_all()
+                queue.waiting.append(request)
+            self._waits_for[txnum] = (target_block, request)
+            if db_tracer.lock:
+                db_tracer.emit('lock', 'wait', lambda: {'block': str(target_block), 'txnum': txnum, 'mode': mode, 'queue': len(queue.waiting)})
+
+            # the new wait may close several cycles; keep breaking them while we are still waiting
+            while not request.granted and not request.aborted and self._detectDeadlock(txnum):
+                pass
+            while not request.granted and not request.aborted:
+                request.condition.wait()
+            if request.aborted:
+                raise LockAbortException('Tx ' + str(txnum) + ' aborted to break a deadlock on ' + str(target_block) + '. Try again.')
+            return True
+
+    # release lock on a block
+    # commit_lsn; the lock is released early, before that <COMMIT> is flushed(see Transaction.commit)
+    def unlock(self, target_block, txnum, commit_lsn=0):
+        with self._mutex:
+            queue = self._queues.get(target_block)
+            mode = queue.granted.pop(txnum, None) if queue else None
+            if mode is None:
+                return
+            if commit_lsn and mode in ('X', 'SIX') and commit_lsn > self._release_lsns.get(target_block, 0):
+                self._release_lsns[target_block] = commit_lsn
+            elif commit_lsn and mode == 'IX' and commit_lsn > self._intent_release_lsns.get(target_block, 0):
+                self._intent_release_lsns[target_block] = commit_lsn
+            self._grantWaiting(target_block, queue)
+
+    # Early lock release
+    # Whoever is granted a lock released early may see data of a commit that is not durable yet
+    # Returns(and forgets) the commit lsn this transaction has to see flushed before its own commit is reported
+    def dependency(self, txnum):
+        with self._mutex:
+            return self._dependencies.pop(txnum, 0)
+
+    # The log is durable up to lsn; releases before that no longer create dependencies
+    def forgetDurable(self, lsn):
+        with self._mutex:
+            for release_lsns in (self._release_lsns, self._intent_release_lsns):
+                for key in [key for key, release_lsn in release_lsns.items() if release_lsn <= lsn]:
+                    del release_lsns[key]
+
+    # Bitmap(bit i is slot i) of the rows of a block someone holds or waits for a record lock on
+    def lockedRows(self, target_block):
+        with self._mutex:
+            bits = 0
+            for slot in self._row_slots.get(target_block, ()):
+                bits |= 1 << slot
+            return bits
+
+    def stats(self):
+        with self._mutex:
+            return {'deadlocks': self.deadlocks, 'detection_time': self.detection_time, 'max_detection_time': self.max_detection_time}
+
+    def _grantable(self, queue, txnum, mode):
+        for holder, held in queue.granted.items():
+            if holder != txnum and (held, mode) not in LockTable.COMPATIBLE:
+                return False
+        return True
+
+    # Called with the mutex held
+    def _grantWaiting(self, target_block, queue):
+        while queue.waiting and self._grantable(queue, queue.waiting[0].txnum, queue.waiting[0].mode):
+            request = queue.waiting.popleft()
+            queue.granted[request.txnum] = request.mode
+            self._inherit(target_block, request.txnum)
+            request.granted = True
+            del self._waits_for[request.txnum]
+            request.condition.notify()
+        if not queue.granted and not queue.waiting:
+            del self._queues[target_block]
+            if isinstance(target_block, tuple):
+                slots = self._row_slots[target_block[0]]
+                slots.discard(target_block[1])
+                if not slots:
+                    del self._row_slots[target_block[0]]
+
+    # Called with the mutex held
+    # A released IX only matters to locks that read the whole key(S, SIX, X) without locking the rows(or blocks) below it
+    def _inherit(self, target_block, txnum):
+        release_lsn = self._release_lsns.get(target_block)
+        if self._queues[target_block].granted[txnum] in ('S', 'SIX', 'X'):
+            release_lsn = max(release_lsn or 0, self._intent_release_lsns.get(target_block, 0))
+        if release_lsn and release_lsn > self._dependencies.get(txnum, 0):
+            self._dependencies[txnum] = release_lsn
+
+    # Outgoing edges of a waiting transaction in the wait-for graph
+    def _blockers(self, txnum):
+        target_block, request = self._waits_for[txnum]
+        queue = self._queues[target_block]
+        blockers = [holder for holder, held in queue.granted.items() if holder != txnum and (held, request.mode) not in LockTable.COMPATIBLE]
+        for ahead in queue.waiting: # grants follow the queue order, so we wait for every earlier waiter, compatible or not
+            if ahead is request:
+                break
+            if ahead.txnum != txnum:
+                blockers.append(ahead.txnum)
+        return blockers
+
+    # Depth first search from the new waiter; a cycle has to go through it
+    # Returns True if a victim was aborted
+    def _detectDeadlock(self, txnum):
+        start = time.time()
+        path, visited = [txnum], {txnum}
+        edges = [iter(self._blockers(txnum))]
+        while edges:
+            blocker = next(edges[-1], None)
+            if blocker is None:
+                edges.pop()
+                path.pop()
+            elif blocker == txnum:
+                break
+            elif blocker in self._waits_for and blocker not in visited:
+                visited.add(blocker)
+                path.append(blocker)
+                edges.append(iter(self._blockers(blocker)))
+        if not path:
+            return False
+
+        cycle = [self._waits_for[t][1] for t in path]
+        victim = min(cycle, key=lambda r: (r.cost() if r.cost else 0, -r.txnum))
+        target_block, _ = self._waits_for.pop(victim.txnum)
+        queue = self._queues[target_block]
+        queue.waiting.remove(victim)
+        victim.aborted = True
+        victim.condition.notify()
+        self._grantWaiting(target_block, queue) # requests behind the victim might be grantable now
+
+        elapsed = time.time() - start
+        self.deadlocks += 1
+        self.detection_time += elapsed
+        self.max_detection_time = max(self.max_detection_time, elapsed)
+        if db_tracer.lock:
+            db_tracer.emit('lock', 'deadlock', lambda: {'cycle': [r.txnum for r in cycle], 'victim': victim.txnum, 'seconds': elapsed})
+        return True
 
 # Concurrency Manager responsible for correctly executing concurrent transaction; it uses lock to do so.
 # We know serial schedules are correct due to proof by contradiction.
@@ -369,54 +1074,157 @@ class LockTable:
 # CM object request a lock using the global LockTable object
 # But all CM refer to a static instance of lock table
 # This static instance of lock table keeps all locks obtained by all transactions
+#
+# Multi-granularity locking
+# Locks form a hierarchy database -> file -> block; before locking a block we hold an intention lock on its file and the database
+#   reading a block: IS on database and file, S on the block
+#   writing a block: IX on database and file, X on the block
+# Once a transaction holds more than ESCALATION_THRESHOLD block locks in a file, they are traded for one file lock
+#   a scan ends up with a single S lock on the file(SIX if it also writes the file), a bulk update with an X lock
+# A file lock of S/SIX/X already covers reading any of its blocks, X covers writing them
+# Record locking(optional, per transaction) adds one more level; IS/IX on the block, S/X on (block, slot)
+#   transactions touching different rows of a block no longer wait for each other
+#   record locks count toward the escalation threshold of their file like block locks
 class ConcurrencyMgr:
     _global_locktable = LockTable() # ConcurrencyMgr.db_locktable
+    DATABASE = '*' # lock key of the whole database; files are locked by name, blocks by Block
+    ESCALATION_THRESHOLD = 32
 
-    def __init__(self):
-        self.tx_locks = {}
+    # cost; callable returning how expensive it is to abort this transaction, used to pick deadlock victims
+    def __init__(self, txnum, cost=None):
+        self.txnum = txnum
+        self.cost = cost
+        self.tx_locks = {} # lock key -> mode
+        self.file_blocks = {} # file name -> blocks of that file locked individually
+        self.escalate_shared = True # read committed turns this off, a file S lock would outlive the scan
 
     def sLock(self, target_block):
-        if target_block not in self.tx_locks:
-            ConcurrencyMgr._global_locktable.sLock(target_block)
-            self.tx_locks[target_block] = 'S'
-        # else CM always has a sLock no the block
-
+        file_name = target_block.file_name
+        if self.tx_locks.get(target_block) in ('S', 'SIX', 'X') or self.tx_locks.get(file_name) in ('S', 'SIX', 'X'):
+            return
+        self._lock(ConcurrencyMgr.DATABASE, 'IS')
+        self._lock(file_name, 'IS')
+        self._lock(target_block, 'S')
+        self._countBlock(file_name, target_block, 'S')
+
+    # Asks for X directly; if we already hold S the lock table handles the upgrade
     def xLock(self, target_block):
-        if not (target_block in self.tx_locks and self.tx_locks[target_block] == 'X'):
-            # this block is already in the tx_locks list and we have xLock on it
-            self.sLock(target_block)
-            ConcurrencyMgr._global_locktable.xLock(target_block)
-            self.tx_locks[target_block] = 'X'
-
-    def release(self):
-        for block in self.tx_locks.keys():
-            ConcurrencyMgr._global_locktable.unlock(block)
+        file_name = target_block.file_name
+        if self.tx_locks.get(target_block) == 'X' or self.tx_locks.get(file_name) == 'X':
+            return
+        self._lock(ConcurrencyMgr.DATABASE, 'IX')
+        self._lock(file_name, 'IX')
+        self._lock(target_block, 'X')
+        self._countBlock(file_name, target_block, 'X')
+
+    def sLockRecord(self, target_block, slot):
+        file_name = target_block.file_name
+        if self._recordCovered(target_block, slot, ('S', 'SIX', 'X')):
+            return
+        self._lock(ConcurrencyMgr.DATABASE, 'IS')
+        self._lock(file_name, 'IS')
+        self._lock(target_block, 'IS')
+        self._lock((target_block, slot), 'S')
+        self._countBlock(file_name, (target_block, slot), 'S')
+
+    def xLockRecord(self, target_block, slot):
+        self.tryXLockRecord(target_block, slot, True)
+
+    # Used by inserts to skip slots other transactions are working on; only the record lock itself is not waited for
+    def tryXLockRecord(self, target_block, slot, wait=False):
+        file_name = target_block.file_name
+        if self._recordCovered(target_block, slot, ('X',)):
+            return True
+        self._lock(ConcurrencyMgr.DATABASE, 'IX')
+        self._lock(file_name, 'IX')
+        self._lock(target_block, 'IX')
+        if not self._lock((target_block, slot), 'X', wait):
+            return False
+        self._countBlock(file_name, (target_block, slot), 'X')
+        return True
+
+    def _recordCovered(self, target_block, slot, covering_modes):
+        return (self.tx_locks.get((target_block, slot)) in covering_modes
+                or self.tx_locks.get(target_block) in covering_modes
+                or self.tx_locks.get(target_block.file_name) in covering_modes)
+
+    # Children are released before their parents
+    # commit_lsn; released early, before <COMMIT> is durable
+    # Returns the commit lsn this transaction depends on through locks released early by others(see LockTable.dependency)
+    def release(self, commit_lsn=0):
+        for key in sorted(self.tx_locks, key=lambda k: 0 if isinstance(k, tuple) else 1 if isinstance(k, Block) else (3 if k == ConcurrencyMgr.DATABASE else 2)):
+            ConcurrencyMgr._global_locktable.unlock(key, self.txnum, commit_lsn)
         self.tx_locks.clear()
-
-
+        self.file_blocks.clear()
+        return ConcurrencyMgr._global_locktable.dependency(self.txnum)
+
+    # Read committed; drops the S locks held on a block(and its rows) once the transaction is done reading it
+    # Written blocks and rows stay X locked, intention locks on the file and the database are kept until completion
+    def releaseShared(self, target_block):
+        blocks = self.file_blocks.get(target_block.file_name, set())
+        for key in [k for k in blocks if (k[0] if isinstance(k, tuple) else k) == target_block]:
+            if self.tx_locks[key] == 'S':
+                ConcurrencyMgr._global_locktable.unlock(key, self.txnum)
+                del self.tx_locks[key]
+                blocks.discard(key)
+        if self.tx_locks.get(target_block) == 'IS' and not any(isinstance(k, tuple) and k[0] == target_block for k in blocks):
+            ConcurrencyMgr._global_locktable.unlock(target_block, self.txnum)
+            del self.tx_locks[target_block]
+
+    def _lock(self, key, mode, wait=True):
+        held = self.tx_locks.get(key)
+        if held and mode in LockTable.COVERS[held]:
+            return True
+        if not ConcurrencyMgr._global_locktable.lock(key, self.txnum, mode, self.cost, wait):
+            return False
+        self.tx_locks[key] = LockTable.SUPREMUM[held][mode] if held else mode
+        return True
+
+    def _countBlock(self, file_name, target_block, mode):
+        blocks = self.file_blocks.setdefault(file_name, set())
+        blocks.add(target_block)
+        if len(blocks) > ConcurrencyMgr.ESCALATION_THRESHOLD and (mode == 'X' or self.escalate_shared):
+            self._escalate(file_name, mode)
+
+    # Trade the block(and record) locks of a file for a single file lock
+    # S escalation keeps the X locks(the file lock becomes SIX if we were writing), X escalation covers everything
+    def _escalate(self, file_name, mode):
+        self._lock(file_name, mode)
+        blocks = self.file_blocks[file_name]
+        for blk in list(blocks):
+            if mode == 'X' or self.tx_locks[blk] == 'S':
+                ConcurrencyMgr._global_locktable.unlock(blk, self.txnum)
+                del self.tx_locks[blk]
+                blocks.discard(blk)
+        if db_tracer.lock:
+            db_tracer.emit('lock', 'escalate', lambda: {'txnum': self.txnum, 'file': file_name, 'mode': self.tx_locks[file_name]})
+
+
+# Blocks pinned by a transaction
+# A block can be pinned several times(i.e. by two scans), pin_counts keeps how many; the buffer is shared
 class BufferList:
     def __init__(self, bm):
         self.bm = bm
 
         self.block_buffer_map = {}
-        self.block_pin_history = []
+        self.pin_counts = collections.Counter() # block -> number of times this transaction pinned it
 
     def pin(self, target_block):
         buf_ref = self.bm.pin(target_block)
         self.block_buffer_map[target_block] = buf_ref
-        self.block_pin_history.append(target_block)
+        self.pin_counts[target_block] += 1
 
     def unpin(self, target_block):
         self.bm.unpin(self.block_buffer_map[target_block])
-        self.block_pin_history.remove(target_block) # remove the first entry, one instance, of matching block
-        if target_block not in self.block_pin_history:
+        self.pin_counts[target_block] -= 1
+        if not self.pin_counts[target_block]:
+            del self.pin_counts[target_block]
             del self.block_buffer_map[target_block]
 
     def unpinAll(self):
-        for blk in self.block_pin_history:
-            self.bm.unpin(self.block_buffer_map[blk])
+        self.bm.unpinAll([(self.block_buffer_map[blk], count) for blk, count in self.pin_counts.items()])
         self.block_buffer_map.clear()
-        self.block_pin_history.clear()
+        self.pin_counts.clear()
 
     def getBuffer(self, target_block):
         return self.block_buffer_map[target_block]
@@ -475,30 +1283,198 @@ class Transaction:
     # Used together to synchronously increase txnum
     _lock = threading.Lock()
     _next_txnum = 0
-
-    def __init__(self, fm, lm, bm):
+    _retry_stats = {'runs': 0, 'retries': 0, 'failures': 0, 'backoff_time': 0.0}
+
+    # Isolation levels, all of them take X locks until completion
+    #   serializable; S locks until completion, size() locks the end of file so no phantom rows appear
+    #   repeatable read; S locks until completion, but rows appended by others can show up
+    #   read committed; S locks of a block are released once it is unpinned(a scan moved past it)
+    SERIALIZABLE = 'serializable'
+    REPEATABLE_READ = 'repeatable read'
+    READ_COMMITTED = 'read committed'
+
+    # record_locking; RecordPage reads and writes lock single rows instead of whole blocks
+    # snapshot; read-only, takes no locks and reads the database as of its start(see VersionStore)
+    # optimistic; reads like a snapshot, buffers its writes and validates them at commit(see _validateAndWrite)
+    # read_only; locks like any other transaction but rejects writes
+    # Whether declared or not, a transaction that never writes logs nothing and its commit flushes nothing(see RecoveryMgr)
+    # isolation; one of the levels above, only applies to locking transactions
+    # early_lock_release; locks are released once <COMMIT> is in the log buffer, commit returns after the flush
+    # async_commit; like early_lock_release, but commit returns without flushing(a crash can lose the commit)
+    def __init__(self, fm, lm, bm, record_locking=False, snapshot=False, optimistic=False, read_only=False, isolation=SERIALIZABLE,
+                 early_lock_release=False, async_commit=False):
+        if isolation not in (Transaction.SERIALIZABLE, Transaction.REPEATABLE_READ, Transaction.READ_COMMITTED):
+            raise Exception('Unknown isolation level ' + str(isolation) + '.')
         self.fm : FileMgr = fm
         self.lm : LogMgr = lm
         self.bm : BufferMgr = bm
 
         self.txnum = Transaction.get_next_txnum()
-        self.cm : ConcurrencyMgr = ConcurrencyMgr()
+        self.cm : ConcurrencyMgr = ConcurrencyMgr(self.txnum, lambda: self.rm.log_count) # deadlock victim cost
         self.rm : RecoveryMgr = RecoveryMgr(self, self.txnum, self.lm, self.bm) # I am unsure everytime I am using self.tx inside RM
         self.bufferList : BufferList = BufferList(self.bm)
+        self.record_locking = record_locking
+        self.isolation = isolation
+        self.early_lock_release = early_lock_release or async_commit
+        self.async_commit = async_commit
+        self.cm.escalate_shared = isolation != Transaction.READ_COMMITTED
+        self.snapshot = snapshot
+        self.read_only = read_only or snapshot
+        self.optimistic = optimistic
+        self._buffering = optimistic # optimistic writes go to write_set until commit
+        self.read_set = set() # blocks an optimistic transaction read
+        self.write_set = {} # (block, offset) -> (value, okToLog); what optimistic reads see
+        self.write_log = [] # (block, replay) in write order; replay() repeats the buffered write at commit
+        self.pending_marks = {} # block -> {slot: used}; slot header changes of the buffered row inserts and deletes
+        self.private_blocks = set() # blocks whose snapshot page has the transaction's own raw writes(see setRaw)
+        self.buffered_blocks = set() # blocks with field writes in write_set
+        if self.snapshot or self.optimistic:
+            self.snapshot_seq = self.bm.versions.beginSnapshot(lambda: Transaction._backfillVersions(self.lm, self.bm))
+            self.snapshot_lsn = self.bm.versions.commit_lsn # read after the seq; every commit the snapshot sees is at or before it
+            self.snapshot_pages = {} # block -> page as of the snapshot, while the block is pinned
         # Currently there is no system to prevent new transaction to begin during recovery
 
     # Transaction lifespan
+    # Writes become visible to new snapshots before the locks are released
+    # With early lock release the locks go before the flush, so nobody queues behind our disk write
+    #   a transaction granted one of those locks logs its <COMMIT> after ours, flushing its commit flushes ours too
+    #   a read-only one has no <COMMIT>; it flushes up to the commit it depends on instead
+    #   a snapshot sees transactions that completed before it began, it flushes up to their newest <COMMIT>
     def commit(self):
-        self.rm.commit()
-        db_logger.info("Commited " + str(self.txnum))
-        self.cm.release()
-        self.bufferList.unpinAll()
+        if self.optimistic:
+            self._validateAndWrite()
+        commit_lsn = self.rm.commit(flush=not self.early_lock_release)
+        if db_tracer.tx:
+            db_tracer.emit('tx', 'commit', lambda: {'txnum': self.txnum})
+        dependency_lsn = self._complete(commit_lsn if self.early_lock_release else 0)
+        if not self.async_commit:
+            lsn = max(commit_lsn, dependency_lsn)
+            if lsn:
+                self.lm.flushPage(lsn)
+        ConcurrencyMgr._global_locktable.forgetDurable(self.lm.last_saved_lsn)
 
     def rollback(self):
         self.rm.rollback()
-        db_logger.info("Rolled back " + str(self.txnum))
-        self.cm.release()
+        if db_tracer.tx:
+            db_tracer.emit('tx', 'rollback', lambda: {'txnum': self.txnum})
+        self._complete()
+
+    def _complete(self, commit_lsn=0):
+        if self.snapshot or self.optimistic:
+            self.bm.versions.endSnapshot(self.snapshot_seq)
+            self.snapshot_pages.clear()
+        if not self.snapshot:
+            self.bm.versions.complete(self.txnum, commit_lsn)
+        dependency_lsn = self.cm.release(commit_lsn)
+        if self.snapshot or self.optimistic:
+            dependency_lsn = max(dependency_lsn, self.snapshot_lsn)
         self.bufferList.unpinAll()
+        return dependency_lsn
+
+    # Called when the version store starts recording(see VersionStore); its recording flag is already set
+    # A write that checked the flag before it was set finishes under its buffer latch, taking every latch once waits for those
+    # Then the writes of the running transactions are read back from their log chains, under the log lock so none can complete meanwhile
+    #   a transaction that completed before that needs no entries, every snapshot from now on sees its writes
+    @staticmethod
+    def _backfillVersions(lm, bm):
+        for buf in bm.buffer_pool:
+            with buf.latch:
+                pass
+        with lm._lock:
+            for txnum, lsn in RecoveryMgr.activeTransactions(lm).items():
+                writes = []
+                while lsn:
+                    log_data = LogRecord.createLogRecord(lm.readLog(lsn))
+                    op = log_data[0]
+                    if op == LogRecord.START:
+                        break
+                    if op in LogRecord.UPDATES:
+                        writes.extend(reversed(Transaction._overwritten(lm, op, log_data)))
+                    lsn = log_data[-1]
+                bm.versions.addEarlier(txnum, reversed(writes))
+
+    # (block, offset, overwritten bytes or undo(page)) entries of a logged update, in the order the write recorded them
+    @staticmethod
+    def _overwritten(lm, op, log_data):
+        block = Block(log_data[2], log_data[3])
+        if op == LogRecord.FORMATPAGE: # an appended block was empty
+            return [(Block(log_data[2], -1), 0, b''), (block, 0, bytes(lm.file_mgr.block_size))]
+        if op in LogRecord.ROW_OPS:
+            entries = [(block, log_data[4], log_data[5])]
+            mark = LogRecord.slotMark(op, log_data)
+            if mark is not None:
+                slot, used = mark
+                entries.append((block, None, lambda page: SlotHeader.mark(page, slot, not used)))
+            return entries
+        old_val = log_data[5]
+        temp_page = Page(4 if op == LogRecord.SETINT else 4 + len(old_val.encode()))
+        temp_page.setData(0, old_val)
+        return [(block, log_data[4], bytes(temp_page.bb))]
+
+    # Optimistic commit
+    # Lock the blocks we read(S) and the blocks we wrote(X); locks are only held while committing
+    # Validation fails if a transaction that completed after we began wrote one of the blocks we read
+    # Otherwise the buffered writes are replayed as ordinary logged writes
+    def _validateAndWrite(self):
+        written = {entry[0] for entry in self.write_log}
+        for block in sorted(self.read_set | written, key=lambda b: (b.file_name, b.block_number)):
+            if block in written:
+                self.cm.xLock(block)
+            else:
+                self.cm.sLock(block)
+        if self.bm.versions.changedSince(self.read_set, self.snapshot_seq):
+            raise LockAbortException('Tx ' + str(self.txnum) + ' failed validation; data it read was changed by a transaction that committed after it began. Try again.')
+
+        self._buffering = False
+        for block, replay in self.write_log:
+            self.pin(block)
+            replay()
+            self.unpin(block)
+
+    # Transaction runner; runs work(tx) in a new transaction, commits it and returns work's result
+    # An AbortException(deadlock victim, failed validation, full buffer pool) rolls back and runs work again in a new transaction
+    #   before each retry we sleep a random time up to backoff * 2^attempt(capped at max_backoff)
+    #   the randomness spreads out transactions that were aborted together, so they do not collide again right away
+    # Any other exception rolls back and is raised; so is the last AbortException once max_retries is used up
+    # tx_options are passed to Transaction(i.e. optimistic=True)
+    @staticmethod
+    def run(fm, lm, bm, work, max_retries=10, backoff=0.001, max_backoff=0.1, **tx_options):
+        attempt = 0
+        while True:
+            tx = Transaction(fm, lm, bm, **tx_options)
+            try:
+                result = work(tx)
+                tx.commit()
+                Transaction._countRetries(runs=1)
+                return result
+            except AbortException:
+                tx.rollback()
+                if attempt == max_retries:
+                    Transaction._countRetries(runs=1, failures=1)
+                    raise
+            except BaseException:
+                tx.rollback()
+                raise
+            delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+            Transaction._countRetries(retries=1, backoff_time=delay)
+            time.sleep(delay)
+            attempt += 1
+
+    # Retry metrics of Transaction.run since the last reset
+    #   runs; completed calls, retries; extra attempts, failures; calls that gave up, backoff_time; seconds spent sleeping
+    @staticmethod
+    def retryStats(reset=False):
+        with Transaction._lock:
+            stats = dict(Transaction._retry_stats)
+            if reset:
+                Transaction._retry_stats.update(runs=0, retries=0, failures=0, backoff_time=0.0)
+        return stats
+
+    @staticmethod
+    def _countRetries(**increments):
+        with Transaction._lock:
+            for name, increment in increments.items():
+                Transaction._retry_stats[name] += increment
 
     # TODO: Find out what is the idle place/setup to call recover()? Every startup doesn't make much sense.
     # any single transaction can trigger recovery of the entire database - why?
@@ -517,39 +1493,323 @@ class Transaction:
 
     def unpin(self, target_block):
         self.bufferList.unpin(target_block)
+        if target_block not in self.bufferList.block_buffer_map:
+            if (self.snapshot or self.optimistic) and target_block not in self.private_blocks:
+                self.snapshot_pages.pop(target_block, None)
+            elif self.isolation == Transaction.READ_COMMITTED:
+                self.cm.releaseShared(target_block)
 
     # Read and returns value (uses CM for locking)
-    def getInt(self, target_block, block_offset):
-        self.cm.sLock(target_block)
+    # slot is passed by RecordPage; with record locking only that row is locked
+    # Buffer latch keeps the page consistent while transactions holding record locks share it
+    def getInt(self, target_block, block_offset, slot=None):
+        if self.snapshot or self._buffering:
+            return self._versionedRead(target_block, block_offset, False)
+        self._sLock(target_block, slot)
         buf_ref = self.bufferList.getBuffer(target_block) # TODO: this returns None if the block is not pinned by this tx
-        return buf_ref.page.getInt(block_offset)
+        with buf_ref.latch:
+            return buf_ref.page.getInt(block_offset)
+
+    def getString(self, target_block, block_offset, slot=None):
+        if self.snapshot or self._buffering:
+            return self._versionedRead(target_block, block_offset, True)
+        self._sLock(target_block, slot)
+        buf_ref = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            return buf_ref.page.getStr(block_offset)
 
-    def getString(self, target_block, block_offset):
-        self.cm.sLock(target_block)
+    # Read without locking; callers lock(or try to) before relying on the value
+    def peekInt(self, target_block, block_offset):
+        if self.snapshot or self._buffering:
+            return self._versionedRead(target_block, block_offset, False)
         buf_ref = self.bufferList.getBuffer(target_block)
-        return buf_ref.page.getStr(block_offset)
+        with buf_ref.latch:
+            return buf_ref.page.getInt(block_offset)
 
     # Write value (Uses CM for locking and RM for logging)
-    def setInt(self, target_block, block_offset, new_val, okToLog):
-        self.cm.xLock(target_block)
+    def setInt(self, target_block, block_offset, new_val, okToLog, slot=None):
+        if self._buffering:
+            self._buffer(target_block, [(block_offset, new_val)], lambda: self.setInt(target_block, block_offset, new_val, okToLog, slot))
+            return
+        self._xLock(target_block, slot)
         buf_ref: Buffer = self.bufferList.getBuffer(target_block)
-        lsn = -1
-        if okToLog:
-            lsn = self.rm.setInt(buf_ref, block_offset)
-        db_logger.info('Writing int ' + str(new_val) + ' to ' + str(buf_ref.block) + ' at ' + str(block_offset))
-        buf_ref.page.setData(block_offset, new_val)
-        buf_ref.setModified(self.txnum, lsn)
-
-    def setString(self, target_block, block_offset, new_val, okToLog):
-        self.cm.xLock(target_block)
+        with buf_ref.latch:
+            self.bm.versions.record(self.txnum, buf_ref.block, block_offset, bytes(buf_ref.page.bb[block_offset:block_offset + 4]))
+            lsn = -1
+            if okToLog:
+                buf_ref.markDirty(self.lm.current_lsn + 1)
+                lsn = self.rm.setInt(buf_ref, block_offset, new_val)
+            if db_tracer.tx:
+                db_tracer.emit('tx', 'setInt', lambda: {'txnum': self.txnum, 'block': str(buf_ref.block), 'offset': block_offset, 'value': new_val})
+            buf_ref.page.setData(block_offset, new_val)
+            buf_ref.setModified(self.txnum, lsn)
+
+    def setString(self, target_block, block_offset, new_val, okToLog, slot=None):
+        if self._buffering:
+            self._buffer(target_block, [(block_offset, new_val)], lambda: self.setString(target_block, block_offset, new_val, okToLog, slot))
+            return
+        self._xLock(target_block, slot)
+        buf_ref: Buffer = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            self.bm.versions.record(self.txnum, buf_ref.block, block_offset, bytes(buf_ref.page.bb[block_offset:block_offset + 4 + len(new_val.encode())]))
+            lsn = -1
+            if okToLog:
+                buf_ref.markDirty(self.lm.current_lsn + 1)
+                lsn = self.rm.setString(buf_ref, block_offset, new_val)
+            if db_tracer.tx:
+                db_tracer.emit('tx', 'setString', lambda: {'txnum': self.txnum, 'block': str(buf_ref.block), 'offset': block_offset, 'value': new_val})
+            buf_ref.page.setData(block_offset, new_val)
+            buf_ref.setModified(self.txnum, lsn)
+
+    # Physiological write; the fields of one row change under a single lock, latch and log record(see RecordPage)
+    # writes are (offset, int or str) pairs, the record carries the before and after image of the byte range they cover
+    #   a bytes value is written as it is(a whole row encoded by RowCodec), without a length in front
+    # Optimistic transactions buffer the whole row write and replay it at commit
+    def setRow(self, target_block, writes, op, slot=None):
+        if self._buffering:
+            self._buffer(target_block, writes, lambda: self.setRow(target_block, writes, op, slot))
+            if op in (LogRecord.INSERTROW, LogRecord.DELETEROW):
+                self.pending_marks.setdefault(target_block, {})[slot] = op == LogRecord.INSERTROW
+            return
+        start = min(block_offset for block_offset, _ in writes)
+        end = max(block_offset + Transaction._writeLength(new_val) for block_offset, new_val in writes)
+        self._xLock(target_block, slot)
+        buf_ref: Buffer = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            image = Page(bytearray(buf_ref.page.bb[start:end]))
+            for block_offset, new_val in writes:
+                if isinstance(new_val, bytes):
+                    image.bb[block_offset - start:block_offset - start + len(new_val)] = new_val
+                else:
+                    image.setData(block_offset - start, new_val)
+            self._writePieces(buf_ref, start, bytes(image.bb), op, slot)
+        if op == LogRecord.DELETEROW:
+            FreeSpaceMap.markFree(self.bm, target_block, self.txnum)
+
+    # Bytes a setRow value takes in the block
+    @staticmethod
+    def _writeLength(new_val):
+        if isinstance(new_val, int):
+            return 4
+        return len(new_val) if isinstance(new_val, bytes) else 4 + len(new_val.encode())
+
+    # writes; (offset, value) pairs optimistic reads of the block see from now on
+    # A bytes value(a whole row) goes to the transaction's copy of the page instead, the field writes it covers are dropped
+    def _buffer(self, target_block, writes, replay):
+        for block_offset, new_val in writes:
+            if isinstance(new_val, bytes):
+                self._snapshotPage(target_block).bb[block_offset:block_offset + len(new_val)] = new_val
+                self.private_blocks.add(target_block)
+                for key in [key for key in self.write_set if key[0] == target_block and block_offset <= key[1] < block_offset + len(new_val)]:
+                    del self.write_set[key]
+            else:
+                self.write_set[(target_block, block_offset)] = (new_val,)
+                self.buffered_blocks.add(target_block)
+        self.write_log.append((target_block, replay))
+
+    # Page bytes with the buffered field writes that fall in them applied
+    def _overlay(self, target_block, block_offset, data):
+        if target_block not in self.buffered_blocks:
+            return data
+        image = Page(bytearray(data))
+        for (block, write_offset), (new_val,) in self.write_set.items():
+            if block == target_block and block_offset <= write_offset < block_offset + len(data):
+                image.setData(write_offset - block_offset, new_val)
+        return bytes(image.bb[:len(data)])
+
+    # Writes pieces([(offset, bytes)]) of a block as they are, one row record(op) per piece; slotted pages change blocks this way
+    # The block is locked as a whole, rows of a slotted page move around when it is compacted
+    # Optimistic transactions write the pieces to their own copy of the page; validation makes sure the block is still that page at commit
+    def setRaw(self, target_block, pieces, op):
+        if self._buffering:
+            page = self._snapshotPage(target_block)
+            for block_offset, new_bytes in pieces:
+                page.bb[block_offset:block_offset + len(new_bytes)] = new_bytes
+            self.private_blocks.add(target_block)
+            self._buffer(target_block, [], lambda: self.setRaw(target_block, pieces, op))
+            return
+        self._xLock(target_block, None)
+        buf_ref: Buffer = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            for block_offset, new_bytes in pieces:
+                self._writePieces(buf_ref, block_offset, new_bytes, op)
+        if op == LogRecord.DELETEROW:
+            FreeSpaceMap.markFree(self.bm, target_block, self.txnum)
+
+    # Raw bytes of a block; slotted pages read their directory and rows through here, record pages whole rows
+    # Optimistic transactions see their own buffered writes
+    def getBytes(self, target_block, block_offset, length, slot=None):
+        if self.snapshot or self._buffering:
+            data = bytes(self._snapshotPage(target_block).bb[block_offset:block_offset + length])
+            if self._buffering:
+                self.read_set.add(target_block)
+                data = self._overlay(target_block, block_offset, data)
+            return data
+        self._sLock(target_block, slot)
+        buf_ref = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            return bytes(buf_ref.page.bb[block_offset:block_offset + length])
+
+    # Runs read(page bytes) on the block without locking, like peekInt
+    def peekPage(self, target_block, read):
+        if self.snapshot or self._buffering:
+            if self._buffering:
+                self.read_set.add(target_block)
+            return read(self._snapshotPage(target_block).bb)
+        buf_ref = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            return read(buf_ref.page.bb)
+
+    # Locks a block for writing before reading it; a slotted page reads the block it is about to change
+    def xLockBlock(self, target_block):
+        if not self._buffering:
+            self._xLock(target_block, None)
+
+    # Page level operation for a block that was just appended; zeroes the whole page with a single <FORMATPAGE> record
+    # An optimistic transaction has nothing to buffer, the appended block is already empty
+    #   it still goes on the free space map right away; if the transaction fails validation the block stays empty
+    def formatPage(self, target_block):
+        if self._buffering:
+            FreeSpaceMap.markFree(self.bm, target_block, self.txnum)
+            return
+        self._xLock(target_block, None)
+        buf_ref: Buffer = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            self.bm.versions.record(self.txnum, buf_ref.block, 0, bytes(buf_ref.page.bb))
+            buf_ref.markDirty(self.lm.current_lsn + 1)
+            lsn = self.rm.formatPage(buf_ref)
+            buf_ref.page.bb[:] = bytes(self.fm.block_size)
+            buf_ref.setModified(self.txnum, lsn)
+        FreeSpaceMap.markFree(self.bm, target_block, self.txnum)
+
+    # Writes raw bytes; rolling back a row record writes its before image back through here
+    def setBytes(self, target_block, block_offset, new_bytes, okToLog, slot=None, op=LogRecord.UPDATEROW):
+        self._xLock(target_block, slot)
         buf_ref: Buffer = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            self._writeBytes(buf_ref, block_offset, new_bytes, op, okToLog, slot)
+        if op == LogRecord.DELETEROW: # rolling back an insert frees the slot as well
+            FreeSpaceMap.markFree(self.bm, target_block, self.txnum)
+
+    # Called with the buffer latch held
+    # Inserts and deletes also set or clear the slot's bit in the page header; the header's before image is kept for snapshots
+    # A row image too large for one log block is written as several row records, each with both images of its part
+    #   every part carries the slot; marking the slot header is idempotent
+    def _writePieces(self, buf_ref, block_offset, new_bytes, op, slot=None):
+        limit = (self.fm.block_size - 48 - len(buf_ref.block.file_name.encode())) // 2 # both images of a piece fit in one log block
+        for start in range(0, len(new_bytes), limit):
+            self._writeBytes(buf_ref, block_offset + start, new_bytes[start:start + limit], op, True, slot)
+
+    def _writeBytes(self, buf_ref, block_offset, new_bytes, op, okToLog, slot=None):
+        old_bytes = bytes(buf_ref.page.bb[block_offset:block_offset + len(new_bytes)])
+        self.bm.versions.record(self.txnum, buf_ref.block, block_offset, old_bytes)
         lsn = -1
         if okToLog:
-            lsn = self.rm.setString(buf_ref, block_offset)
-        db_logger.info('Writing str ' + str(new_val) + ' to ' + str(buf_ref.block) + ' at ' + str(block_offset))
-        buf_ref.page.setData(block_offset, new_val)
+            buf_ref.markDirty(self.lm.current_lsn + 1)
+            lsn = self.rm.setBytes(buf_ref, block_offset, old_bytes, new_bytes, op, slot)
+        if db_tracer.tx:
+            db_tracer.emit('tx', 'setBytes', lambda: {'txnum': self.txnum, 'block': str(buf_ref.block), 'offset': block_offset, 'length': len(new_bytes)})
+        buf_ref.page.bb[block_offset:block_offset + len(new_bytes)] = new_bytes
+        if slot is not None and op in (LogRecord.INSERTROW, LogRecord.DELETEROW):
+            # the header is shared by the rows of the block(record locking lets several transactions change it), so
+            #   snapshots put back only this slot's bit and its share of the count, never bytes of the header
+            was_used = SlotHeader.isUsed(buf_ref.page, slot)
+            self.bm.versions.recordUndo(self.txnum, buf_ref.block, lambda page: SlotHeader.mark(page, slot, was_used))
+            SlotHeader.mark(buf_ref.page, slot, op == LogRecord.INSERTROW)
         buf_ref.setModified(self.txnum, lsn)
 
+    # Slot header of a record page(see SlotHeader); (bitmap, used count) read without locking, like peekInt
+    # Optimistic transactions see their own buffered inserts and deletes
+    def peekSlots(self, target_block, slot_count):
+        if self.snapshot or self._buffering:
+            if self._buffering:
+                self.read_set.add(target_block)
+            bits, used = SlotHeader.read(self._snapshotPage(target_block), slot_count)
+            for slot, in_use in self.pending_marks.get(target_block, {}).items():
+                if bool(bits >> slot & 1) != in_use:
+                    bits ^= 1 << slot
+                    used += 1 if in_use else -1
+            return bits, used
+        buf_ref = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            return SlotHeader.read(buf_ref.page, slot_count)
+
+    # Free space map(see FreeSpaceMap); next block of file_name after block_number that may have an empty slot, -1 if none
+    def nextFreeBlock(self, file_name, block_number):
+        return FreeSpaceMap.nextFree(self.bm, file_name, block_number, self.size(file_name), self.txnum)
+
+    # The block gave back room without freeing a slot(a slotted record shrank); puts it on the free space map
+    def markFree(self, target_block):
+        FreeSpaceMap.markFree(self.bm, target_block, self.txnum)
+
+    # An insert found no slot it could claim in the block; it leaves the free space map only if it is really full
+    # full(page) tells, under the block's latch, whether the page has no room left for a row
+    def markFull(self, target_block, full):
+        fsm_buf = FreeSpaceMap.pinFor(self.bm, target_block)
+        if fsm_buf is None:
+            return
+        buf_ref = self.bufferList.getBuffer(target_block)
+        with buf_ref.latch:
+            if full(buf_ref.page):
+                FreeSpaceMap.markFull(fsm_buf, target_block, self.txnum)
+        self.bm.unpin(fsm_buf)
+
+    # Bitmap of the slots a scan has to look at; it still reads each of their flags under a lock
+    # With block locks the bitmap is read under the block's S lock, so it is exact
+    # With record locking a clear bit may be a delete that has not committed; rows others have locked are looked at too
+    #   and a serializable scan looks at every slot, the row locks it takes on empty slots keep inserts(phantoms) out
+    def scanSlots(self, target_block, slot_count):
+        if self.snapshot or self._buffering:
+            return self.peekSlots(target_block, slot_count)[0]
+        if not self.record_locking:
+            self.cm.sLock(target_block)
+            return self.peekSlots(target_block, slot_count)[0]
+        if self.isolation == Transaction.SERIALIZABLE:
+            return (1 << slot_count) - 1
+        bits = self.peekSlots(target_block, slot_count)[0] # before the lock table; a delete clears its bit only once it holds the row lock
+        return bits | ConcurrencyMgr._global_locktable.lockedRows(target_block)
+
+    # Claim a row for an insert without waiting; False if another transaction has it locked
+    def tryXLockRecord(self, target_block, slot):
+        if self._buffering: # conflicting inserts are caught by validation
+            return True
+        if self.snapshot or not self.record_locking:
+            self._xLock(target_block, None)
+            return True
+        return self.cm.tryXLockRecord(target_block, slot)
+
+    # Snapshot and optimistic reads; optimistic ones see their own buffered writes and remember the block
+    def _versionedRead(self, target_block, block_offset, str_val):
+        if self._buffering:
+            pending = self.write_set.get((target_block, block_offset))
+            if pending:
+                return pending[0]
+            self.read_set.add(target_block)
+        page = self._snapshotPage(target_block)
+        return page.getStr(block_offset) if str_val else page.getInt(block_offset)
+
+    def _snapshotPage(self, target_block):
+        page = self.snapshot_pages.get(target_block)
+        if page is None:
+            buf_ref = self.bufferList.getBuffer(target_block)
+            with buf_ref.latch:
+                page = self.snapshot_pages[target_block] = self.bm.versions.read(buf_ref, self.snapshot_seq)
+        return page
+
+    def _sLock(self, target_block, slot):
+        if slot is not None and self.record_locking:
+            self.cm.sLockRecord(target_block, slot)
+        else:
+            self.cm.sLock(target_block)
+
+    def _xLock(self, target_block, slot):
+        if self.read_only:
+            raise Exception('Tx ' + str(self.txnum) + ' is read-only.')
+        if slot is not None and self.record_locking:
+            self.cm.xLockRecord(target_block, slot)
+        else:
+            self.cm.xLock(target_block)
+
     # Transaction file manager access
     # Why we need file access? Can't we make all update through buffer
     def availableBuffers(self):
@@ -559,12 +1819,18 @@ class Transaction:
     # TODO: Size/append obtains a lock on Block(-1); but when it is being added to the list of buffers associated with a transactions?
     def size(self, filename):
         """call fm.length() that returns block count of a file. Acquires lock on dummy block"""
-        self.cm.sLock(Block(filename, -1))
+        if self.optimistic:
+            self.read_set.add(Block(filename, -1))
+        elif not self.snapshot and self.isolation == Transaction.SERIALIZABLE: # blocks appended after the snapshot look empty to it
+            self.cm.sLock(Block(filename, -1))
         return self.fm.length(filename)
 
     # returns the new block references
+    # Appending counts as a write to the end of file marker, so optimistic transactions that read the size see it
+    # Optimistic transactions append right away under an X lock, only the new block's content is buffered
     def append(self, filename):
-        self.cm.xLock(Block(filename, -1))
+        self._xLock(Block(filename, -1), None)
+        self.bm.versions.record(self.txnum, Block(filename, -1), 0, b'')
         return self.fm.appendEmptyBlock(filename)
 
     def blockSize(self):
@@ -0,0 +1,820 @@
+# Micro benchmarks for the storage, log and transaction layers
+# Each benchmark runs against a throw away database inside a temp directory
+#   python benchmark.py                 run every benchmark
+#   python benchmark.py log_iter        run the named benchmark(s) only
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import random
+import threading
+import contextlib
+
+from Planner import *
+
+
+# FileMgr changes the working directory into the db folder; we undo that once the benchmark is done
+@contextlib.contextmanager
+def tempDB(block_size=400, buffer_pool_size=8):
+    cwd = os.getcwd()
+    temp_dir = tempfile.mkdtemp()
+    os.chdir(temp_dir)
+    try:
+        fm = FileMgr('benchdb', block_size)
+        lm = LogMgr(fm, 'benchdb.log')
+        bm = BufferMgr(fm, lm, buffer_pool_size)
+        yield fm, lm, bm
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(temp_dir)
+
+
+def report(name, count, elapsed, unit='records'):
+    print('%-45s %10d %s in %7.3fs  %12.0f %s/sec' % (name, count, unit, elapsed, count / elapsed, unit))
+
+
+# Log iteration throughput; batch of one block emulates the old one readBlockToPage per block iterator
+def log_iter(record_count=200000):
+    with tempDB() as (fm, lm, bm):
+        for i in range(record_count):
+            LogRecord.writeToLog(lm=lm, op=LogRecord.START, txnum=i)
+
+        for batch in (1, LogIter.BATCH_BLOCKS):
+            saved, LogIter.BATCH_BLOCKS = LogIter.BATCH_BLOCKS, batch
+            start = time.time()
+            count = sum(1 for _ in lm.iterator())
+            report('log backward, %d block(s) per read' % batch, count, time.time() - start)
+
+            start = time.time()
+            count = sum(1 for _ in lm.iterator(forward=True))
+            report('log forward, %d block(s) per read' % batch, count, time.time() - start)
+            LogIter.BATCH_BLOCKS = saved
+
+        # start from the middle of the log
+        middle_lsn = None
+        for i, (lsn, _) in enumerate(lm.iterator(with_lsn=True)):
+            if i == record_count // 2:
+                middle_lsn = lsn
+                break
+        start = time.time()
+        count = sum(1 for _ in lm.iterator(start_lsn=middle_lsn, forward=True))
+        report('log forward from middle lsn', count, time.time() - start)
+
+
+# Transactions updating blocks_per_tx blocks each; commit only flushes the log
+def commit_latency(tx_count=2000, blocks_per_tx=4):
+    with tempDB(buffer_pool_size=16) as (fm, lm, bm):
+        blocks = [Block('bench', i) for i in range(blocks_per_tx)]
+        start = time.time()
+        for i in range(tx_count):
+            tx = Transaction(fm, lm, bm)
+            for blk in blocks:
+                tx.pin(blk)
+                tx.setInt(blk, 0, i, True)
+            tx.commit()
+        report('commit, %d dirty blocks per tx' % blocks_per_tx, tx_count, time.time() - start, 'commits')
+
+
+# Rollback of a tx with a few updates while another tx floods the log in between
+# Rollback follows the tx's own prev_lsn chain, so its cost should stay flat as the unrelated traffic grows
+def rollback_chain(update_count=20, unrelated_counts=(0, 10000, 100000)):
+    for unrelated_count in unrelated_counts:
+        with tempDB(buffer_pool_size=16) as (fm, lm, bm):
+            blk, other_blk = Block('bench', 0), Block('bench', 1)
+            tx, other_tx = Transaction(fm, lm, bm), Transaction(fm, lm, bm)
+            tx.pin(blk)
+            other_tx.pin(other_blk)
+            per_gap = unrelated_count // update_count
+            for i in range(update_count):
+                tx.setInt(blk, 4 * i, i, True)
+                for j in range(per_gap):
+                    other_tx.setInt(other_blk, 0, j, True)
+
+            start = time.time()
+            tx.rollback()
+            report('rollback, %d unrelated records in between' % unrelated_count, update_count, time.time() - start, 'undos')
+            other_tx.commit()
+
+
+# Recovery of a log full of updates from transactions that never committed
+# The crash is simulated by dropping the log and buffer managers without flushing the buffers
+def recovery(update_count=1000000, block_count=500, tx_count=10):
+    with tempDB(block_size=4096, buffer_pool_size=64) as (fm, lm, bm):
+        txs = [Transaction(fm, lm, bm) for _ in range(tx_count)]
+        blocks = [Block('bench', i) for i in range(block_count)]
+        for i in range(update_count):
+            tx, blk = txs[i % tx_count], blocks[(i * 7) % block_count]
+            buf = bm.pin(blk)
+            tx.rm.setInt(buf, (i % 1000) * 4, i)
+            bm.unpin(buf)
+        lm.flushPage()
+        shutil.copy('benchdb.log', 'crash.log')
+
+        for workers in (1, RecoveryMgr.RECOVERY_WORKERS):
+            ConcurrencyMgr._global_locktable = LockTable()
+            saved, RecoveryMgr.RECOVERY_WORKERS = RecoveryMgr.RECOVERY_WORKERS, workers
+            # every run recovers the same log; drop the previous recovery's records
+            shutil.copy('crash.log', 'benchdb.log')
+            crash_lm = LogMgr(fm, 'benchdb.log')
+            crash_bm = BufferMgr(fm, crash_lm, 64)
+            start = time.time()
+            Transaction(fm, crash_lm, crash_bm).recover()
+            report('recovery, %d worker(s)' % workers, update_count, time.time() - start, 'updates')
+            RecoveryMgr.RECOVERY_WORKERS = saved
+
+
+# Restart after a crash has to recover from the last checkpoint; after an orderly shutdown it only reads the last log record
+def startup(tx_counts=(1000, 10000, 50000)):
+    for tx_count in tx_counts:
+        with tempDB(buffer_pool_size=16) as (fm, lm, bm):
+            blocks = [Block('bench', i) for i in range(8)]
+            for i in range(tx_count):
+                tx = Transaction(fm, lm, bm)
+                tx.pin(blocks[i % 8])
+                tx.setInt(blocks[i % 8], 0, i, True)
+                tx.commit()
+            shutil.copy('benchdb.log', 'crash.log')
+
+            start = time.time()
+            restart_lm = LogMgr(fm, 'crash.log')
+            Transaction(fm, restart_lm, BufferMgr(fm, restart_lm, 16)).recover()
+            report('startup after crash, %d txs in log' % tx_count, 1, time.time() - start, 'startups')
+
+            RecoveryMgr.shutdown(lm, bm)
+            start = time.time()
+            restart_lm = LogMgr(fm, 'benchdb.log')
+            if not RecoveryMgr.isCleanShutdown(restart_lm):
+                Transaction(fm, restart_lm, BufferMgr(fm, restart_lm, 16)).recover()
+            report('startup after clean shutdown, %d txs in log' % tx_count, 1, time.time() - start, 'startups')
+
+
+# Threads running short transactions against the lock table only; block i is picked with probability skewed toward 0
+# Each tx locks its blocks in block order(no deadlocks), a third of them exclusively
+def lock_throughput(thread_count=8, tx_per_thread=2000, locks_per_tx=4, block_count=1000):
+    ConcurrencyMgr._global_locktable = LockTable()
+    blocks = [Block('bench', i) for i in range(block_count)]
+    counter = iter(range(1, thread_count * tx_per_thread + 1))
+    counter_lock = threading.Lock()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        for _ in range(tx_per_thread):
+            with counter_lock:
+                txnum = next(counter)
+            cm = ConcurrencyMgr(txnum)
+            picked = sorted({int(block_count * rnd.random() ** 4) for _ in range(locks_per_tx)})
+            for b in picked:
+                if rnd.random() < 0.33:
+                    cm.xLock(blocks[b])
+                else:
+                    cm.sLock(blocks[b])
+            cm.release()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    report('lock throughput, %d threads, skewed' % thread_count, thread_count * tx_per_thread, time.time() - start, 'txs')
+
+
+# Pairs of transactions locking two blocks in opposite order; every round is a deadlock
+# Reports how long it takes until the victim is aborted and the survivor commits
+def deadlock(rounds=1000):
+    locktable = ConcurrencyMgr._global_locktable = LockTable()
+    a, b = Block('bench', 0), Block('bench', 1)
+    start = time.time()
+    for i in range(rounds):
+        first, second = ConcurrencyMgr(2 * i + 1, lambda: 10), ConcurrencyMgr(2 * i + 2, lambda: 1)
+        first.xLock(a)
+        second.xLock(b)
+        t = threading.Thread(target=first.xLock, args=(b,))
+        t.start()
+        while 2 * i + 1 not in locktable._waits_for:
+            time.sleep(0)
+        try:
+            second.xLock(a) # closes the cycle; second has written less so it is the victim
+        except Exception:
+            second.release()
+        t.join()
+        first.release()
+    elapsed = time.time() - start
+    report('deadlock resolution', rounds, elapsed, 'deadlocks')
+    stats = locktable.stats()
+    print('%-45s %10d deadlocks, avg detection %.1fus, worst %.1fus' % ('lock table stats', stats['deadlocks'], 1e6 * stats['detection_time'] / max(1, stats['deadlocks']), 1e6 * stats['max_detection_time']))
+
+
+# A full scan reading block_count blocks of one file; with escalation it ends up holding one file lock
+def scan_locks(block_count=10000):
+    for threshold in (block_count + 1, ConcurrencyMgr.ESCALATION_THRESHOLD):
+        locktable = ConcurrencyMgr._global_locktable = LockTable()
+        saved, ConcurrencyMgr.ESCALATION_THRESHOLD = ConcurrencyMgr.ESCALATION_THRESHOLD, threshold
+        cm = ConcurrencyMgr(1)
+        start = time.time()
+        for i in range(block_count):
+            cm.sLock(Block('bench', i))
+        elapsed = time.time() - start
+        held = len(locktable._queues)
+        cm.release()
+        report('scan locking, escalation after %d blocks' % threshold, block_count, elapsed, 'blocks')
+        print('%-45s %10d locks held at the end of the scan' % ('', held))
+        ConcurrencyMgr.ESCALATION_THRESHOLD = saved
+
+
+# Threads updating their own row of a single block table; with block locks they queue behind each other's commit
+def row_updates(thread_count=8, tx_per_thread=300):
+    layout = Layout(Schema(['id', 'int', 4], ['val', 'int', 4]))
+    for record_locking in (False, True):
+        with tempDB(buffer_pool_size=16) as (fm, lm, bm):
+            ConcurrencyMgr._global_locktable = LockTable()
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'hot', layout)
+            for i in range(thread_count):
+                ts.insert()
+                ts.setInt('id', i)
+            ts.closeRecordPage()
+            tx.commit()
+
+            aborts = []
+
+            # read then write the same row; two block lock holders upgrading to X is a deadlock, the victim retries
+            def worker(row):
+                done = 0
+                while done < tx_per_thread:
+                    tx = Transaction(fm, lm, bm, record_locking)
+                    try:
+                        ts = TableScan(tx, 'hot', layout)
+                        ts.moveToRecordID(RecordID(0, row))
+                        ts.setInt('val', ts.getInt('val') + 1)
+                        ts.closeRecordPage()
+                        tx.commit()
+                        done += 1
+                    except Exception:
+                        tx.rollback()
+                        aborts.append(row)
+
+            threads = [threading.Thread(target=worker, args=(row,)) for row in range(thread_count)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            report('row updates, %s locks, %d threads' % ('record' if record_locking else 'block', thread_count), thread_count * tx_per_thread, time.time() - start, 'txs')
+            print('%-45s %10d deadlock aborts' % ('', len(aborts)))
+
+
+# Writers increment random rows while readers sum the whole table, for a fixed time
+# 2PL readers lock every block they scan(a single file lock after escalation), snapshot readers lock nothing
+def mixed_workload(writer_count=4, reader_count=2, row_count=5000, seconds=3.0):
+    layout = Layout(Schema(['id', 'int', 4], ['val', 'int', 4]))
+    for snapshot in (False, True):
+        with tempDB(buffer_pool_size=32) as (fm, lm, bm):
+            ConcurrencyMgr._global_locktable = LockTable()
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'acct', layout)
+            for i in range(row_count):
+                ts.insert()
+                ts.setInt('id', i)
+            rows = []
+            ts.beforeFirst()
+            while ts.nextRecord():
+                rows.append(ts.currentRecordID())
+            ts.closeRecordPage()
+            tx.commit()
+
+            stop = time.time() + seconds
+            writes, scans, aborts = [], [], []
+
+            def writer(seed):
+                rnd = random.Random(seed)
+                while time.time() < stop:
+                    tx = Transaction(fm, lm, bm)
+                    try:
+                        ts = TableScan(tx, 'acct', layout)
+                        ts.moveToRecordID(rnd.choice(rows))
+                        ts.setInt('val', ts.getInt('val') + 1)
+                        ts.closeRecordPage()
+                        tx.commit()
+                        writes.append(1)
+                    except Exception:
+                        tx.rollback()
+                        aborts.append(1)
+
+            def reader():
+                while time.time() < stop:
+                    tx = Transaction(fm, lm, bm, snapshot=snapshot)
+                    try:
+                        ts = TableScan(tx, 'acct', layout)
+                        total = 0
+                        while ts.nextRecord():
+                            total += ts.getInt('val')
+                        ts.closeRecordPage()
+                        tx.commit()
+                        scans.append(total)
+                    except Exception:
+                        tx.rollback()
+                        aborts.append(1)
+
+            threads = [threading.Thread(target=writer, args=(i,)) for i in range(writer_count)]
+            threads += [threading.Thread(target=reader) for _ in range(reader_count)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            mode = 'snapshot' if snapshot else '2PL'
+            report('mixed, writers, %s readers' % mode, len(writes), seconds, 'txs')
+            report('mixed, full scans, %s readers' % mode, len(scans), seconds, 'scans')
+            print('%-45s %10d aborts' % ('', len(aborts)))
+
+
+# Each transaction increments two random rows; fewer rows means more transactions touch the same blocks
+# 2PL waits for locks(and retries deadlock victims), OCC runs lock free and retries when commit fails validation
+def occ_vs_2pl(thread_count=8, tx_per_thread=200, row_counts=(3000, 300, 30)):
+    layout = Layout(Schema(['id', 'int', 4], ['val', 'int', 4]))
+    for row_count in row_counts:
+        for optimistic in (False, True):
+            with tempDB(buffer_pool_size=32) as (fm, lm, bm):
+                ConcurrencyMgr._global_locktable = LockTable()
+                tx = Transaction(fm, lm, bm)
+                ts = TableScan(tx, 'counters', layout)
+                for i in range(row_count):
+                    ts.insert()
+                    ts.setInt('id', i)
+                ts.closeRecordPage()
+                tx.commit()
+                slots_per_block = layout.slotsPerBlock(tx.blockSize())
+
+                aborts = []
+
+                def worker():
+                    done = 0
+                    while done < tx_per_thread:
+                        rows = random.sample(range(row_count), 2)
+                        tx = Transaction(fm, lm, bm, optimistic=optimistic)
+                        try:
+                            ts = TableScan(tx, 'counters', layout)
+                            for row in rows:
+                                ts.moveToRecordID(RecordID(row // slots_per_block, row % slots_per_block))
+                                ts.setInt('val', ts.getInt('val') + 1)
+                            ts.closeRecordPage()
+                            tx.commit()
+                            done += 1
+                        except Exception:
+                            tx.rollback()
+                            aborts.append(1)
+
+                threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+                start = time.time()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                report('%s, %d rows' % ('OCC' if optimistic else '2PL', row_count), thread_count * tx_per_thread, time.time() - start, 'txs')
+                print('%-45s %10d aborts' % ('', len(aborts)))
+
+
+# One row per transaction, the way a stream of SELECT ... WHERE id = x runs
+# A transaction that only reads writes no <START>/<COMMIT> and never flushes the log
+def point_reads(query_count=20000, row_count=1000):
+    layout = Layout(Schema(['id', 'int', 4], ['val', 'int', 4]))
+    with tempDB(buffer_pool_size=32) as (fm, lm, bm):
+        tx = Transaction(fm, lm, bm)
+        ts = TableScan(tx, 'points', layout)
+        for i in range(row_count):
+            ts.insert()
+            ts.setInt('id', i)
+        ts.closeRecordPage()
+        tx.commit()
+        slots_per_block = layout.slotsPerBlock(tx.blockSize())
+
+        for read_only in (False, True):
+            log_start = lm.current_lsn
+            start = time.time()
+            for _ in range(query_count):
+                row = random.randrange(row_count)
+                tx = Transaction(fm, lm, bm, read_only=read_only)
+                ts = TableScan(tx, 'points', layout)
+                ts.moveToRecordID(RecordID(row // slots_per_block, row % slots_per_block))
+                ts.getInt('val')
+                ts.closeRecordPage()
+                tx.commit()
+            report('point reads%s' % (', declared read-only' if read_only else ''), query_count, time.time() - start, 'txs')
+            print('%-45s %10d log bytes' % ('', lm.current_lsn - log_start))
+
+
+# A reader keeps scanning the whole table while writers update random rows, for a fixed time
+# Serializable and repeatable read scans hold their S locks(one file lock after escalation) until they commit,
+# read committed scans only hold the block they are on
+def isolation_levels(writer_count=4, row_count=5000, seconds=3.0):
+    layout = Layout(Schema(['id', 'int', 4], ['val', 'int', 4]))
+    for isolation in (Transaction.SERIALIZABLE, Transaction.REPEATABLE_READ, Transaction.READ_COMMITTED):
+        with tempDB(buffer_pool_size=32) as (fm, lm, bm):
+            ConcurrencyMgr._global_locktable = LockTable()
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'report', layout)
+            for i in range(row_count):
+                ts.insert()
+                ts.setInt('id', i)
+            ts.closeRecordPage()
+            tx.commit()
+            slots_per_block = layout.slotsPerBlock(tx.blockSize())
+
+            stop = threading.Event()
+            counts = {'writes': 0, 'scans': 0, 'aborts': 0}
+
+            def writer():
+                while not stop.is_set():
+                    row = random.randrange(row_count)
+                    tx = Transaction(fm, lm, bm)
+                    try:
+                        ts = TableScan(tx, 'report', layout)
+                        ts.moveToRecordID(RecordID(row // slots_per_block, row % slots_per_block))
+                        ts.setInt('val', ts.getInt('val') + 1)
+                        ts.closeRecordPage()
+                        tx.commit()
+                        counts['writes'] += 1
+                    except Exception:
+                        tx.rollback()
+                        counts['aborts'] += 1
+
+            def reader():
+                while not stop.is_set():
+                    tx = Transaction(fm, lm, bm, isolation=isolation)
+                    try:
+                        ts = TableScan(tx, 'report', layout)
+                        while ts.nextRecord():
+                            ts.getInt('val')
+                        ts.closeRecordPage()
+                        tx.commit()
+                        counts['scans'] += 1
+                    except Exception:
+                        tx.rollback()
+                        counts['aborts'] += 1
+
+            threads = [threading.Thread(target=writer) for _ in range(writer_count)] + [threading.Thread(target=reader)]
+            for t in threads:
+                t.start()
+            time.sleep(seconds)
+            stop.set()
+            for t in threads:
+                t.join()
+            report('%s, writes' % isolation, counts['writes'], seconds, 'txs')
+            report('%s, scans' % isolation, counts['scans'], seconds, 'scans')
+            print('%-45s %10d deadlock aborts' % ('', counts['aborts']))
+
+
+# Every transaction increments one of a few hot rows; with strict commits the next updater waits for our log flush
+# Early lock release lets it run during the flush, async commit skips the wait for the flush altogether
+def hot_rows(thread_count=8, tx_per_thread=500, hot_count=2):
+    layout = Layout(Schema(['id', 'int', 4], ['val', 'int', 4]))
+    for label, options in (('strict', {}), ('early lock release', {'early_lock_release': True}), ('async commit', {'async_commit': True})):
+        with tempDB(buffer_pool_size=16) as (fm, lm, bm):
+            ConcurrencyMgr._global_locktable = LockTable()
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'hot', layout)
+            for i in range(hot_count):
+                ts.insert()
+                ts.setInt('id', i)
+            ts.closeRecordPage()
+            tx.commit()
+
+            aborts = []
+
+            def worker():
+                done = 0
+                while done < tx_per_thread:
+                    tx = Transaction(fm, lm, bm, record_locking=True, **options)
+                    try:
+                        ts = TableScan(tx, 'hot', layout)
+                        slot = random.randrange(hot_count)
+                        ts.moveToRecordID(RecordID(0, slot))
+                        tx.cm.xLockRecord(ts.rp.blk, slot) # select for update; two readers upgrading would deadlock
+                        ts.setInt('val', ts.getInt('val') + 1)
+                        ts.closeRecordPage()
+                        tx.commit()
+                        done += 1
+                    except Exception:
+                        tx.rollback()
+                        aborts.append(1)
+
+            threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            report('hot rows, %s' % label, thread_count * tx_per_thread, time.time() - start, 'txs')
+            print('%-45s %10d aborts' % ('', len(aborts)))
+
+
+# A burst of threads read and then update the same few rows; two readers upgrading to X is a deadlock
+# Transaction.run retries the victims; without backoff they rerun immediately and tend to collide again
+def retry_backoff(thread_count=16, tx_per_thread=100, row_count=4):
+    layout = Layout(Schema(['id', 'int', 4], ['val', 'int', 4]))
+    for backoff in (0, 0.001):
+        with tempDB(buffer_pool_size=32) as (fm, lm, bm):
+            ConcurrencyMgr._global_locktable = LockTable()
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'burst', layout)
+            for i in range(row_count):
+                ts.insert()
+                ts.setInt('id', i)
+            ts.closeRecordPage()
+            tx.commit()
+            Transaction.retryStats(reset=True)
+
+            def increment(tx):
+                ts = TableScan(tx, 'burst', layout)
+                ts.moveToRecordID(RecordID(0, random.randrange(row_count)))
+                ts.setInt('val', ts.getInt('val') + 1)
+                ts.closeRecordPage()
+
+            latencies = []
+
+            def worker():
+                for _ in range(tx_per_thread):
+                    start = time.time()
+                    Transaction.run(fm, lm, bm, increment, max_retries=1000, backoff=backoff, record_locking=True)
+                    latencies.append(time.time() - start)
+
+            threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            stats = Transaction.retryStats()
+            latencies.sort()
+            report('burst, %s' % ('jittered backoff' if backoff else 'no backoff'), stats['runs'], time.time() - start, 'txs')
+            print('%-45s %10d retries, %.1fms p99, %.1fms max latency' % ('', stats['retries'], latencies[len(latencies) * 99 // 100] * 1000, latencies[-1] * 1000))
+
+
+# One transaction pinning blocks; every block is pinned twice(a scan and a lookup), one pin is dropped right away
+# and the other stays until commit, which drops them all at once
+#   100k pins over the 64 blocks of the pool; the pins held at commit pile up on a few blocks
+#   distinct blocks; every block is pinned by a buffer of its own(the pool is as large as the blocks), the transaction holds all of them
+def pin_bookkeeping(pin_count=100000, buffer_pool_size=64, distinct_blocks=2000):
+    for label, block_numbers, pool_size in (('%d pins over %d blocks' % (pin_count, buffer_pool_size), [i % buffer_pool_size for i in range(pin_count)], buffer_pool_size),
+                                            ('%d distinct blocks' % distinct_blocks, range(distinct_blocks), distinct_blocks)):
+        with tempDB(buffer_pool_size=pool_size) as (fm, lm, bm):
+            tx = Transaction(fm, lm, bm)
+            blocks = [Block('pins', i) for i in block_numbers]
+            start = time.time()
+            for blk in blocks:
+                tx.pin(blk)
+                tx.pin(blk)
+            pinned = time.time()
+            for blk in blocks:
+                tx.unpin(blk)
+            unpinned = time.time()
+            tx.commit()
+            report('%s, pin' % label, len(blocks) * 2, pinned - start, 'pins')
+            report('%s, unpin' % label, len(blocks), unpinned - pinned, 'unpins')
+            report('%s, commit(bulk unpin)' % label, len(blocks), time.time() - unpinned, 'pins')
+
+
+# Inserting rows of a 10 column table; field by field(one log record per field) vs a whole row(a single insert row record)
+def wide_inserts(row_count=20000):
+    fields = [('c%d' % i, 'int', 4) if i % 2 else ('c%d' % i, 'str', 8) for i in range(10)]
+    layout = Layout(Schema(*fields))
+    row = {name: (i if field_type == 'int' else 'v%d' % i) for i, (name, field_type, _) in enumerate(fields)}
+    for by_row in (False, True):
+        with tempDB(block_size=4096, buffer_pool_size=32) as (fm, lm, bm):
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'wide', layout)
+            log_start = lm.current_lsn
+            start = time.time()
+            for _ in range(row_count):
+                if by_row:
+                    ts.insert(row)
+                else:
+                    ts.insert()
+                    for name, val in row.items():
+                        if isinstance(val, int):
+                            ts.setInt(name, val)
+                        else:
+                            ts.setString(name, val)
+            ts.closeRecordPage()
+            tx.commit()
+            report('10 column inserts, %s' % ('by row' if by_row else 'by field'), row_count, time.time() - start, 'rows')
+            print('%-45s %10d log bytes/row' % ('', (lm.current_lsn - log_start) // row_count))
+
+
+# Bulk insert into a narrow table; a new block is formatted every few hundred rows
+def table_growth(row_count=50000, block_size=4096):
+    layout = Layout(Schema(['a', 'int', 4], ['b', 'str', 4]))
+    with tempDB(block_size=block_size, buffer_pool_size=32) as (fm, lm, bm):
+        tx = Transaction(fm, lm, bm)
+        ts = TableScan(tx, 'growth', layout)
+        start = time.time()
+        for i in range(row_count):
+            ts.insert({'a': i, 'b': 'x'})
+        ts.closeRecordPage()
+        tx.commit()
+        report('narrow inserts, %d blocks' % fm.length('growth.tbl'), row_count, time.time() - start, 'rows')
+
+
+# Scanning a table after 95% of its rows were deleted, and filling the last free slot of every block of a full table
+# Both only visit the slots the page header bitmap points at
+def sparse_tables(block_count=200, block_size=4096):
+    layout = Layout(Schema(['a', 'int', 4], ['b', 'str', 4]))
+    row_count = block_count * layout.slotsPerBlock(block_size)
+    with tempDB(block_size=block_size, buffer_pool_size=32) as (fm, lm, bm):
+        tx = Transaction(fm, lm, bm)
+        ts = TableScan(tx, 'sparse', layout)
+        for i in range(row_count):
+            ts.insert({'a': i, 'b': 'x'})
+        ts.beforeFirst()
+        while ts.nextRecord():
+            if ts.getInt('a') % 20:
+                ts.deleteRecord()
+        ts.closeRecordPage()
+        tx.commit()
+
+        tx = Transaction(fm, lm, bm)
+        ts = TableScan(tx, 'sparse', layout)
+        start = time.time()
+        found = 0
+        while ts.nextRecord():
+            found += 1
+        ts.closeRecordPage()
+        tx.commit()
+        report('scan, 5%% of %d slots used' % row_count, found, time.time() - start, 'rows')
+
+    with tempDB(block_size=block_size, buffer_pool_size=32) as (fm, lm, bm):
+        tx = Transaction(fm, lm, bm)
+        ts = TableScan(tx, 'full', layout)
+        for i in range(row_count):
+            ts.insert({'a': i, 'b': 'x'})
+            if ts.current_slot_index == layout.slotsPerBlock(block_size) // 2:
+                ts.deleteRecord() # one free slot in the middle of every block
+        ts.closeRecordPage()
+        tx.commit()
+
+        tx = Transaction(fm, lm, bm)
+        ts = TableScan(tx, 'full', layout)
+        start = time.time()
+        for i in range(block_count):
+            ts.insert({'a': i, 'b': 'y'})
+        ts.closeRecordPage()
+        tx.commit()
+        report('inserts into a full table(%d blocks)' % block_count, block_count, time.time() - start, 'rows')
+
+
+# One row inserted per transaction into a full table; every insert starts from a fresh TableScan(block 0)
+# The free space map sends it straight to the block with room, whatever the table size
+def insert_latency(block_counts=(50, 500), tx_count=200, block_size=4096):
+    layout = Layout(Schema(['a', 'int', 4], ['b', 'str', 4]))
+    for block_count in block_counts:
+        with tempDB(block_size=block_size, buffer_pool_size=32) as (fm, lm, bm):
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'full', layout)
+            for i in range(block_count * layout.slotsPerBlock(block_size)):
+                ts.insert({'a': i, 'b': 'x'})
+            ts.closeRecordPage()
+            tx.commit()
+
+            start = time.time()
+            for i in range(tx_count):
+                tx = Transaction(fm, lm, bm)
+                ts = TableScan(tx, 'full', layout)
+                ts.insert({'a': i, 'b': 'y'})
+                ts.closeRecordPage()
+                tx.commit()
+            report('single row insert txs, %d full blocks' % block_count, tx_count, time.time() - start, 'txs')
+
+
+# Fixed slots vs slotted pages for string columns that mostly use a fraction of their declared length
+# Reports how many rows fit in a block and how fast a scan reads them back
+def slotted_pages(row_count=20000, block_size=4096):
+    schema = Schema(['id', 'int', 4], ['name', 'str', 40], ['email', 'str', 60], ['bio', 'str', 200])
+    rng = random.Random(7)
+    rows = [{'id': i,
+             'name': 'user%d' % rng.randint(0, 99999),
+             'email': 'user%d@example.com' % rng.randint(0, 99999),
+             'bio': 'x' * (rng.randint(0, 40) if rng.random() < 0.9 else rng.randint(40, 200))} for i in range(row_count)]
+    for layout in (Layout(schema), SlottedLayout(schema)):
+        name = 'slotted' if isinstance(layout, SlottedLayout) else 'fixed'
+        with tempDB(block_size=block_size, buffer_pool_size=32) as (fm, lm, bm):
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'people', layout)
+            start = time.time()
+            for row in rows:
+                ts.insert(row)
+            ts.closeRecordPage()
+            tx.commit()
+            report('%s, inserts' % name, row_count, time.time() - start, 'rows')
+            print('%-45s %10.1f rows/block' % ('', row_count / fm.length('people.tbl')))
+
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'people', layout)
+            start = time.time()
+            while ts.nextRecord():
+                ts.getInt('id'), ts.getString('name'), ts.getString('email'), ts.getString('bio')
+            ts.closeRecordPage()
+            tx.commit()
+            report('%s, scan' % name, row_count, time.time() - start, 'rows')
+
+
+def large_values(row_count=2000, value_size=2000, block_size=400):
+    schema = Schema(['id', 'int', 4], ['name', 'str', 20], ['doc', 'text', 40])
+    rng = random.Random(7)
+    rows = [{'id': i, 'name': 'doc%d' % i, 'doc': ''.join(rng.choice('abcdefgh') for _ in range(value_size))} for i in range(row_count)]
+    for layout in (Layout(schema), SlottedLayout(schema)):
+        name = 'slotted' if isinstance(layout, SlottedLayout) else 'fixed'
+        with tempDB(block_size=block_size, buffer_pool_size=32) as (fm, lm, bm):
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'docs', layout)
+            start = time.time()
+            for row in rows:
+                ts.insert(row)
+            ts.closeRecordPage()
+            tx.commit()
+            report('%s, %d byte values, inserts' % (name, value_size), row_count, time.time() - start, 'rows')
+            print('%-45s %10d table blocks, %d overflow blocks' % ('', fm.length('docs.tbl'), fm.length('docs.ovf')))
+
+            for fields in (('id', 'name'), ('id', 'name', 'doc')):
+                tx = Transaction(fm, lm, bm)
+                ts = TableScan(tx, 'docs', layout)
+                start = time.time()
+                while ts.nextRecord():
+                    for field_name in fields:
+                        ts.getVal(field_name)
+                ts.closeRecordPage()
+                tx.commit()
+                report('%s, scan %s' % (name, ', '.join(fields)), row_count, time.time() - start, 'rows')
+
+
+# Reading and rewriting every field of a wide table, field by field and as whole rows(RowCodec)
+def row_codec(row_count=20000, block_size=4096):
+    fields = [('c%d' % i, 'int', 4) if i % 2 else ('c%d' % i, 'str', 12) for i in range(20)]
+    layout = Layout(Schema(*fields))
+    row = {name: (i if field_type == 'int' else 'value%d' % i) for i, (name, field_type, _) in enumerate(fields)}
+    with tempDB(block_size=block_size, buffer_pool_size=32) as (fm, lm, bm):
+        tx = Transaction(fm, lm, bm)
+        ts = TableScan(tx, 'wide', layout)
+        for _ in range(row_count):
+            ts.insert(row)
+        ts.closeRecordPage()
+        tx.commit()
+
+        for by_row in (False, True):
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'wide', layout)
+            start = time.time()
+            while ts.nextRecord():
+                if by_row:
+                    ts.getRow()
+                else:
+                    for name, _, _ in fields:
+                        ts.getVal(name)
+            ts.closeRecordPage()
+            tx.commit()
+            report('20 column scan, %s' % ('getRow' if by_row else 'getVal per field'), row_count, time.time() - start, 'rows')
+
+        for by_row in (False, True):
+            tx = Transaction(fm, lm, bm)
+            ts = TableScan(tx, 'wide', layout)
+            start = time.time()
+            while ts.nextRecord():
+                if by_row:
+                    ts.setRow(row)
+                else:
+                    ts.updateRow(row)
+            ts.closeRecordPage()
+            tx.commit()
+            report('20 column rewrite, %s' % ('setRow' if by_row else 'updateRow'), row_count, time.time() - start, 'rows')
+
+
+BENCHMARKS = {
+    'log_iter': log_iter,
+    'commit_latency': commit_latency,
+    'rollback_chain': rollback_chain,
+    'recovery': recovery,
+    'startup': startup,
+    'lock_throughput': lock_throughput,
+    'deadlock': deadlock,
+    'scan_locks': scan_locks,
+    'row_updates': row_updates,
+    'mixed_workload': mixed_workload,
+    'occ_vs_2pl': occ_vs_2pl,
+    'point_reads': point_reads,
+    'isolation_levels': isolation_levels,
+    'hot_rows': hot_rows,
+    'retry_backoff': retry_backoff,
+    'pin_bookkeeping': pin_bookkeeping,
+    'wide_inserts': wide_inserts,
+    'table_growth': table_growth,
+    'sparse_tables': sparse_tables,
+    'insert_latency': insert_latency,
+    'slotted_pages': slotted_pages,
+    'large_values': large_values,
+    'row_codec': row_codec,
+}
+
+if __name__ == '__main__':
+    for name in (sys.argv[1:] or BENCHMARKS.keys()):
+        BENCHMARKS[name]()
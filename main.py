@@ -32,15 +32,30 @@ class SimpleDB:
         self.lm: LogMgr = LogMgr(self.fm, db_name + '.log')
         self.bm: BufferMgr = BufferMgr(self.fm, self.lm, buffer_pool_size)
 
+        # must be checked before the first transaction writes its <START>
+        clean_shutdown = self.fm.db_exists and RecoveryMgr.isCleanShutdown(self.lm)
+
         tx: Transaction = Transaction(self.fm, self.lm, self.bm)
-        if self.fm.db_exists:
+        if not self.fm.db_exists:
+            print('Created new db...')
+        elif clean_shutdown:
+            print('Clean shutdown, skipping recovery...')
+        else:
             print('Recovering...')
             tx.recover()
-        else:
-            print('Created new db...')
-            self.mm = MetadataMgr(tx, True) # if db does not existes, then initialize everything
+        self.mm = MetadataMgr(tx, not self.fm.db_exists) # if db does not existes, then initialize everything
         tx.commit()
 
+        # non-quiescent checkpoints keep the recovery window short while the db is running
+        self.checkpointer: Checkpointer = Checkpointer(self.lm, self.bm)
+        self.checkpointer.start()
+
+    # Orderly shutdown; every transaction must be completed
+    # Writes every buffer to disk, so the next startup can skip recovery
+    def close(self):
+        self.checkpointer.stop()
+        RecoveryMgr.shutdown(self.lm, self.bm)
+
 
 
 db = SimpleDB('Plannertest', 400, 8)
@@ -68,4 +83,6 @@ while scn.nextRecord():
     for field_name in scn_schema.field_info.keys():
         print(scn.getVal(field_name), end=" ")
     print()
-scn.closeRecordPage()
\ No newline at end of file
+scn.closeRecordPage()
+tx.commit()
+db.close()
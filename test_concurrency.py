@@ -0,0 +1,195 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from Planner import *
+
+
+class ConcurrencyTest(unittest.TestCase):
+    BLOCK_SIZE = 400
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+        self.locktable = ConcurrencyMgr._global_locktable = LockTable()
+        self.fm = FileMgr('testdb', ConcurrencyTest.BLOCK_SIZE)
+        self.lm = LogMgr(self.fm, 'testdb.log')
+        self.bm = BufferMgr(self.fm, self.lm, 16)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def newTransaction(self, **tx_options):
+        return Transaction(self.fm, self.lm, self.bm, **tx_options)
+
+    # Blocks of a file, each with an int at offset 0
+    def makeBlocks(self, file_name, values):
+        tx = self.newTransaction()
+        blocks = []
+        for value in values:
+            blk = tx.append(file_name)
+            tx.pin(blk)
+            tx.setInt(blk, 0, value, True)
+            blocks.append(blk)
+        tx.commit()
+        return blocks
+
+    def readInts(self, blocks):
+        tx = self.newTransaction()
+        values = []
+        for blk in blocks:
+            tx.pin(blk)
+            values.append(tx.getInt(blk, 0))
+        tx.commit()
+        return values
+
+    def waitUntilBlocked(self, tx):
+        deadline = time.time() + 10
+        while tx.txnum not in self.locktable._waits_for:
+            self.assertLess(time.time(), deadline, 'Tx ' + str(tx.txnum) + ' never waited for a lock')
+            time.sleep(0.001)
+
+    # The transaction that closes the cycle is not necessarily the victim; the one that has logged less is
+    def test_deadlock_victim(self):
+        a, b = self.makeBlocks('locks.tbl', [0, 0])
+        big, small = self.newTransaction(), self.newTransaction()
+        big.pin(a)
+        big.setInt(a, 0, 1, True)
+        big.setInt(a, 4, 1, True)
+        small.pin(b)
+        small.setInt(b, 0, 2, True)
+
+        errors = []
+        def bigWrites():
+            try:
+                big.pin(b)
+                big.setInt(b, 0, 1, True)
+            except Exception as e:
+                errors.append(e)
+        waiter = threading.Thread(target=bigWrites)
+        waiter.start()
+        self.waitUntilBlocked(big)
+        small.pin(a)
+        with self.assertRaises(LockAbortException):
+            small.setInt(a, 0, 2, True)
+        small.rollback()
+        waiter.join()
+        big.commit()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.readInts([a, b]), [1, 1])
+
+    # Reads a, writes b; fails if a transaction that committed after it began wrote a
+    def test_optimistic_validation(self):
+        a, b = self.makeBlocks('occ.tbl', [10, 20])
+        occ = self.newTransaction(optimistic=True)
+        occ.pin(a)
+        occ.pin(b)
+        occ.setInt(b, 0, occ.getInt(a, 0) + 1, True)
+        self.assertEqual(self.readInts([b]), [20]) # buffered until commit
+
+        writer = self.newTransaction()
+        writer.pin(a)
+        writer.setInt(a, 0, 30, True)
+        writer.commit()
+        with self.assertRaises(LockAbortException):
+            occ.commit()
+        occ.rollback()
+        self.assertEqual(self.readInts([a, b]), [30, 20])
+
+        occ = self.newTransaction(optimistic=True)
+        occ.pin(a)
+        occ.pin(b)
+        occ.setInt(b, 0, occ.getInt(a, 0) + 1, True)
+        occ.commit()
+        self.assertEqual(self.readInts([a, b]), [30, 31])
+
+    # Transaction.run rolls back the failed attempt and runs the work again
+    def test_optimistic_retry(self):
+        a, b = self.makeBlocks('occ.tbl', [10, 20])
+        attempts = []
+        def work(tx):
+            tx.pin(a)
+            tx.pin(b)
+            value = tx.getInt(a, 0)
+            if not attempts: # a conflicting commit after the first attempt read a
+                writer = self.newTransaction()
+                writer.pin(a)
+                writer.setInt(a, 0, 30, True)
+                writer.commit()
+            attempts.append(value)
+            tx.setInt(b, 0, value + 1, True)
+        Transaction.run(self.fm, self.lm, self.bm, work, optimistic=True)
+        self.assertEqual(attempts, [10, 30])
+        self.assertEqual(self.readInts([a, b]), [30, 31])
+
+    def tableRows(self, tx, table_name, layout):
+        ts = TableScan(tx, table_name, layout)
+        rows = set()
+        while ts.nextRecord():
+            rows.add((ts.getInt('id'), ts.getString('name')))
+        ts.closeRecordPage()
+        return rows
+
+    # A snapshot sees the transactions that completed before it began, nothing else
+    # The first writer starts before any snapshot is open, so its earlier writes were never recorded(see VersionStore)
+    def test_snapshot_visibility(self):
+        schema = Schema(['id', 'int', 4], ['name', 'str', 12])
+        for layout in (Layout(schema), SlottedLayout(schema)):
+            with self.subTest(layout=type(layout).__name__):
+                table_name = type(layout).__name__
+                tx = self.newTransaction()
+                ts = TableScan(tx, table_name, layout)
+                for row_id in range(30):
+                    ts.insert({'id': row_id, 'name': 'v0'})
+                ts.closeRecordPage()
+                tx.commit()
+                before = {(row_id, 'v0') for row_id in range(30)}
+
+                early = self.newTransaction()
+                ts = TableScan(early, table_name, layout)
+                while ts.nextRecord():
+                    if ts.getInt('id') == 0:
+                        ts.deleteRecord()
+                    elif ts.getInt('id') == 1:
+                        ts.setString('name', 'early')
+                ts.closeRecordPage()
+                self.assertFalse(self.bm.versions.recording)
+
+                snapshot = self.newTransaction(snapshot=True)
+                self.assertEqual(self.tableRows(snapshot, table_name, layout), before)
+                early.commit()
+                late = self.newTransaction()
+                ts = TableScan(late, table_name, layout)
+                for row_id in range(100, 130):
+                    ts.insert({'id': row_id, 'name': 'late'})
+                ts.closeRecordPage()
+                late.commit()
+                self.assertEqual(self.tableRows(snapshot, table_name, layout), before)
+
+                rolled_back = self.newTransaction()
+                ts = TableScan(rolled_back, table_name, layout)
+                ts.nextRecord()
+                ts.setString('name', 'gone')
+                ts.closeRecordPage()
+                after = (before - {(0, 'v0'), (1, 'v0')}) | {(1, 'early')} | {(row_id, 'late') for row_id in range(100, 130)}
+                second = self.newTransaction(snapshot=True)
+                self.assertEqual(self.tableRows(second, table_name, layout), after)
+                rolled_back.rollback()
+                self.assertEqual(self.tableRows(second, table_name, layout), after)
+                self.assertEqual(self.tableRows(snapshot, table_name, layout), before)
+                snapshot.commit()
+                second.commit()
+
+                # Nothing is kept once no snapshot is open
+                self.assertFalse(self.bm.versions.recording)
+                self.assertEqual(self.bm.versions.deltas, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
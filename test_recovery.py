@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from Planner import *
+
+
+# Crash and recover round trips
+# A crash loses the buffer pool, the log tail that was not flushed and the lock table; the files on disk stay
+#   crash(flush_buffers=False) keeps only what commits flushed to the log, recovery has to redo it
+#   crash(flush_buffers=True) writes every page first, the changes of unfinished transactions included, recovery has to undo them
+class RecoveryTest(unittest.TestCase):
+    BLOCK_SIZE = 400
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+        ConcurrencyMgr._global_locktable = LockTable()
+        self.fm = FileMgr('testdb', RecoveryTest.BLOCK_SIZE)
+        self.lm = LogMgr(self.fm, 'testdb.log')
+        self.bm = BufferMgr(self.fm, self.lm, 8)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def crash(self, flush_buffers):
+        if flush_buffers:
+            self.bm.flushAll()
+        ConcurrencyMgr._global_locktable = LockTable()
+        self.lm = LogMgr(self.fm, 'testdb.log')
+        self.bm = BufferMgr(self.fm, self.lm, 8)
+        Transaction(self.fm, self.lm, self.bm).recover()
+
+    def loggedOps(self):
+        return {LogRecord.createLogRecord(log_record)[0] for log_record in self.lm.iterator()}
+
+    # {id: row} of the table as a new transaction reads it
+    def rows(self, table_name, layout):
+        tx = Transaction(self.fm, self.lm, self.bm)
+        ts = TableScan(tx, table_name, layout)
+        rows = {}
+        while ts.nextRecord():
+            row = ts.getRow()
+            rows[row['id']] = row
+        ts.closeRecordPage()
+        tx.commit()
+        return rows
+
+    # Inserts, updates and deletes over several blocks; returns the rows the table has after it
+    def changeRows(self, tx, table_name, layout, values, rows=None):
+        rows = dict(rows or {})
+        ts = TableScan(tx, table_name, layout)
+        while ts.nextRecord():
+            row_id = ts.getInt('id')
+            if row_id % 3 == 0:
+                ts.deleteRecord()
+                del rows[row_id]
+            elif row_id % 3 == 1:
+                ts.updateRow({'name': 'upd' + str(row_id), 'bio': values(row_id + 1000)})
+                rows[row_id] = dict(rows[row_id], name='upd' + str(row_id), bio=values(row_id + 1000))
+        first = max(rows, default=0) + 1
+        for row_id in range(first, first + 20):
+            rows[row_id] = {'id': row_id, 'name': 'new' + str(row_id), 'bio': values(row_id)}
+            ts.insert(rows[row_id])
+        ts.closeRecordPage()
+        return rows
+
+    def roundTrip(self, layout, values, table_name='people'):
+        tx = Transaction(self.fm, self.lm, self.bm)
+        committed = self.changeRows(tx, table_name, layout, values)
+        tx.commit()
+        tx = Transaction(self.fm, self.lm, self.bm)
+        committed = self.changeRows(tx, table_name, layout, values, committed)
+        tx.commit()
+        self.crash(flush_buffers=False)
+        self.assertEqual(self.rows(table_name, layout), committed)
+
+        tx = Transaction(self.fm, self.lm, self.bm)
+        self.changeRows(tx, table_name, layout, values, committed)
+        self.crash(flush_buffers=True)
+        self.assertEqual(self.rows(table_name, layout), committed)
+
+    def schema(self, bio_type):
+        return Schema(['id', 'int', 4], ['name', 'str', 12], ['bio', bio_type, 20])
+
+    def test_fixed_layout(self):
+        self.roundTrip(Layout(self.schema('str')), lambda row_id: 'bio' + str(row_id))
+
+    def test_slotted_layout(self):
+        self.roundTrip(SlottedLayout(self.schema('str')), lambda row_id: 'b' * (row_id % 20))
+
+    def test_text_values_in_overflow_blocks(self):
+        for layout in (Layout(self.schema('text')), SlottedLayout(self.schema('text'))):
+            with self.subTest(layout=type(layout).__name__):
+                self.roundTrip(layout, lambda row_id: str(row_id) * (1 if row_id % 2 else 300), type(layout).__name__)
+
+    def test_row_records(self):
+        self.roundTrip(Layout(self.schema('str')), lambda row_id: 'bio' + str(row_id))
+        self.assertTrue({LogRecord.INSERTROW, LogRecord.UPDATEROW, LogRecord.DELETEROW, LogRecord.FORMATPAGE} <= self.loggedOps())
+
+    def test_field_records(self):
+        tx = Transaction(self.fm, self.lm, self.bm)
+        blk = tx.append('fields.tbl')
+        tx.pin(blk)
+        tx.setInt(blk, 0, 7, True)
+        tx.setString(blk, 8, 'seven', True)
+        tx.commit()
+        self.crash(flush_buffers=False)
+        self.assertTrue({LogRecord.SETINT, LogRecord.SETSTRING} <= self.loggedOps())
+
+        tx = Transaction(self.fm, self.lm, self.bm)
+        tx.pin(blk)
+        self.assertEqual((tx.getInt(blk, 0), tx.getString(blk, 8)), (7, 'seven'))
+        tx.setInt(blk, 0, 8, True)
+        tx.setString(blk, 8, 'eight', True)
+        self.crash(flush_buffers=True)
+
+        tx = Transaction(self.fm, self.lm, self.bm)
+        tx.pin(blk)
+        self.assertEqual((tx.getInt(blk, 0), tx.getString(blk, 8)), (7, 'seven'))
+        tx.commit()
+
+    # The free space map is not logged; redo of a formatted block puts it back on the map
+    def test_format_page_redo(self):
+        layout = Layout(self.schema('str'))
+        tx = Transaction(self.fm, self.lm, self.bm)
+        ts = TableScan(tx, 'people', layout)
+        ts.insert({'id': 1, 'name': 'one'})
+        ts.closeRecordPage()
+        tx.commit()
+        self.fm.writePageToBlock(Block('people.fsm', 0), Page(RecoveryTest.BLOCK_SIZE)) # the map page on disk lost the bit
+        self.crash(flush_buffers=False)
+        self.assertEqual(list(self.rows('people', layout)), [1])
+        tx = Transaction(self.fm, self.lm, self.bm)
+        self.assertEqual(tx.nextFreeBlock('people.tbl', -1), 0)
+        tx.commit()
+
+
+if __name__ == '__main__':
+    unittest.main()